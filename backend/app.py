@@ -1,26 +1,36 @@
 import os
-import zipfile
 import io
 import time
 import threading
 import requests
 import unicodedata
 import re
-from flask import Flask, render_template, request, send_file, jsonify, session
+import json
+import uuid
+import base64
+import binascii
+from flask import Flask, render_template, request, send_file, jsonify, session, Response, stream_with_context
 from werkzeug.security import generate_password_hash, check_password_hash
-from openpyxl import load_workbook
 from openpyxl.styles import PatternFill
-from datetime import datetime
+from datetime import datetime, timedelta
 
 # Local imports
-from .models import db, User, Network, FileMetadata
+from sqlalchemy import func, or_, and_
+from .models import db, User, Network, FileMetadata, AuditJob, AuditSession, UploadSession, ScanUpload, MasterSchema, ensure_indexes, ensure_columns
+from . import master_index, sheet_schema, columnar, jobs, chunked_upload, scans, audit_sessions, drive_outbox, progress as events
+from .verification import parse_scanned_codes, parse_room_markers, compare_codes
+from .reports import write_audit_zip, write_batch_zip
+from .workbook_cache import workbook_cache, file_digest
+from .scheduler import scheduler
 
 app = Flask(__name__, static_folder=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static'))
 app.secret_key = 'super_secret_key_sesi_sorocaba' # Change in production
+# Behind nginx/Apache, let the proxy stream downloads (X-Sendfile / X-Accel-Redirect)
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE') == '1'
 
 # --- Database Config ---
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DB_PATH = os.path.join(BASE_DIR, 'database.db')
+DB_PATH = os.environ.get('DATABASE_PATH') or os.path.join(BASE_DIR, 'database.db')
 app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{DB_PATH}'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
@@ -28,61 +38,134 @@ db.init_app(app)
 
 # --- File Storage Config ---
 PROJECT_ROOT = os.path.abspath(os.path.join(BASE_DIR, '..'))
-UPLOAD_FOLDER = os.path.join(PROJECT_ROOT, 'uploads')
+DATA_ROOT = os.environ.get('DATA_ROOT') or PROJECT_ROOT # uploads/ and Relatorios_Gerados/ live here (tests use a temp dir)
+UPLOAD_FOLDER = os.path.join(DATA_ROOT, 'uploads')
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
 SCANNED_DATA_FOLDER = os.path.join(UPLOAD_FOLDER, 'scanned_data')
 os.makedirs(SCANNED_DATA_FOLDER, exist_ok=True)
 
-REPORTS_FOLDER = os.path.join(PROJECT_ROOT, 'Relatorios_Gerados')
+REPORTS_FOLDER = os.path.join(DATA_ROOT, 'Relatorios_Gerados')
 os.makedirs(REPORTS_FOLDER, exist_ok=True)
 
 # Initialize DB
 with app.app_context():
     db.create_all()
+    ensure_columns()
+    ensure_indexes()
 
-# --- Keep Alive System ---
-def keep_alive_pinger():
-    """Pings the server every 14 minutes to prevent sleep."""
-    url = "http://127.0.0.1:8000/keep_alive" # Default Gunicorn port often 8000 or from env
-    # In production (Render), we might need the public URL. 
-    # But localhost ping might suffice if the server process itself stays active.
-    # However, Render might kill if no external requests.
-    # User requested "something to send requests".
-    
-    # Better approach for Render: Use the public URL if available, else localhost
-    # Render sets RENDER_EXTERNAL_URL
+# --- Login Lists Cache ---
+# City and network pickers are read on every login screen; a short TTL keeps
+# other workers' copies fresh enough, writes here invalidate this worker's.
+
+LIST_CACHE_SECONDS = 60
+
+_list_cache = {} # key -> (expires_at, value)
+_list_cache_lock = threading.Lock()
+
+def cached_list(key, loader):
+    now = time.time()
+    with _list_cache_lock:
+        entry = _list_cache.get(key)
+        if entry and entry[0] > now: return entry[1]
+    value = loader()
+    with _list_cache_lock:
+        _list_cache[key] = (now + LIST_CACHE_SECONDS, value)
+    return value
+
+def invalidate_lists():
+    with _list_cache_lock:
+        _list_cache.clear()
+
+def load_cities():
+    # DISTINCT city from Network table
+    return sorted(r[0] for r in db.session.query(Network.city).distinct())
+
+def networks_query(city):
+    """(id, name, owner email) of a city's networks, in one joined query."""
+    return db.session.query(Network.id, Network.name, User.email)\
+        .outerjoin(User, User.id == Network.admin_id)\
+        .filter(Network.city == city)
+
+def load_networks(city):
+    rows = networks_query(city).order_by(Network.id).all()
+    return [{'id': r[0], 'name': r[1], 'owner': r[2] or 'Unknown'} for r in rows]
+
+# --- Health & Warm-up (one scheduler per host) ---
+
+HEALTH_CHECK_SECONDS = 14 * 60 # Render spins instances down after 15 idle minutes
+WARM_UP_SECONDS = 10 * 60
+
+def health_check():
+    """Requests /keep_alive through the public URL so the host counts as active."""
+    # Render sets RENDER_EXTERNAL_URL; locally, the port gunicorn listens on
     public_url = os.environ.get('RENDER_EXTERNAL_URL')
-    target_url = public_url + "/keep_alive" if public_url else url
+    target_url = (public_url or f"http://127.0.0.1:{os.environ.get('PORT', 8000)}") + "/keep_alive"
+    requests.get(target_url, timeout=30).raise_for_status()
 
-    print(f" * Keep-Alive Pinger Initialized. Target: {target_url}")
-    
-    while True:
-        time.sleep(14 * 60) # 14 minutes
+def warm_lists():
+    for city in cached_list('cities', load_cities):
+        cached_list(('networks', city), lambda: load_networks(city))
+
+def warm_room_index():
+    """Indexes masters that are missing or stale, so no first /get_rooms pays for a parse."""
+    filepaths = {r[0] for r in FileMetadata.query.filter_by(type='master_spreadsheet').with_entities(FileMetadata.filepath)}
+    for filepath in filepaths:
+        path = os.path.join(app.config['UPLOAD_FOLDER'], filepath)
+        if not os.path.exists(path): continue
         try:
-            print(" * Sending Keep-Alive Ping...")
-            requests.get(target_url)
+            if master_index.get_index(filepath, path) is None:
+                master_index.build_index(filepath, path)
+            else:
+                master_index.known_rooms(filepath, path) # Pulls the index pages into the OS cache
         except Exception as e:
-            print(f" * Keep-Alive Ping Failed: {e}")
+            db.session.rollback()
+            print(f"Error warming {filepath}: {e}")
+
+scheduler.add('health_check', HEALTH_CHECK_SECONDS, health_check, run_at_start=False)
+scheduler.add('warm_room_index', WARM_UP_SECONDS, warm_room_index)
+scheduler.add('warm_lists', WARM_UP_SECONDS, warm_lists)
 
-# Start Pinger in Background Thread
 # Only start if not in debug/reloader mode to avoid duplicates
 if not app.debug or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
-    t = threading.Thread(target=keep_alive_pinger, daemon=True)
-    t.start()
+    if scheduler.start(app, os.path.join(BASE_DIR, '.scheduler.lock')):
+        print(f" * Host scheduler running in worker {os.getpid()}")
+
+    # Every worker fills its own login lists once, off the request path
+    def warm_worker():
+        with app.app_context():
+            try:
+                warm_lists()
+            finally:
+                db.session.remove()
+    threading.Thread(target=warm_worker, daemon=True).start()
 
 @app.route('/keep_alive')
 def keep_alive():
-    return jsonify({"status": "alive", "timestamp": time.time()})
+    """Liveness plus this worker's cache and the shared queue stats."""
+    with _list_cache_lock:
+        list_entries = len(_list_cache)
+    return jsonify({
+        "status": "alive",
+        "timestamp": time.time(),
+        "pid": os.getpid(),
+        "cache": {
+            "workbooks": workbook_cache.stats(),
+            "lists": {"entries": list_entries, "ttl": LIST_CACHE_SECONDS}
+        },
+        "queues": {
+            "jobs": {status: count for status, count in db.session.query(AuditJob.status, func.count(AuditJob.id)).group_by(AuditJob.status)},
+            "drive_outbox": drive_outbox.stats()
+        },
+        "scheduler": scheduler.stats()
+    })
 
 # --- Routes ---
 
 @app.route('/get_active_cities', methods=['GET'])
 def get_active_cities():
-    # DISTINCT city from Network table
-    cities = [r[0] for r in db.session.query(Network.city).distinct()]
-    return jsonify({'cities': sorted(cities)})
+    return jsonify({'cities': cached_list('cities', load_cities)})
 
 @app.route('/')
 def index():
@@ -164,6 +247,7 @@ def register_admin():
         db.session.add(new_net)
         
         db.session.commit()
+        invalidate_lists()
         return jsonify({'message': 'Conta e Rede criadas com sucesso! Faça login.'})
     except Exception as e:
         db.session.rollback()
@@ -191,6 +275,7 @@ def create_network():
         new_net = Network(name=name, password=hashed, city=city, admin_id=uid)
         db.session.add(new_net)
         db.session.commit()
+        invalidate_lists()
         return jsonify({'success': True})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -212,6 +297,7 @@ def delete_network():
         
     db.session.delete(net)
     db.session.commit()
+    invalidate_lists()
     return jsonify({'success': True})
 
 @app.route('/get_my_networks', methods=['GET'])
@@ -227,17 +313,24 @@ def get_networks():
     city = request.args.get('city')
     if not city: return jsonify({'networks': []})
     
-    nets = Network.query.filter_by(city=city).all()
-    results = []
-    for n in nets:
-        owner = User.query.get(n.admin_id)
-        owner_email = owner.email if owner else 'Unknown'
-        results.append({
-            'id': n.id,
-            'name': n.name,
-            'owner': owner_email
-        })
-    return jsonify({'networks': results})
+    with_counts = request.args.get('counts') in ('1', 'true')
+    if not with_counts:
+        return jsonify({'networks': cached_list(('networks', city), lambda: load_networks(city))})
+    
+    # Still one query: the network list plus report/master counts
+    def count_by_network(file_type):
+        return db.session.query(FileMetadata.network_id.label('network_id'), func.count(FileMetadata.id).label('total'))\
+            .filter(FileMetadata.type == file_type)\
+            .group_by(FileMetadata.network_id).subquery()
+    reports = count_by_network('audit_report')
+    masters = count_by_network('master_spreadsheet')
+    rows = networks_query(city)\
+        .outerjoin(reports, reports.c.network_id == Network.id)\
+        .outerjoin(masters, masters.c.network_id == Network.id)\
+        .add_columns(func.coalesce(reports.c.total, 0), func.coalesce(masters.c.total, 0))\
+        .order_by(Network.id).all()
+    return jsonify({'networks': [{'id': r[0], 'name': r[1], 'owner': r[2] or 'Unknown', 'report_count': r[3], 'master_count': r[4]}
+                                 for r in rows]})
 
 @app.route('/join_network', methods=['POST'])
 def join_network():
@@ -273,6 +366,36 @@ def join_network():
 
 # --- File Management (Local FS + SQL Metadata) ---
 
+def register_master(filename, safe_name, save_path, user_id, network_id):
+    """Indexes a master already saved at save_path and records its metadata. Returns the JSON reply."""
+    # Parse once here so get_rooms/verify never re-open the workbook.
+    # On a replacement only the sheets whose content changed are re-indexed.
+    index_stats = None
+    try:
+        index_stats = master_index.build_index(safe_name, save_path)
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error indexing {safe_name}: {e}")
+    
+    # Same file for the same network: refresh the existing entry instead of listing it twice
+    existing = FileMetadata.query.filter_by(filepath=safe_name, type='master_spreadsheet', network_id=network_id).first()
+    if existing:
+        existing.filename = filename
+        existing.user_id = user_id
+        existing.upload_date = datetime.utcnow()
+    else:
+        db.session.add(FileMetadata(
+            filename=filename,
+            filepath=safe_name,
+            type='master_spreadsheet',
+            user_id=user_id,
+            network_id=network_id
+        ))
+    db.session.commit()
+    
+    message = f'Planilha "{filename}" atualizada com sucesso!' if existing else f'Planilha "{filename}" carregada com sucesso!'
+    return {'message': message, 'index': index_stats}
+
 @app.route('/upload_master', methods=['POST'])
 def upload_master():
     if not session.get('is_admin'):
@@ -293,25 +416,163 @@ def upload_master():
         save_path = os.path.join(app.config['UPLOAD_FOLDER'], safe_name)
         file.save(save_path)
         
-        # Save Metadata
-        user_id = int(session.get('user_id'))
         network_id = request.form.get('network_id')
-        if network_id: network_id = int(network_id)
-        
-        new_file = FileMetadata(
-            filename=filename,
-            filepath=safe_name,
-            type='master_spreadsheet',
-            user_id=user_id,
-            network_id=network_id
-        )
-        db.session.add(new_file)
-        db.session.commit()
-        
-        return jsonify({'message': f'Planilha "{filename}" carregada com sucesso!'})
+        return jsonify(register_master(filename, safe_name, save_path, int(session.get('user_id')), int(network_id) if network_id else None))
     
     return jsonify({'error': 'Formato inválido. Apenas .xlsx'}), 400
 
+# --- Chunked Upload (init, put chunks, complete; resumable) ---
+
+def get_upload_session(upload_id):
+    """The caller's upload session, or an error reply."""
+    upload = UploadSession.query.get(upload_id)
+    if not upload: return None, (jsonify({'error': 'Envio não encontrado ou expirado'}), 404)
+    if upload.user_id != int(session.get('user_id')): return None, (jsonify({'error': 'Permissão negada'}), 403)
+    return upload, None
+
+@app.route('/upload_master/chunked', methods=['POST'])
+def init_chunked_upload():
+    if not session.get('is_admin'): return jsonify({'error': 'Acesso negado.'}), 403
+
+    data = request.json or {}
+    filename = data.get('filename') or ''
+    if not filename.lower().endswith('.xlsx'): return jsonify({'error': 'Formato inválido. Apenas .xlsx'}), 400
+    try:
+        total_size = int(data.get('total_size'))
+        chunk_size = int(data.get('chunk_size') or chunked_upload.MAX_CHUNK_SIZE)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Tamanho inválido'}), 400
+    if total_size <= 0: return jsonify({'error': 'Arquivo vazio'}), 400
+    chunk_size = min(max(chunk_size, chunked_upload.MIN_CHUNK_SIZE), chunked_upload.MAX_CHUNK_SIZE)
+
+    chunked_upload.purge_stale(app.config['UPLOAD_FOLDER'])
+
+    network_id = data.get('network_id')
+    upload = UploadSession(
+        id=uuid.uuid4().hex,
+        filename=filename,
+        filepath=re.sub(r'[^a-zA-Z0-9_.-]', '_', filename),
+        total_size=total_size,
+        chunk_size=chunk_size,
+        file_sha1=data.get('sha1'),
+        user_id=int(session.get('user_id')),
+        network_id=int(network_id) if network_id else None
+    )
+    db.session.add(upload)
+    db.session.commit()
+    return jsonify(chunked_upload.upload_status(app.config['UPLOAD_FOLDER'], upload)), 201
+
+@app.route('/upload_master/chunked/<upload_id>', methods=['GET'])
+def chunked_upload_status(upload_id):
+    """Lists the chunks already stored, so an interrupted client resumes from there."""
+    if not session.get('is_admin'): return jsonify({'error': 'Acesso negado.'}), 403
+    upload, error = get_upload_session(upload_id)
+    if error: return error
+    return jsonify(chunked_upload.upload_status(app.config['UPLOAD_FOLDER'], upload))
+
+@app.route('/upload_master/chunked/<upload_id>/<int:index>', methods=['PUT'])
+def put_chunk(upload_id, index):
+    """Raw chunk bytes in the body, SHA-1 hex in the X-Chunk-SHA1 header."""
+    if not session.get('is_admin'): return jsonify({'error': 'Acesso negado.'}), 403
+    upload, error = get_upload_session(upload_id)
+    if error: return error
+
+    try:
+        chunked_upload.save_chunk(app.config['UPLOAD_FOLDER'], upload, index, request.stream, request.headers.get('X-Chunk-SHA1'))
+    except chunked_upload.ChunkError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'success': True, 'index': index})
+
+@app.route('/upload_master/chunked/<upload_id>/complete', methods=['POST'])
+def complete_chunked_upload(upload_id):
+    """Assembles the chunks into the master file, then indexes it like /upload_master."""
+    if not session.get('is_admin'): return jsonify({'error': 'Acesso negado.'}), 403
+    upload, error = get_upload_session(upload_id)
+    if error: return error
+
+    filename, safe_name, network_id = upload.filename, upload.filepath, upload.network_id
+    save_path = os.path.join(app.config['UPLOAD_FOLDER'], safe_name)
+    try:
+        chunked_upload.assemble(app.config['UPLOAD_FOLDER'], upload, save_path)
+    except chunked_upload.ChunkError as e:
+        return jsonify({'error': str(e)}), 400
+
+    return jsonify(register_master(filename, safe_name, save_path, int(session.get('user_id')), network_id))
+
+@app.route('/upload_master/chunked/<upload_id>', methods=['DELETE'])
+def abort_chunked_upload(upload_id):
+    if not session.get('is_admin'): return jsonify({'error': 'Acesso negado.'}), 403
+    upload, error = get_upload_session(upload_id)
+    if error: return error
+    chunked_upload.discard(app.config['UPLOAD_FOLDER'], upload)
+    return jsonify({'success': True})
+
+# --- Listing Pagination (shared by list_masters / list_reports) ---
+
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+def encode_cursor(value, row_id):
+    return base64.urlsafe_b64encode(json.dumps([value, row_id]).encode()).decode()
+
+def decode_cursor(cursor):
+    """(value, id) of a cursor made by encode_cursor. Raises ValueError on anything else."""
+    try:
+        decoded = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (binascii.Error, UnicodeError) as e:
+        raise ValueError('cursor') from e
+    if not (isinstance(decoded, list) and len(decoded) == 2 and isinstance(decoded[0], str) and type(decoded[1]) is int):
+        raise ValueError('cursor')
+    return decoded[0], decoded[1]
+
+def paginate_files(query, default_sort, columns=()):
+    """Applies the listing filters, sort and keyset cursor from the query string.
+
+    Args: limit, cursor, sort ('date' | 'name'), order ('asc' | 'desc'),
+    prefix (filename), date_from / date_to (YYYY-MM-DD, inclusive).
+    Keyset on (upload_date, id) or (filename, id): no OFFSET, so every page
+    is an index range scan. Raises ValueError on bad arguments.
+    Returns (rows, next_cursor); rows carry id, filename, network_id, upload_date
+    plus any extra FileMetadata `columns` the caller asks for.
+    """
+    args = request.args
+
+    prefix = args.get('prefix')
+    if prefix:
+        escaped = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        query = query.filter(FileMetadata.filename.like(escaped + '%', escape='\\'))
+    if args.get('date_from'):
+        query = query.filter(FileMetadata.upload_date >= datetime.strptime(args['date_from'], '%Y-%m-%d'))
+    if args.get('date_to'):
+        query = query.filter(FileMetadata.upload_date < datetime.strptime(args['date_to'], '%Y-%m-%d') + timedelta(days=1))
+
+    sort = args.get('sort', default_sort)
+    if sort not in ('date', 'name'): raise ValueError('sort')
+    column = FileMetadata.filename if sort == 'name' else FileMetadata.upload_date
+    order = args.get('order', 'asc' if sort == 'name' else 'desc')
+    if order not in ('asc', 'desc'): raise ValueError('order')
+    limit = max(1, min(int(args.get('limit', PAGE_SIZE)), MAX_PAGE_SIZE))
+
+    cursor = args.get('cursor')
+    if cursor:
+        value, last_id = decode_cursor(cursor)
+        if sort == 'date': value = datetime.fromisoformat(value)
+        if order == 'desc':
+            query = query.filter(or_(column < value, and_(column == value, FileMetadata.id < last_id)))
+        else:
+            query = query.filter(or_(column > value, and_(column == value, FileMetadata.id > last_id)))
+
+    ordering = (column.desc(), FileMetadata.id.desc()) if order == 'desc' else (column.asc(), FileMetadata.id.asc())
+    rows = query.with_entities(FileMetadata.id, FileMetadata.filename, FileMetadata.network_id, FileMetadata.upload_date, *columns)\
+        .order_by(*ordering).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor(last.filename if sort == 'name' else last.upload_date.isoformat(), last.id)
+    return rows, next_cursor
+
 @app.route('/list_masters', methods=['GET'])
 def list_masters():
     user_id = session.get('user_id')
@@ -322,7 +583,9 @@ def list_masters():
     
     # Simple permissions
     if is_super:
-        pass
+        network_id = request.args.get('network_id')
+        if network_id:
+            query = query.filter_by(network_id=int(network_id))
     elif user_id:
         network_id = request.args.get('network_id')
         if network_id:
@@ -334,10 +597,13 @@ def list_masters():
         # Keeping logic: show files for this network
         query = query.filter((FileMetadata.network_id == int(connected_net_id)))
     else:
-        return jsonify({'masters': []})
+        return jsonify({'masters': [], 'next_cursor': None})
 
-    files = query.all()
-    return jsonify({'masters': sorted([f.filename for f in files])})
+    try:
+        rows, next_cursor = paginate_files(query, default_sort='name')
+    except ValueError:
+        return jsonify({'error': 'Parâmetros de listagem inválidos'}), 400
+    return jsonify({'masters': [r.filename for r in rows], 'next_cursor': next_cursor})
 
 @app.route('/delete_master', methods=['POST'])
 def delete_master():
@@ -357,8 +623,10 @@ def delete_master():
         full_path = os.path.join(app.config['UPLOAD_FOLDER'], f_meta.filepath)
         if os.path.exists(full_path):
             os.remove(full_path)
+        columnar.remove(full_path)
             
         # Remove DB
+        master_index.drop_index(f_meta.filepath)
         db.session.delete(f_meta)
         db.session.commit()
         return jsonify({'message': 'Removido com sucesso'})
@@ -369,10 +637,84 @@ def delete_master():
 def get_master(filename):
     if not session.get('is_admin'): return jsonify({'error': 'Acesso negado.'}), 403
     
-    f_meta = FileMetadata.query.filter_by(filename=filename).first()
+    f_meta = FileMetadata.query.filter_by(filename=filename, type='master_spreadsheet')\
+        .with_entities(FileMetadata.filepath).first()
     if not f_meta: return jsonify({'error': 'Arquivo não encontrado'}), 404
     
-    return send_file(os.path.join(app.config['UPLOAD_FOLDER'], f_meta.filepath), download_name=filename)
+    path = os.path.join(app.config['UPLOAD_FOLDER'], f_meta.filepath)
+    try:
+        return send_download(path, filename, os.stat(path), as_attachment=False)
+    except FileNotFoundError:
+        return jsonify({'error': 'Arquivo não encontrado'}), 404
+
+# --- Master Layouts (admin) ---
+# Shows where the room and item headers were found in each sheet, and lets an
+# admin pin the layout of sheets whose headers are not recognized.
+
+def managed_master(filename):
+    """(FileMetadata, path) of a master the current admin manages, or (None, error response)."""
+    if not session.get('is_admin'): return None, (jsonify({'error': 'Acesso negado.'}), 403)
+    f_meta = FileMetadata.query.filter_by(filename=filename, type='master_spreadsheet').first()
+    if not f_meta: return None, (jsonify({'error': 'Arquivo não encontrado'}), 404)
+    if not session.get('is_super_admin') and f_meta.user_id != int(session.get('user_id')):
+        return None, (jsonify({'error': 'Permissão negada'}), 403)
+    path = os.path.join(app.config['UPLOAD_FOLDER'], f_meta.filepath)
+    if not os.path.exists(path): return None, (jsonify({'error': 'Arquivo físico não encontrado'}), 404)
+    return (f_meta, path), None
+
+def schema_response(f_meta, path):
+    # Learn layouts first if this master was never parsed with layout tracking
+    if not MasterSchema.query.filter_by(filepath=f_meta.filepath).first():
+        master_index.rebuild_sheets(f_meta.filepath, path)
+    layouts = sheet_schema.load_layouts(f_meta.filepath)
+    sheets = []
+    for sheet in master_index.sheet_summaries(f_meta.filepath, path):
+        sheet['layout'] = layouts.get(sheet['sheet_name'])
+        sheets.append(sheet)
+    return jsonify({'filename': f_meta.filename, 'sheets': sheets})
+
+@app.route('/masters/<filename>/schema', methods=['GET'])
+def get_master_schema(filename):
+    found, error = managed_master(filename)
+    if error: return error
+    return schema_response(*found)
+
+@app.route('/masters/<filename>/schema', methods=['PUT'])
+def set_master_schema(filename):
+    """Pins one sheet's layout: {sheet_name, header_row, inv_idx, desc_idx, room_header_row, room_columns}, 0-based."""
+    found, error = managed_master(filename)
+    if error: return error
+    f_meta, path = found
+
+    data = request.json or {}
+    sheet_name = data.get('sheet_name')
+    try:
+        header_row, inv_idx, desc_idx, room_header_row = (int(data.get(k, -1)) for k in ('header_row', 'inv_idx', 'desc_idx', 'room_header_row'))
+        room_columns = [int(c) for c in data['room_columns']] if data.get('room_columns') else None
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Linhas e colunas devem ser números'}), 400
+    if min(header_row, inv_idx, desc_idx, room_header_row) < -1 or (room_columns and (len(room_columns) != 3 or min(room_columns) < -1)):
+        return jsonify({'error': 'Layout inválido'}), 400
+    if (header_row == -1) != (inv_idx == -1) or (room_header_row == -1) != (not room_columns):
+        return jsonify({'error': 'Informe linha e colunas de cada cabeçalho'}), 400
+
+    rows = master_index.sheet_rows(path, sheet_name, max(header_row, room_header_row + 1) + 1)
+    if rows is None: return jsonify({'error': 'Aba não encontrada'}), 404
+    sheet_schema.set_manual(f_meta.filepath, sheet_name, rows, room_header_row, room_columns, header_row, inv_idx, desc_idx)
+    master_index.rebuild_sheets(f_meta.filepath, path, [sheet_name]) # Commits
+    return schema_response(f_meta, path)
+
+@app.route('/masters/<filename>/schema', methods=['DELETE'])
+def reset_master_schema(filename):
+    """Forgets stored layouts (of ?sheet_name=X, or all) and detects them again."""
+    found, error = managed_master(filename)
+    if error: return error
+    f_meta, path = found
+
+    sheet_name = request.args.get('sheet_name')
+    sheet_schema.forget(f_meta.filepath, sheet_name)
+    master_index.rebuild_sheets(f_meta.filepath, path, [sheet_name] if sheet_name else None) # Commits
+    return schema_response(f_meta, path)
 
 # --- Verification & Logic ---
 
@@ -383,13 +725,20 @@ def list_reports():
     net_id = session.get('connected_network_id') or request.args.get('network_id')
     user_id = session.get('user_id')
     
+    filter_net_id = request.args.get('network_id')
+    
     if session.get('is_super_admin'):
-        pass # See ALL
+        # See ALL (optionally one network)
+        if filter_net_id:
+            query = query.filter_by(network_id=int(filter_net_id))
     elif session.get('is_admin'):
         # Admin sees reports from ALL networks they manage
         if user_id:
             my_nets = Network.query.filter_by(admin_id=int(user_id)).with_entities(Network.id).all()
             my_net_ids = [n.id for n in my_nets]
+            if filter_net_id:
+                # Narrow to one of their networks (nothing if not theirs)
+                my_net_ids = [n for n in my_net_ids if n == int(filter_net_id)] or [-1]
             if my_net_ids:
                 query = query.filter(FileMetadata.network_id.in_(my_net_ids))
             else:
@@ -397,11 +746,22 @@ def list_reports():
     elif net_id:
         query = query.filter_by(network_id=int(net_id))
     else:
-        return jsonify({'reports': []})
+        return jsonify({'reports': [], 'next_cursor': None})
         
-    files = query.all()
+    try:
+        rows, next_cursor = paginate_files(query, default_sort='date', columns=(FileMetadata.web_view_link,))
+    except ValueError:
+        return jsonify({'error': 'Parâmetros de listagem inválidos'}), 400
     # Return more info for admin visibility
-    return jsonify({'reports': [{'filename': f.filename, 'network_id': f.network_id} for f in files]})
+    return jsonify({
+        'reports': [{
+            'filename': r.filename,
+            'network_id': r.network_id,
+            'upload_date': r.upload_date.isoformat() if r.upload_date else None,
+            'drive_link': r.web_view_link
+        } for r in rows],
+        'next_cursor': next_cursor
+    })
 
 @app.route('/delete_report', methods=['POST'])
 def delete_report():
@@ -421,267 +781,533 @@ def get_report(filename):
     if not session.get('is_admin') and not session.get('connected_network_id'):
         return jsonify({'error': 'Unauthorized'}), 403
     
-    report_path = os.path.join(REPORTS_FOLDER, filename)
-    if os.path.exists(report_path):
-        return send_file(report_path, as_attachment=True, download_name=filename)
-        
-    f_meta = FileMetadata.query.filter_by(filename=filename).first()
-    if f_meta:
-        path = os.path.join(app.config['UPLOAD_FOLDER'], f_meta.filepath)
-        if os.path.exists(path):
-            return send_file(path, as_attachment=True, download_name=filename)
+    # Reports live in REPORTS_FOLDER; the metadata lookup is only for older uploads
+    for path in report_paths(filename):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        return send_download(path, filename, stat)
             
     return jsonify({'error': 'Arquivo não encontrado'}), 404
 
+def report_paths(filename):
+    yield os.path.join(REPORTS_FOLDER, filename)
+    f_meta = FileMetadata.query.filter_by(filename=filename).with_entities(FileMetadata.filepath).first()
+    if f_meta:
+        yield os.path.join(app.config['UPLOAD_FOLDER'], f_meta.filepath)
+
+def send_download(path, download_name, stat, as_attachment=True):
+    """send_file with a strong ETag (content SHA-1), If-None-Match -> 304 and Range -> 206.
+
+    The body goes out through wsgi.file_wrapper (os.sendfile under gunicorn)
+    or X-Sendfile when USE_X_SENDFILE is set.
+    """
+    response = send_file(path, as_attachment=as_attachment, download_name=download_name,
+                         etag=file_digest(path, stat), last_modified=stat.st_mtime, conditional=True, max_age=0)
+    # Downloads need a login: browsers may keep a copy but must revalidate it
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
 @app.route('/get_rooms', methods=['POST'])
 def get_rooms():
     data = request.json
     selected_files = data.get('filenames', [])
-    all_rooms = []
+    files = []
+    errors = []
+
+    # One lookup for all selected files (first row wins, as with .first())
+    filepaths = {}
+    rows = FileMetadata.query.filter(FileMetadata.filename.in_(selected_files), FileMetadata.type == 'master_spreadsheet')\
+        .with_entities(FileMetadata.filename, FileMetadata.filepath).order_by(FileMetadata.id).all()
+    for row in rows:
+        filepaths.setdefault(row.filename, row.filepath)
 
     for filename in selected_files:
-        f_meta = FileMetadata.query.filter_by(filename=filename).first()
-        if not f_meta: continue
+        filepath = filepaths.get(filename)
+        if not filepath:
+            errors.append({'file': filename, 'error': 'Arquivo não encontrado db'})
+            continue
         
-        path = os.path.join(app.config['UPLOAD_FOLDER'], f_meta.filepath)
-        if not os.path.exists(path): continue
+        path = os.path.join(app.config['UPLOAD_FOLDER'], filepath)
+        if not os.path.exists(path):
+            errors.append({'file': filename, 'error': 'Arquivo físico não encontrado'})
+            continue
         
-        try:
-            wb = load_workbook(path, read_only=True, data_only=True)
-            for sheet_name in wb.sheetnames:
-                ws = wb[sheet_name]
-                rows = list(ws.iter_rows(values_only=True))
-                
-                sheet_rooms = []
-                
-                # Scan for Header Row
-                for r_idx, row in enumerate(rows):
-                    # Check if this row looks like the specific header row
-                    # We look for "Localização" and "Denominação"
-                    row_str = [str(c).strip().lower() for c in row if c]
-                    
-                    if any("localização" in s for s in row_str):
-                        # Found a potential header row.
-                        # Now try to identify column indices
-                        loc_idx = -1
-                        denom_idx = -1
-                        inv_idx = -1
-                        
-                        for c_idx, cell in enumerate(row):
-                            val = str(cell).strip()
-                            val_lower = val.lower()
-                            
-                            if "localização" in val_lower:
-                                loc_idx = c_idx
-                            elif "denominação" in val_lower and "imobilizado" not in val_lower:
-                                # Avoid "Denominação do imobilizado" which is the items list
-                                denom_idx = c_idx
-                            elif "nº invent" in val_lower or "n° invent" in val_lower:
-                                # Grab Inventory Number if available
-                                inv_idx = c_idx
-                        
-                        # If we found at least Localização, check the NEXT row for data
-                        if loc_idx != -1 and r_idx + 1 < len(rows):
-                            data_row = rows[r_idx + 1]
-                            
-                            loc_val = str(data_row[loc_idx]).strip() if loc_idx < len(data_row) and data_row[loc_idx] else ""
-                            denom_val = str(data_row[denom_idx]).strip() if denom_idx != -1 and denom_idx < len(data_row) and data_row[denom_idx] else ""
-                            inv_val = str(data_row[inv_idx]).strip() if inv_idx != -1 and inv_idx < len(data_row) and data_row[inv_idx] else ""
-                            
-                            # Construct Display Name
-                            # Filter empty parts
-                            parts = [p for p in [loc_val, denom_val, inv_val] if p and p != "None"]
-                            if parts:
-                                full_name = " - ".join(parts)
-                                # Room ID: Use Sheet Name + Localização (or just Sheet Name if unique per sheet)
-                                # To be safe and robust:
-                                room_id = f"{sheet_name}::{full_name}"
-                                sheet_rooms.append({'id': room_id, 'name': full_name, 'source': filename, 'type': 'sliced'})
-                                
-                                # Assume only one main header per sheet for this specific format? 
-                                # Or continue scanning?
-                                # If we found a valid room line, unlikely to change format in same sheet.
-                                # But let's continue scanning just in case multiple rooms are listed (unlikely based on images).
-                                break 
-
-                if sheet_rooms:
-                    all_rooms.extend(sheet_rooms)
-                else:
-                    # Fallback: If no headers found, do NOT add generic sheet names "Table X"
-                    # User requested to remove "Table 1, Table 2..." garbage.
-                    # Only add if it looks like a meaningful sheet? 
-                    # For now, suppressing fallback as per user request to clean up list.
-                    pass
-                    
-            wb.close()
-        except: pass
-
-    return jsonify({'rooms': all_rooms})
+        files.append((filename, filepath, path))
+
+    # Optional client token: progress is streamed on /progress/<token>/events
+    token = data.get('progress_token')
+    def on_file(done, total, source):
+        if token: events.publish(f'request:{token}', {'stage': f'Lendo planilhas ({done}/{total})...', 'progress': 100 * done // total, 'file': source})
+
+    # Index first (built at upload); unindexed files are parsed in parallel
+    all_rooms, parse_errors = master_index.list_rooms(files, on_file)
+    for err in parse_errors:
+        print(f"Error reading {err['file']}: {err['error']}")
+    if token: events.publish(f'request:{token}', {'status': 'done', 'stage': 'Concluído', 'progress': 100}, final=True)
+
+    return jsonify({'rooms': all_rooms, 'errors': errors + parse_errors})
+
+@app.route('/upload_scan', methods=['POST'])
+def upload_scan():
+    """Streams a collector export (multipart 'file' or a raw text/csv body) to scanned_data.
+
+    Returns a scan_id to pass to /verify or /verify_batch instead of scanned_codes,
+    plus the code counts and the most repeated codes. Only the uploader's user
+    or network can audit with that scan_id.
+    """
+    if not session.get('is_admin') and not session.get('connected_network_id'):
+        return jsonify({'error': 'Unauthorized'}), 403
+    too_large = jsonify({'error': f'Arquivo maior que {scans.MAX_SCAN_BYTES // (1024 * 1024)} MB'}), 413
+    if request.content_length and request.content_length > scans.MAX_SCAN_BYTES: return too_large
+
+    if 'file' in request.files:
+        upload = request.files['file']
+        is_csv = upload.filename.lower().endswith('.csv') or upload.mimetype == 'text/csv'
+        stream = upload.stream
+    elif request.mimetype in ('text/plain', 'text/csv'):
+        is_csv = request.mimetype == 'text/csv'
+        stream = request.stream
+    else:
+        return jsonify({'error': 'Envie o arquivo do coletor (.txt ou .csv)'}), 400
+
+    try:
+        scan_id, summary = scans.save_scan(stream, SCANNED_DATA_FOLDER, is_csv, scans.MAX_SCAN_BYTES)
+    except scans.ScanTooLarge:
+        return too_large # Chunked bodies have no Content-Length to check up front
+    if not summary['unique']: return jsonify({'error': 'Nenhum código encontrado no arquivo'}), 400
+
+    user_id = session.get('user_id')
+    net_id = session.get('connected_network_id')
+    db.session.add(ScanUpload(id=scan_id, user_id=int(user_id) if user_id else None, network_id=int(net_id) if net_id else None))
+    db.session.commit()
+    return jsonify(summary)
+
+def owned_scan_path(scan_id):
+    """(path, None) of a scan uploaded by the current user or network, else (None, error response)."""
+    path = scans.scan_path(SCANNED_DATA_FOLDER, scan_id)
+    record = ScanUpload.query.get(scan_id) if path else None
+    if not record: return None, (jsonify({'error': 'Arquivo de leitura não encontrado'}), 404)
+    if not owns_record(record): return None, (jsonify({'error': 'Unauthorized'}), 403)
+    return path, None
 
 @app.route('/verify', methods=['POST'])
 def verify():
+    """Validates the request and queues the audit; poll /jobs/<id> for the result."""
     data = request.json
     analyst_name = data.get('analyst_name', 'Analista')
     selected_room = data.get('room_name')
     source_file = data.get('source_file')
     scanned_codes_raw = data.get('scanned_codes', '')
+    scan_id = data.get('scan_id') # From /upload_scan, for large collector files
     
     if not source_file: return jsonify({'error': 'Arquivo fonte não identificado'}), 400
-
-    # Clean Scanned Codes
-    scanned_codes = set()
-    for line in scanned_codes_raw.splitlines():
-        c = line.strip()
-        if c: scanned_codes.add(c)
+    if not selected_room: return jsonify({'error': 'Nenhuma sala selecionada'}), 400
+    if scan_id:
+        _, error = owned_scan_path(scan_id)
+        if error: return error
     
-    f_meta = FileMetadata.query.filter_by(filename=source_file).first()
+    f_meta = FileMetadata.query.filter_by(filename=source_file, type='master_spreadsheet')\
+        .with_entities(FileMetadata.filepath).first()
     if not f_meta: return jsonify({'error': 'Arquivo não encontrado db'}), 404
     
     path = os.path.join(app.config['UPLOAD_FOLDER'], f_meta.filepath)
     if not os.path.exists(path): return jsonify({'error': 'Arquivo físico não encontrado'}), 404
 
+    net_id = session.get('connected_network_id')
+    user_id = session.get('user_id')
+    
+    job = jobs.enqueue('verify', {
+        'analyst_name': analyst_name,
+        'room_name': selected_room,
+        'filepath': f_meta.filepath,
+        'scanned_codes': '' if scan_id else scanned_codes_raw,
+        'scan_id': scan_id,
+        'user_id': int(user_id) if user_id else None,
+        'network_id': int(net_id) if net_id else None
+    }, user_id=int(user_id) if user_id else None, network_id=int(net_id) if net_id else None)
+
+    return jsonify({
+        'success': True,
+        'job_id': job.id,
+        'status_url': f'/jobs/{job.id}'
+    }), 202
+
+def run_verify_job(payload, progress):
+    """Audit of one room, run by the job workers (see jobs.py)."""
+    analyst_name = payload['analyst_name']
+    selected_room = payload['room_name']
+    
+    path = os.path.join(app.config['UPLOAD_FOLDER'], payload['filepath'])
+    if not os.path.exists(path): raise jobs.JobError('Arquivo físico não encontrado')
+
+    # Clean Scanned Codes
+    if payload.get('scan_id'):
+        scan_path = scans.scan_path(SCANNED_DATA_FOLDER, payload['scan_id'])
+        if not scan_path: raise jobs.JobError('Arquivo de leitura não encontrado')
+        scanned_codes = scans.read_scan(scan_path)
+    else:
+        scanned_codes = parse_scanned_codes(payload['scanned_codes'])
     timestamp = time.strftime("%Y%m%d_%H%M%S")
     
-    try:
-        # 1. Parse Expected Items from Sheet
-        wb = load_workbook(path, read_only=True, data_only=True)
-        # Parse Room ID to get Sheet Name and Row Offset if sliced
-        # Format: "SheetName::Localização - Denom..."
-        is_sliced = "::" in selected_room
-        target_sheet_name = selected_room.split("::")[0] if is_sliced else selected_room
-        
-        if target_sheet_name not in wb.sheetnames: return jsonify({'error': 'Aba não encontrada'}), 400
-        ws = wb[target_sheet_name]
-        
-        rows = list(ws.iter_rows(values_only=True))
-        
-        # Identify Columns (Dynamic like get_rooms)
-        inv_idx = -1
-        desc_idx = -1
-        expected_items = {} # Map Code -> Row Data (or Description)
-        
-        # Scan header to find columns
-        header_row_idx = -1
-        for r_idx, row in enumerate(rows):
-            row_str = [str(c).strip().lower() for c in row if c]
-            if any("nº invent" in s or "n° invent" in s for s in row_str):
-                 header_row_idx = r_idx
-                 # Map cols
-                 for c_idx, cell in enumerate(row):
-                     val = str(cell).strip().lower()
-                     if "nº invent" in val or "n° invent" in val: inv_idx = c_idx
-                     elif "denominação" in val: desc_idx = c_idx
-                 break
-        
-        # Extract Expected
-        if header_row_idx != -1 and inv_idx != -1:
-            for r_idx in range(header_row_idx + 1, len(rows)):
-                row = rows[r_idx]
-                if inv_idx < len(row) and row[inv_idx]:
-                    code = str(row[inv_idx]).strip()
-                    # Filter: If "sliced", verify if this row matches the specific room?
-                    # The user selected a "Sliced" room (specific header value).
-                    # But the current get_rooms implementation just gives us lines.
-                    # Complex Logic: If the sheet has MULTIPLE rooms, we need to filter only items for THAT room.
-                    # Current `get_rooms` finds the header "Localização". 
-                    # If this is a master sheet with one room per sheet, we take all.
-                    # If it's a huge sheet with many rooms... we need to filter by "Localização" column if it exists.
-                    # Let's assume for now we take all items in that sheet OR try to match the room name.
-                    # Given the "Sliced" logic in `get_rooms` uses the header VALUE to name the room...
-                    # We should check if the row matches that value.
-                    
-                    # Refined Logic:
-                    # If is_sliced, selected_room contains "Sheet::Loc - Denom - Inv".
-                    # We can't easily filter back without knowing which column is Localização.
-                    # Let's try to grab Description for context.
-                    desc = str(row[desc_idx]).strip() if desc_idx != -1 and desc_idx < len(row) else "Item"
-                    expected_items[code] = {'desc': desc, 'row_data': row}
-        
-        wb.close()
-        
-        # 2. Compare
-        verified_codes = []
-        missing_codes = []
-        extra_codes = []
-        
-        # Verified & Missing
-        for code, info in expected_items.items():
-            if code in scanned_codes:
-                verified_codes.append({'code': code, 'desc': info['desc'], 'status': 'Encontrado'})
-            else:
-                missing_codes.append({'code': code, 'desc': info['desc'], 'status': 'Faltante'})
-        
-        # Extra
-        for code in scanned_codes:
-            if code not in expected_items:
-                extra_codes.append({'code': code, 'desc': 'Não consta na planilha', 'status': 'Sobras'})
-                
-        # 3. Generate 3 Excel Files
-        from openpyxl import Workbook
-        
-        def save_excel(data, filename, title):
-            wb_new = Workbook()
-            ws_new = wb_new.active
-            ws_new.title = title
-            ws_new.append(["Código", "Descrição", "Status"])
-            for item in data:
-                ws_new.append([item['code'], item['desc'], item['status']])
-            path = os.path.join(app.config['UPLOAD_FOLDER'], filename) # Temp save
-            wb_new.save(path)
-            return path
-
-        files_to_zip = []
-        
-        # File 1: Analisados (Verified)
-        f1 = f"Conferidos_{analyst_name}_{timestamp}.xlsx"
-        p1 = save_excel(verified_codes, f1, "Conferidos")
-        files_to_zip.append((p1, f1))
-        
-        # File 2: Deveriam ter sido encontrados (Missing)
-        f2 = f"Faltantes_{analyst_name}_{timestamp}.xlsx"
-        p2 = save_excel(missing_codes, f2, "Faltantes")
-        files_to_zip.append((p2, f2))
-        
-        # File 3: Não encontrados/Sobras (Extra)
-        f3 = f"Sobras_{analyst_name}_{timestamp}.xlsx"
-        p3 = save_excel(extra_codes, f3, "Sobras")
-        files_to_zip.append((p3, f3))
-        
-        # 4. ZIP Them
-        zip_filename = f"Auditoria_{analyst_name}_{timestamp}.zip"
-        zip_path = os.path.join(REPORTS_FOLDER, zip_filename)
-        
-        with zipfile.ZipFile(zip_path, 'w') as zipf:
-            for file_path, arcname in files_to_zip:
-                zipf.write(file_path, arcname)
-                
-        # Cleanup temp xl files
-        for file_path, _ in files_to_zip:
-            if os.path.exists(file_path): os.remove(file_path)
+    # 1. Expected Items from the master index
+    # Parse Room ID to get Sheet Name and Row Offset if sliced
+    # Format: "SheetName::Localização - Denom..."
+    progress('Lendo planilha...', 10)
+    is_sliced = "::" in selected_room
+    target_sheet_name = selected_room.split("::")[0] if is_sliced else selected_room
+    
+    def on_sheet(done, total):
+        # Only called when the master is not indexed and has to be parsed
+        progress(f'Lendo abas ({done}/{total})...', 10 + 25 * done // total, sheet=done, sheets=total)
+    
+    expected_items = master_index.expected_items(payload['filepath'], path, target_sheet_name, on_sheet)
+    if expected_items is None: raise jobs.JobError('Aba não encontrada')
+    
+    # 2. Compare (bulk set operations, column-oriented results)
+    progress('Comparando códigos...', 40)
+    result = compare_codes(expected_items, scanned_codes)
             
-        # 5. Metadata
-        net_id = session.get('connected_network_id')
-        user_id = session.get('user_id')
+    # 3. Generate 3 Excel Files, streamed straight into the ZIP
+    progress('Gerando relatórios...', 60)
+    zip_filename = f"Auditoria_{analyst_name}_{timestamp}.zip"
+    zip_path = os.path.join(REPORTS_FOLDER, zip_filename)
+    def on_file(index, total, arcname):
+        progress(f'Gerando {arcname} ({index + 1}/{total})...', 60 + 25 * index // total, file=arcname)
+    write_audit_zip(zip_path, analyst_name, timestamp, result, on_file)
+    progress('Compactando relatório...', 85)
         
-        new_rep = FileMetadata(
-            filename=zip_filename,
-            filepath=zip_filename,
-            type='audit_report',
-            user_id=int(user_id) if user_id else None,
-            network_id=int(net_id) if net_id else None
-        )
-        db.session.add(new_rep)
-        db.session.commit()
+    # 4. Metadata
+    progress('Registrando relatório...', 90)
+    new_rep = FileMetadata(
+        filename=zip_filename,
+        filepath=zip_filename,
+        type='audit_report',
+        user_id=payload['user_id'],
+        network_id=payload['network_id']
+    )
+    db.session.add(new_rep)
+    db.session.commit()
 
-        return jsonify({
-            'success': True,
-            'download_url': f'/get_report/{zip_filename}'
+    # Drive sync goes through the outbox; the audit never waits on Google
+    drive_outbox.enqueue(zip_filename, analyst_name, selected_room.split("::")[-1], file_id=new_rep.id)
+
+    return {
+        'success': True,
+        'download_url': f'/get_report/{zip_filename}'
+    }
+
+jobs.register_handler('verify', run_verify_job)
+
+@app.route('/verify_batch', methods=['POST'])
+def verify_batch():
+    """Queues one audit covering many rooms; poll /jobs/<id> for the result.
+
+    Body: analyst_name plus either
+      - source_file and rooms: {room: "codes" or [codes]}
+      - rooms: [{source_file, room_name, scanned_codes}] (several masters)
+      - source_file and scanned_codes (or a scan_id from /upload_scan) with "# <sala>" marker lines
+    Rooms are /get_rooms ids, sheet names or room names.
+    """
+    data = request.json or {}
+    analyst_name = data.get('analyst_name', 'Analista')
+    default_source = data.get('source_file')
+    rooms = data.get('rooms')
+
+    entries = [] # (source_file, room, raw codes)
+    try:
+        if isinstance(rooms, dict):
+            entries = [(default_source, room, codes) for room, codes in rooms.items()]
+        elif isinstance(rooms, list):
+            entries = [(r.get('source_file') or default_source, r.get('room_name'), r.get('scanned_codes', '')) for r in rooms]
+        elif data.get('scan_id'):
+            scan_path, error = owned_scan_path(data['scan_id'])
+            if error: return error
+            entries = [(default_source, room, sorted(codes)) for room, codes in parse_room_markers(scans.scan_lines(scan_path)).items()]
+        elif data.get('scanned_codes'):
+            entries = [(default_source, room, sorted(codes)) for room, codes in parse_room_markers(data['scanned_codes'].splitlines()).items()]
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except AttributeError:
+        return jsonify({'error': 'Formato inválido de salas'}), 400
+
+    if not entries: return jsonify({'error': 'Nenhuma sala informada'}), 400
+    if any(not source for source, _, _ in entries): return jsonify({'error': 'Arquivo fonte não identificado'}), 400
+    if any(not room for _, room, _ in entries): return jsonify({'error': 'Nenhuma sala selecionada'}), 400
+
+    # One query for every master involved
+    sources = {source for source, _, _ in entries}
+    filepaths = {}
+    for filename, filepath in FileMetadata.query.filter(FileMetadata.filename.in_(sources), FileMetadata.type == 'master_spreadsheet')\
+            .order_by(FileMetadata.id).with_entities(FileMetadata.filename, FileMetadata.filepath):
+        filepaths.setdefault(filename, filepath)
+    for source in sources:
+        if source not in filepaths: return jsonify({'error': f'Arquivo não encontrado db: {source}'}), 404
+        if not os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], filepaths[source])):
+            return jsonify({'error': f'Arquivo físico não encontrado: {source}'}), 404
+
+    payload_rooms = []
+    for source, room, codes in entries:
+        if isinstance(codes, str): codes = parse_scanned_codes(codes)
+        payload_rooms.append({
+            'source_file': source,
+            'filepath': filepaths[source],
+            'room_name': room,
+            'scanned_codes': sorted({str(c).strip() for c in codes} - {''})
         })
-        
-    except Exception as e:
-        import traceback
-        traceback.print_exc()
-        return jsonify({'error': str(e)}), 500
+
+    net_id = session.get('connected_network_id')
+    user_id = session.get('user_id')
+
+    job = jobs.enqueue('verify_batch', {
+        'analyst_name': analyst_name,
+        'rooms': payload_rooms,
+        'user_id': int(user_id) if user_id else None,
+        'network_id': int(net_id) if net_id else None
+    }, user_id=int(user_id) if user_id else None, network_id=int(net_id) if net_id else None)
+
+    return jsonify({
+        'success': True,
+        'job_id': job.id,
+        'status_url': f'/jobs/{job.id}'
+    }), 202
+
+def run_verify_batch_job(payload, progress):
+    """Audit of many rooms: each master is loaded once, all its rooms compared in one pass."""
+    analyst_name = payload['analyst_name']
+    timestamp = time.strftime("%Y%m%d_%H%M%S")
+    rooms = payload['rooms']
+
+    audits = []
+    masters = {} # filepath -> sheets, loaded on first use
+    for i, room in enumerate(rooms):
+        progress(f'Conferindo sala {i + 1} de {len(rooms)}...', 5 + 75 * i // len(rooms))
+        filepath = room['filepath']
+        if filepath not in masters:
+            path = os.path.join(app.config['UPLOAD_FOLDER'], filepath)
+            if not os.path.exists(path): raise jobs.JobError(f"Arquivo físico não encontrado: {room['source_file']}")
+            masters[filepath] = master_index.expected_items_by_sheet(filepath, path)
+        sheets = masters[filepath]
+
+        sheet_name = master_index.resolve_sheet(room['room_name'], sheets)
+        if sheet_name is None:
+            audits.append({'source': room['source_file'], 'room': room['room_name'], 'result': None, 'error': 'Aba não encontrada'})
+            continue
+        audits.append({
+            'source': room['source_file'],
+            'room': sheets[sheet_name]['room_name'] or sheet_name,
+            'result': compare_codes(sheets[sheet_name]['items'], set(room['scanned_codes'])),
+            'error': None
+        })
+
+    if all(a['result'] is None for a in audits): raise jobs.JobError('Nenhuma sala encontrada nas planilhas')
+
+    progress('Gerando relatório consolidado...', 80)
+    zip_filename = f"Auditoria_Lote_{analyst_name}_{timestamp}.zip"
+    zip_path = os.path.join(REPORTS_FOLDER, zip_filename)
+    write_batch_zip(zip_path, analyst_name, timestamp, audits)
+    progress('Compactando relatório...', 85)
+
+    progress('Registrando relatório...', 90)
+    new_rep = FileMetadata(
+        filename=zip_filename,
+        filepath=zip_filename,
+        type='audit_report',
+        user_id=payload['user_id'],
+        network_id=payload['network_id']
+    )
+    db.session.add(new_rep)
+    db.session.commit()
+
+    drive_outbox.enqueue(zip_filename, analyst_name, f'Lote de {len(audits)} salas', file_id=new_rep.id)
+
+    return {
+        'success': True,
+        'download_url': f'/get_report/{zip_filename}',
+        'rooms': [{'source_file': a['source'], 'room': a['room'], 'error': a['error']} for a in audits]
+    }
+
+jobs.register_handler('verify_batch', run_verify_batch_job)
+
+# Audit workers (queue persisted in the AuditJob table)
+jobs.start_workers(app)
+
+# Drive sync (queue persisted in the DriveOutbox table)
+drive_outbox.start_worker(app, REPORTS_FOLDER)
+
+# --- Live Audit Sessions (scan by scan, finalized into the normal report) ---
+
+def owns_record(record):
+    """Same rule as /jobs: super admin, the user or network that created it; ownerless ones by id."""
+    if session.get('is_super_admin') or not (record.user_id or record.network_id): return True
+    user_id = session.get('user_id')
+    net_id = session.get('connected_network_id')
+    return bool((record.user_id and user_id and record.user_id == int(user_id)) or
+                (record.network_id and net_id and record.network_id == int(net_id)))
+
+def get_audit_session(session_id):
+    audit = AuditSession.query.get(session_id)
+    if not audit: return None, (jsonify({'error': 'Sessão não encontrada'}), 404)
+    if not owns_record(audit): return None, (jsonify({'error': 'Unauthorized'}), 403)
+    return audit, None
+
+@app.route('/audit_sessions', methods=['POST'])
+def open_audit_session():
+    """Opens a room for live scanning. Body: analyst_name, source_file, room_name, selected_files (optional)."""
+    data = request.json or {}
+    analyst_name = data.get('analyst_name', 'Analista')
+    source_file = data.get('source_file')
+    room_name = data.get('room_name')
+
+    if not source_file: return jsonify({'error': 'Arquivo fonte não identificado'}), 400
+    if not room_name: return jsonify({'error': 'Nenhuma sala selecionada'}), 400
+
+    # Other selected masters are searched for codes scanned in the wrong room
+    names = {source_file} | set(data.get('selected_files') or [])
+    filepaths = {}
+    for filename, filepath in FileMetadata.query.filter(FileMetadata.filename.in_(names), FileMetadata.type == 'master_spreadsheet')\
+            .order_by(FileMetadata.id).with_entities(FileMetadata.filename, FileMetadata.filepath):
+        filepaths.setdefault(filename, filepath)
+    if source_file not in filepaths: return jsonify({'error': 'Arquivo não encontrado db'}), 404
+
+    search_files = [(name, filepaths[name]) for name in data.get('selected_files') or [] if name in filepaths and
+                    os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], filepaths[name]))]
+
+    net_id = session.get('connected_network_id')
+    user_id = session.get('user_id')
+    try:
+        audit = audit_sessions.open_session(
+            app.config['UPLOAD_FOLDER'], uuid.uuid4().hex, analyst_name, source_file, filepaths[source_file], room_name, search_files,
+            user_id=int(user_id) if user_id else None, network_id=int(net_id) if net_id else None
+        )
+    except audit_sessions.SessionError as e:
+        return jsonify({'error': str(e)}), 404
+
+    return jsonify(audit_sessions.session_summary(audit)), 201
+
+@app.route('/audit_sessions/<session_id>', methods=['GET'])
+def audit_session_status(session_id):
+    audit, error = get_audit_session(session_id)
+    if error: return error
+    return jsonify(audit_sessions.session_summary(audit))
+
+@app.route('/audit_sessions/<session_id>/scan', methods=['POST'])
+def audit_session_scan(session_id):
+    """Body: {code} or {codes: [...]}. Returns each code's status and the running counts."""
+    audit, error = get_audit_session(session_id)
+    if error: return error
+
+    data = request.json or {}
+    raw = data.get('codes') if data.get('codes') is not None else [data.get('code')]
+    codes = [str(c).strip() for c in raw if c is not None and str(c).strip()]
+    if not codes: return jsonify({'error': 'Nenhum código informado'}), 400
+
+    try:
+        results = audit_sessions.record_scans(app.config['UPLOAD_FOLDER'], audit, codes)
+    except audit_sessions.SessionError as e:
+        return jsonify({'error': str(e)}), 409
+
+    summary = audit_sessions.session_summary(audit)
+    summary['results'] = results
+    return jsonify(summary)
+
+@app.route('/audit_sessions/<session_id>/finalize', methods=['POST'])
+def finalize_audit_session(session_id):
+    """Queues the normal verify job with everything scanned; poll /jobs/<id> for the ZIP."""
+    audit, error = get_audit_session(session_id)
+    if error: return error
+    if audit.status != 'open': return jsonify({'error': 'Sessão já finalizada', 'job_id': audit.job_id}), 409
+
+    job = jobs.enqueue('verify', {
+        'analyst_name': audit.analyst_name,
+        'room_name': audit.sheet_name,
+        'filepath': audit.filepath,
+        'scanned_codes': '\n'.join(audit_sessions.scanned_codes(audit)),
+        'user_id': audit.user_id,
+        'network_id': audit.network_id
+    }, user_id=audit.user_id, network_id=audit.network_id)
+
+    audit.status = 'finalized'
+    audit.job_id = job.id
+    audit.updated_at = datetime.utcnow()
+    db.session.commit()
+    audit_sessions.forget(audit.id)
+
+    return jsonify({
+        'success': True,
+        'job_id': job.id,
+        'status_url': f'/jobs/{job.id}'
+    }), 202
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = AuditJob.query.get(job_id)
+    if not job: return jsonify({'error': 'Tarefa não encontrada'}), 404
+    
+    # Only whoever queued it (same admin or same network) can follow a job;
+    # anonymous audits are reachable only through their random id
+    if not owns_record(job): return jsonify({'error': 'Unauthorized'}), 403
+    
+    return jsonify(jobs.job_status(job))
+
+# --- Progress Streams (Server-Sent Events) ---
+
+SSE_HEARTBEAT_SECONDS = 15
+SSE_MAX_SECONDS = 10 * 60 # Each open stream holds a server thread; the browser reconnects after this
+SSE_REQUEST_IDLE_SECONDS = 60 # A request token with no events for this long is given up
+
+def sse_response(key, on_idle=None, max_idle=None):
+    """text/event-stream of the in-memory events of `key`, resuming after Last-Event-ID."""
+    try:
+        last_id = int(request.headers.get('Last-Event-ID', 0))
+    except ValueError:
+        last_id = 0
+
+    def generate():
+        yield 'retry: 2000\n\n'
+        for event in events.stream(key, last_id, SSE_HEARTBEAT_SECONDS, on_idle, max_idle, SSE_MAX_SECONDS):
+            if event is None:
+                yield ': keep-alive\n\n' # Keeps proxies from closing an idle stream
+                continue
+            event_id, data = event
+            yield f'id: {event_id}\ndata: {json.dumps(data)}\n\n'
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    """Stage-level progress of a job, pushed as it happens."""
+    job = AuditJob.query.get(job_id)
+    if not job: return jsonify({'error': 'Tarefa não encontrada'}), 404
+    if not owns_record(job): return jsonify({'error': 'Unauthorized'}), 403
+
+    # Finished in another process (or before a restart): replay just the outcome
+    buf = events.buffer(job_id, create=False)
+    if job.status in ('done', 'error') and not (buf and buf.finished):
+        events.publish(job_id, jobs.job_status(job), final=True)
+    db.session.remove() # Don't hold a connection for the life of the stream
+
+    def on_idle():
+        # Running here: its events reach the buffer, no need to look further.
+        # Otherwise another worker process may have claimed it and its events
+        # never arrive, so the row is read once per heartbeat
+        if jobs.runs_here(job_id): return None
+        with app.app_context():
+            row = AuditJob.query.get(job_id)
+            if row and row.status in ('done', 'error'): return jobs.job_status(row)
+            return None
+
+    return sse_response(job_id, on_idle)
+
+@app.route('/progress/<token>/events', methods=['GET'])
+def request_events(token):
+    """Progress of a synchronous request that was sent a progress_token (e.g. /get_rooms)."""
+    if not (session.get('is_admin') or session.get('connected_network_id')): return jsonify({'error': 'Unauthorized'}), 403
+    if not re.match(r'^[A-Za-z0-9_-]{8,64}$', token): return jsonify({'error': 'Token inválido'}), 400
+    return sse_response(f'request:{token}', max_idle=SSE_REQUEST_IDLE_SECONDS)
 
 # --- Admin Users ---
 @app.route('/admin/users', methods=['GET'])
@@ -697,6 +1323,7 @@ def delete_user_account(user_id):
     if u:
         db.session.delete(u)
         db.session.commit()
+        invalidate_lists() # Network owner emails
     return jsonify({'success': True})
 
 if __name__ == '__main__':
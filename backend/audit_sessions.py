@@ -0,0 +1,161 @@
+import os
+import json
+import threading
+from datetime import datetime
+from collections import OrderedDict
+from sqlalchemy.exc import IntegrityError
+
+from .models import db, AuditSession, AuditScan
+from . import master_index
+
+# --- Live Audit Sessions ---
+# Scans are stored per session in the DB (any gunicorn worker can take the next
+# call); each worker keeps the room's expected codes and a code -> room map for
+# the other sheets in memory, so classifying a scan is a dict lookup.
+
+LIVE_ROOMS_MAX = 32 # Rooms kept in memory per worker
+MAX_CODES_PER_CALL = 500
+
+STATUS_VERIFIED = 'verified'
+STATUS_EXTRA = 'extra'
+STATUS_WRONG_ROOM = 'wrong_room'
+
+class SessionError(Exception):
+    """Rejected session call, with a message meant for the user."""
+
+class LiveRoom:
+    def __init__(self, expected, locations):
+        self.expected = expected # code -> desc of the audited sheet
+        self.locations = locations # code -> {'source', 'room'} of any other sheet
+
+    def classify(self, code):
+        """(status, desc, location) of one scanned code."""
+        if code in self.expected:
+            return STATUS_VERIFIED, self.expected[code], None
+        location = self.locations.get(code)
+        if location:
+            return STATUS_WRONG_ROOM, None, location
+        return STATUS_EXTRA, None, None
+
+_rooms = OrderedDict() # session id -> LiveRoom
+_rooms_lock = threading.Lock()
+
+def load_sheets(upload_folder, filepath):
+    path = os.path.join(upload_folder, filepath)
+    if not os.path.exists(path): raise SessionError('Arquivo físico não encontrado')
+    return master_index.expected_items_by_sheet(filepath, path)
+
+def build_room(upload_folder, audit, source_sheets=None):
+    """Expected codes of the audited sheet plus where every other code lives (first match wins)."""
+    locations = {}
+    for source, filepath in json.loads(audit.search_files):
+        sheets = source_sheets if source_sheets is not None and filepath == audit.filepath else load_sheets(upload_folder, filepath)
+        for sheet_name, sheet in sheets.items():
+            if filepath == audit.filepath and sheet_name == audit.sheet_name: continue
+            location = {'source': source, 'room': sheet['room_name'] or sheet_name}
+            for code in sheet['items']:
+                locations.setdefault(code, location)
+
+    sheets = source_sheets if source_sheets is not None else load_sheets(upload_folder, audit.filepath)
+    return LiveRoom(sheets[audit.sheet_name]['items'], locations)
+
+def live_room(upload_folder, audit, source_sheets=None):
+    with _rooms_lock:
+        room = _rooms.get(audit.id)
+        if room:
+            _rooms.move_to_end(audit.id)
+            return room
+
+    room = build_room(upload_folder, audit, source_sheets) # Outside the lock: may hit the workbook
+    with _rooms_lock:
+        _rooms[audit.id] = room
+        while len(_rooms) > LIVE_ROOMS_MAX:
+            _rooms.popitem(last=False)
+    return room
+
+def forget(session_id):
+    with _rooms_lock:
+        _rooms.pop(session_id, None)
+
+def open_session(upload_folder, session_id, analyst_name, source_file, filepath, room_name, search_files, user_id=None, network_id=None):
+    """Creates a session for one room; search_files is [(filename, filepath)] for wrong-room lookups."""
+    sheets = load_sheets(upload_folder, filepath)
+    sheet_name = master_index.resolve_sheet(room_name, sheets)
+    if sheet_name is None: raise SessionError('Aba não encontrada')
+
+    # The audited master is always searched first
+    files = [(source_file, filepath)] + [f for f in search_files if f[1] != filepath]
+    audit = AuditSession(
+        id=session_id,
+        analyst_name=analyst_name,
+        source_file=source_file,
+        filepath=filepath,
+        room_name=room_name,
+        sheet_name=sheet_name,
+        search_files=json.dumps(files),
+        expected_count=len(sheets[sheet_name]['items']),
+        user_id=user_id,
+        network_id=network_id
+    )
+    db.session.add(audit)
+    db.session.commit()
+    live_room(upload_folder, audit, sheets)
+    return audit
+
+def session_summary(audit):
+    return {
+        'session_id': audit.id,
+        'status': audit.status,
+        'room': audit.room_name,
+        'expected': audit.expected_count,
+        'found': audit.found_count,
+        'missing': audit.expected_count - audit.found_count,
+        'extra': audit.extra_count,
+        'job_id': audit.job_id
+    }
+
+def record_scans(upload_folder, audit, codes):
+    """Classifies and stores a small batch of codes. Returns one result per input code."""
+    if audit.status != 'open': raise SessionError('Sessão já finalizada')
+    if len(codes) > MAX_CODES_PER_CALL: raise SessionError(f'Máximo de {MAX_CODES_PER_CALL} códigos por envio')
+    room = live_room(upload_folder, audit)
+
+    for attempt in range(2):
+        # Codes already stored (by any worker) are reported as duplicates
+        seen = {code: (status, location) for code, status, location in AuditScan.query
+                .filter(AuditScan.session_id == audit.id, AuditScan.code.in_(codes))
+                .with_entities(AuditScan.code, AuditScan.status, AuditScan.location)}
+
+        results = []
+        new_rows = []
+        found = extra = 0
+        for code in codes:
+            status, desc, location = room.classify(code)
+            duplicate = code in seen
+            if not duplicate:
+                seen[code] = (status, location)
+                new_rows.append({'session_id': audit.id, 'code': code, 'status': status,
+                                 'location': f"{location['room']} ({location['source']})" if location else None})
+                if status == STATUS_VERIFIED: found += 1
+                else: extra += 1
+            results.append({'code': code, 'status': status, 'desc': desc, 'location': location, 'duplicate': duplicate})
+
+        try:
+            db.session.bulk_insert_mappings(AuditScan, new_rows)
+            # Relative UPDATE so concurrent workers never lose a count
+            AuditSession.query.filter_by(id=audit.id).update({
+                'found_count': AuditSession.found_count + found,
+                'extra_count': AuditSession.extra_count + extra,
+                'updated_at': datetime.utcnow()
+            }, synchronize_session=False)
+            db.session.commit()
+            break
+        except IntegrityError:
+            db.session.rollback() # Same code stored by a concurrent call: recheck once
+            if attempt: raise SessionError('Leitura simultânea do mesmo código, tente novamente')
+
+    db.session.refresh(audit)
+    return results
+
+def scanned_codes(audit):
+    return [code for code, in AuditScan.query.filter_by(session_id=audit.id).with_entities(AuditScan.code)]
@@ -0,0 +1,116 @@
+import os
+import uuid
+import shutil
+import hashlib
+from datetime import datetime, timedelta
+
+from .models import db, UploadSession
+
+# --- Chunked, Resumable Uploads ---
+# Chunks are written to <upload folder>/.chunks/<upload id>/<index>.part, so any
+# gunicorn worker can take any chunk and a dropped connection only loses the
+# chunk in flight. The file is assembled (and indexed by the caller) on complete.
+
+MAX_CHUNK_SIZE = 8 * 1024 * 1024
+MIN_CHUNK_SIZE = 64 * 1024
+UPLOAD_STALE_HOURS = 24 # Untouched sessions older than this are purged
+
+class ChunkError(Exception):
+    """Rejected chunk or upload, with a message meant for the user."""
+
+def chunks_folder(upload_folder):
+    return os.path.join(upload_folder, '.chunks')
+
+def session_folder(upload_folder, upload):
+    return os.path.join(chunks_folder(upload_folder), upload.id)
+
+def total_chunks(upload):
+    return max(1, -(-upload.total_size // upload.chunk_size))
+
+def chunk_length(upload, index):
+    """Expected byte length of chunk `index` (the last one may be shorter)."""
+    if index == total_chunks(upload) - 1:
+        return upload.total_size - index * upload.chunk_size
+    return upload.chunk_size
+
+def received_chunks(upload_folder, upload):
+    folder = session_folder(upload_folder, upload)
+    if not os.path.isdir(folder): return []
+    return sorted(int(name[:-5]) for name in os.listdir(folder) if name.endswith('.part'))
+
+def upload_status(upload_folder, upload):
+    received = received_chunks(upload_folder, upload)
+    return {
+        'upload_id': upload.id,
+        'filename': upload.filename,
+        'total_size': upload.total_size,
+        'chunk_size': upload.chunk_size,
+        'total_chunks': total_chunks(upload),
+        'received': received,
+        'missing': sorted(set(range(total_chunks(upload))) - set(received))
+    }
+
+def save_chunk(upload_folder, upload, index, stream, checksum):
+    """Streams one chunk to disk, checking its length and SHA-1 before keeping it."""
+    if index < 0 or index >= total_chunks(upload): raise ChunkError('Parte fora do intervalo')
+    if not checksum: raise ChunkError('Checksum da parte ausente')
+
+    folder = session_folder(upload_folder, upload)
+    os.makedirs(folder, exist_ok=True)
+    final_path = os.path.join(folder, f'{index}.part')
+    tmp_path = f'{final_path}.{uuid.uuid4().hex}.tmp' # Per request: two threads may retry the same chunk
+
+    h = hashlib.sha1()
+    size = 0
+    expected = chunk_length(upload, index)
+    try:
+        with open(tmp_path, 'wb') as f:
+            for block in iter(lambda: stream.read(256 * 1024), b''):
+                size += len(block)
+                if size > expected: raise ChunkError('Parte maior que o esperado')
+                h.update(block)
+                f.write(block)
+        if size != expected: raise ChunkError(f'Parte incompleta ({size} de {expected} bytes)')
+        if h.hexdigest() != checksum.lower(): raise ChunkError('Checksum da parte não confere')
+        os.replace(tmp_path, final_path) # Atomic: a retried chunk never leaves a torn file
+    finally:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+
+    upload.updated_at = datetime.utcnow()
+    db.session.commit()
+
+def assemble(upload_folder, upload, dest_path):
+    """Concatenates every chunk into dest_path (replaced atomically) and drops the session."""
+    missing = upload_status(upload_folder, upload)['missing']
+    if missing: raise ChunkError(f'Faltam {len(missing)} parte(s) do arquivo')
+
+    folder = session_folder(upload_folder, upload)
+    tmp_path = f'{dest_path}.{upload.id}.tmp'
+    h = hashlib.sha1()
+    try:
+        with open(tmp_path, 'wb') as out:
+            for index in range(total_chunks(upload)):
+                with open(os.path.join(folder, f'{index}.part'), 'rb') as part:
+                    for block in iter(lambda: part.read(1024 * 1024), b''):
+                        h.update(block)
+                        out.write(block)
+        if upload.file_sha1 and h.hexdigest() != upload.file_sha1.lower():
+            raise ChunkError('Checksum do arquivo não confere')
+        os.replace(tmp_path, dest_path)
+    finally:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+
+    discard(upload_folder, upload)
+
+def discard(upload_folder, upload):
+    """Removes the chunks and the session row (commits)."""
+    shutil.rmtree(session_folder(upload_folder, upload), ignore_errors=True)
+    db.session.delete(upload)
+    db.session.commit()
+
+def purge_stale(upload_folder):
+    limit = datetime.utcnow() - timedelta(hours=UPLOAD_STALE_HOURS)
+    for upload in UploadSession.query.filter(UploadSession.updated_at < limit).all():
+        shutil.rmtree(session_folder(upload_folder, upload), ignore_errors=True)
+        db.session.delete(upload)
+    db.session.commit()
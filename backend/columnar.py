@@ -0,0 +1,193 @@
+import os
+import sys
+import json
+import mmap
+import struct
+import threading
+from array import array
+
+# --- Columnar Master Cache ---
+# A parsed master is persisted next to its .xlsx (<name>.xlsx.cols) so later
+# reads skip openpyxl entirely. Layout, little-endian:
+#
+#   'PCOL' | format version (u32) | header length (u32) | header JSON | pad to 8
+#   sections, each padded to 8:
+#     row          u32[n]   sheet row of each item
+#     code, desc   u32[n]   string ids
+#     str_offsets  u64[s+1] byte offsets into str_data
+#     str_data     UTF-8 bytes of every distinct string
+#
+# The header holds the source file's SHA-1, the parser version and per-sheet
+# metadata (room name, headers, layout, item range), so room lists come from
+# the header alone. The file is memory-mapped and strings are decoded only for
+# the sheets actually read. A changed source hash or parser version means the
+# file is stale and gets rebuilt from the workbook.
+
+COLUMNAR_SUFFIX = '.cols'
+COLUMNAR_MAGIC = b'PCOL'
+COLUMNAR_FORMAT = 1
+_PREAMBLE = struct.Struct('<4sII')
+_SECTIONS = (('row', 'I'), ('code', 'I'), ('desc', 'I'), ('str_offsets', 'Q'), ('str_data', 'B'))
+_SHEET_FIELDS = ('sheet_name', 'content_hash', 'room_name', 'header_row', 'inv_idx', 'desc_idx', 'layout')
+
+def sidecar_path(path):
+    return path + COLUMNAR_SUFFIX
+
+def _pad(n):
+    return -n % 8
+
+def _little_endian(arr):
+    if sys.byteorder != 'little' and arr.itemsize > 1:
+        arr = array(arr.typecode, arr)
+        arr.byteswap()
+    return arr
+
+def write(path, source_digest, parser_version, sheets):
+    """Writes the columnar file of a parsed master (atomically replaces an older one)."""
+    ids = {}
+    def intern(text):
+        string_id = ids.get(text)
+        if string_id is None:
+            string_id = ids[text] = len(ids)
+        return string_id
+
+    columns = {'row': array('I'), 'code': array('I'), 'desc': array('I')}
+    sheet_meta = []
+    for sheet in sheets:
+        start = len(columns['row'])
+        for r, code, desc in sheet['items']:
+            columns['row'].append(r)
+            columns['code'].append(intern(code))
+            columns['desc'].append(intern(desc))
+        meta = {k: sheet.get(k) for k in _SHEET_FIELDS}
+        meta['start'], meta['count'] = start, len(columns['row']) - start
+        sheet_meta.append(meta)
+
+    offsets = array('Q', [0])
+    data = bytearray()
+    for text in ids: # dicts keep insertion order: position == string id
+        data += text.encode('utf-8')
+        offsets.append(len(data))
+    columns['str_offsets'] = offsets
+    columns['str_data'] = array('B', data)
+
+    sections = {}
+    position = 0
+    for name, _ in _SECTIONS:
+        size = len(columns[name]) * columns[name].itemsize
+        sections[name] = [position, len(columns[name])]
+        position += size + _pad(size)
+
+    header = json.dumps({
+        'source_sha1': source_digest,
+        'parser_version': parser_version,
+        'sheets': sheet_meta,
+        'sections': sections
+    }).encode('utf-8')
+
+    target = sidecar_path(path)
+    tmp = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(_PREAMBLE.pack(COLUMNAR_MAGIC, COLUMNAR_FORMAT, len(header)))
+        f.write(header + b'\0' * _pad(_PREAMBLE.size + len(header)))
+        for name, _ in _SECTIONS:
+            raw = _little_endian(columns[name]).tobytes()
+            f.write(raw + b'\0' * _pad(len(raw)))
+    os.replace(tmp, target) # Readers see the old file or the new one, never half of it
+
+def remove(path):
+    try:
+        os.remove(sidecar_path(path))
+    except FileNotFoundError:
+        pass
+
+class ColumnarMaster:
+    """Read-only view of a columnar file. Use as a context manager (closes the mapping)."""
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, header_len = _PREAMBLE.unpack_from(self._map, 0)
+            if magic != COLUMNAR_MAGIC or version != COLUMNAR_FORMAT: raise ValueError('Formato colunar desconhecido')
+            header = json.loads(self._map[_PREAMBLE.size:_PREAMBLE.size + header_len])
+            base = _PREAMBLE.size + header_len
+            base += _pad(base)
+
+            self.source_sha1 = header['source_sha1']
+            self.parser_version = header['parser_version']
+            self.sheets = header['sheets']
+            view = memoryview(self._map)
+            self._views = [view]
+            self._columns = {}
+            for name, typecode in _SECTIONS:
+                offset, length = header['sections'][name]
+                chunk = view[base + offset:base + offset + length * array(typecode).itemsize]
+                if sys.byteorder != 'little' and typecode != 'B':
+                    column = array(typecode, chunk.tobytes())
+                    column.byteswap()
+                else:
+                    column = chunk.cast(typecode)
+                    self._views.append(chunk)
+                self._columns[name] = column
+                self._views.append(column)
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        for view in reversed(getattr(self, '_views', [])):
+            if isinstance(view, memoryview): view.release()
+        self._views = []
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def string(self, string_id):
+        offsets = self._columns['str_offsets']
+        return bytes(self._columns['str_data'][offsets[string_id]:offsets[string_id + 1]]).decode('utf-8')
+
+    def rooms(self):
+        """(sheet_name, room_name) of sheets with a room, in workbook order. Header only."""
+        return [(s['sheet_name'], s['room_name']) for s in self.sheets if s['room_name']]
+
+    def sheet(self, meta):
+        """One sheet in parse_sheet's shape; only its own strings are decoded."""
+        rows, codes, descs = self._columns['row'], self._columns['code'], self._columns['desc']
+        strings = {} # Descriptions repeat a lot inside a sheet
+        def text(string_id):
+            value = strings.get(string_id)
+            if value is None: value = strings[string_id] = self.string(string_id)
+            return value
+
+        sheet = {k: meta[k] for k in _SHEET_FIELDS}
+        sheet['items'] = [(rows[i], text(codes[i]), text(descs[i])) for i in range(meta['start'], meta['start'] + meta['count'])]
+        return sheet
+
+    def find_sheet(self, sheet_name):
+        for meta in self.sheets:
+            if meta['sheet_name'] == sheet_name: return self.sheet(meta)
+        return None
+
+    def all_sheets(self):
+        return [self.sheet(meta) for meta in self.sheets]
+
+def open_current(path, source_digest, parser_version):
+    """ColumnarMaster of `path` if its sidecar matches the file's hash and parser, else None."""
+    try:
+        master = ColumnarMaster(sidecar_path(path))
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError, struct.error) as e:
+        print(f" * Columnar cache of {path} unreadable, rebuilding: {e}")
+        return None
+    if master.source_sha1 != source_digest or master.parser_version != parser_version:
+        master.close()
+        return None
+    return master
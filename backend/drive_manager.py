@@ -1,24 +1,46 @@
 import os
+import re
+import time
+import random
+import shutil
 import datetime
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
+import threading
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
+
+# google-api-python-client is imported lazily: without credentials.json the
+# app runs fine and Drive sync is simply skipped.
 
 SCOPES = ['https://www.googleapis.com/auth/drive']
 SERVICE_ACCOUNT_FILE = 'credentials.json'
+ROOT_FOLDER_NAME = "Auditorias_Patrimonio"
+
+DRIVE_UPLOAD_WORKERS = int(os.environ.get('DRIVE_UPLOAD_WORKERS', 4)) # Files uploaded at once
+DRIVE_MAX_RETRIES = 5
+DRIVE_BACKOFF_SECONDS = 1 # Doubles on each retry, plus jitter
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
 
 def authenticate():
     creds = None
     if os.path.exists(SERVICE_ACCOUNT_FILE):
+        from google.oauth2 import service_account
         creds = service_account.Credentials.from_service_account_file(
             SERVICE_ACCOUNT_FILE, scopes=SCOPES)
     return creds
 
+def build_service(creds):
+    from googleapiclient.discovery import build
+    return build('drive', 'v3', credentials=creds, cache_discovery=False)
+
 def get_service():
     creds = authenticate()
     if not creds:
         return None
-    return build('drive', 'v3', credentials=creds)
+    return build_service(creds)
+
+def file_media(filepath):
+    from googleapiclient.http import MediaFileUpload
+    return MediaFileUpload(filepath, resumable=True)
 
 def create_folder(service, name, parent_id=None):
     file_metadata = {
@@ -27,58 +49,228 @@ def create_folder(service, name, parent_id=None):
     }
     if parent_id:
         file_metadata['parents'] = [parent_id]
-    
+
     file = service.files().create(body=file_metadata, fields='id, webViewLink').execute()
     return file
 
+def query_literal(value):
+    """A string literal for a Drive query: backslashes and quotes escaped."""
+    return "'" + value.replace('\\', '\\\\').replace("'", "\\'") + "'"
+
 def find_folder(service, name, parent_id=None):
-    query = f"mimeType='application/vnd.google-apps.folder' and name='{name}' and trashed=false"
+    query = f"mimeType='application/vnd.google-apps.folder' and name={query_literal(name)} and trashed=false"
     if parent_id:
-        query += f" and '{parent_id}' in parents"
-    
+        query += f" and {query_literal(parent_id)} in parents"
+
     results = service.files().list(q=query, fields="files(id, webViewLink)").execute()
     files = results.get('files', [])
     if files:
         return files[0]
     return None
 
-def upload_file(service, filename, filepath, folder_id):
+def upload_file(service, filename, filepath, folder_id, media_factory=file_media):
     file_metadata = {
         'name': filename,
         'parents': [folder_id]
     }
-    media = MediaFileUpload(filepath, resumable=True)
-    file = service.files().create(body=file_metadata, media_body=media, fields='id').execute()
+    media = media_factory(filepath)
+    file = service.files().create(body=file_metadata, media_body=media, fields='id, webViewLink').execute()
     return file
 
+def audit_folder_name(analyst_name, room_name, date=None):
+    date_str = (date or datetime.datetime.now()).strftime("%Y-%m-%d")
+    safe_room = "".join([c for c in room_name if c.isalnum() or c in (' ','-','_')]).strip()
+    return f"{date_str} - {analyst_name} - {safe_room}"
+
+# --- Retries ---
+
+def is_retryable(error):
+    """Rate limits, 5xx and network errors are worth retrying; 4xx (bad request, auth) are not."""
+    status = getattr(getattr(error, 'resp', None), 'status', None)
+    if status is not None:
+        return int(status) in RETRYABLE_STATUS
+    return isinstance(error, (OSError, TimeoutError, ConnectionError))
+
+def with_retries(func, retries=DRIVE_MAX_RETRIES, backoff=DRIVE_BACKOFF_SECONDS, sleep=time.sleep):
+    """Calls func(), retrying transient failures with exponential backoff and jitter."""
+    for attempt in range(retries + 1):
+        try:
+            return func()
+        except Exception as e:
+            if attempt >= retries or not is_retryable(e): raise
+            sleep(backoff * (2 ** attempt) * (1 + random.random() / 2))
+
+# --- Drive Sync ---
+
+class DriveSync:
+    """Uploads audit results to Drive.
+
+    Credentials are read once; each thread gets its own service (the API client
+    is not thread-safe). Folder IDs are cached and the files of an audit go up
+    in parallel on a bounded pool; drive_outbox keeps the whole thing off the
+    request path. Pass service_factory/media_factory to use a stand-in such as
+    LocalFolderDrive.
+    """
+
+    def __init__(self, service_factory=None, media_factory=file_media, workers=DRIVE_UPLOAD_WORKERS,
+                 retries=DRIVE_MAX_RETRIES, backoff=DRIVE_BACKOFF_SECONDS, sleep=time.sleep):
+        self.media_factory = media_factory
+        self.retries = retries
+        self.backoff = backoff
+        self.sleep = sleep
+        self._service_factory = service_factory or self._google_service
+        self._creds = None
+        self._creds_lock = threading.Lock()
+        self._local = threading.local()
+        self._folders = {} # (parent_id, name) -> folder
+        self._folders_lock = threading.Lock()
+        self._upload_pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='drive-upload')
+
+    def _google_service(self):
+        with self._creds_lock:
+            if self._creds is None:
+                self._creds = authenticate() or False # False: checked, no credentials
+        return build_service(self._creds) if self._creds else None
+
+    def service(self):
+        if not hasattr(self._local, 'service'):
+            self._local.service = self._service_factory()
+        return self._local.service
+
+    def available(self):
+        return self.service() is not None
+
+    def _retry(self, func):
+        return with_retries(func, self.retries, self.backoff, self.sleep)
+
+    def folder(self, name, parent_id=None):
+        """Finds or creates a folder once; later calls come from the cache."""
+        key = (parent_id, name)
+        with self._folders_lock: # Serialized so two audits never create the same folder twice
+            folder = self._folders.get(key)
+            if folder is None:
+                service = self.service()
+                folder = self._retry(lambda: find_folder(service, name, parent_id)) or \
+                    self._retry(lambda: create_folder(service, name, parent_id))
+                self._folders[key] = folder
+            return folder
+
+    def forget_folder(self, name, parent_id=None):
+        """Drops a cached folder ID (e.g. the folder was deleted on Drive)."""
+        with self._folders_lock:
+            self._folders.pop((parent_id, name), None)
+
+    def _upload_one(self, filename, filepath, folder_id):
+        return self._retry(lambda: upload_file(self.service(), filename, filepath, folder_id, self.media_factory))
+
+    def upload_files(self, files_map, folder_id, return_exceptions=False):
+        """Uploads {filename: filepath} into folder_id concurrently.
+
+        Raises the first failure, or with return_exceptions=True returns
+        {filename: uploaded file or exception}.
+        """
+        futures = {filename: self._upload_pool.submit(self._upload_one, filename, filepath, folder_id)
+                   for filename, filepath in files_map.items() if os.path.exists(filepath)}
+        if not return_exceptions:
+            return [future.result() for future in futures.values()]
+        results = {}
+        for filename, future in futures.items():
+            try:
+                results[filename] = future.result()
+            except Exception as e:
+                results[filename] = e
+        return results
+
+    def upload_audit(self, analyst_name, room_name, files_map, root_id=None):
+        """Blocking upload of one audit. Returns the webViewLink of its folder, or None without credentials."""
+        if not self.available():
+            return None
+
+        if root_id is None:
+            root_id = self.folder(ROOT_FOLDER_NAME)['id']
+        service = self.service()
+        name = audit_folder_name(analyst_name, room_name)
+        audit_folder = self._retry(lambda: create_folder(service, name, parent_id=root_id))
+        self.upload_files(files_map, audit_folder['id'])
+        return audit_folder.get('webViewLink')
+
+_drive_sync = None
+_drive_sync_lock = threading.Lock()
+
+def drive_sync():
+    """Process-wide DriveSync; DRIVE_LOCAL_FOLDER swaps Google for a local folder (development)."""
+    global _drive_sync
+    with _drive_sync_lock:
+        if _drive_sync is None:
+            local_folder = os.environ.get('DRIVE_LOCAL_FOLDER')
+            if local_folder:
+                _drive_sync = DriveSync(service_factory=lambda: LocalFolderDrive(local_folder), media_factory=lambda path: path)
+            else:
+                _drive_sync = DriveSync()
+        return _drive_sync
+
 def upload_audit_results(analyst_name, room_name, files_map):
     """
     files_map: { 'filename': 'absolute_filepath' }
     Returns: webViewLink of the folder
     """
-    service = get_service()
-    if not service:
-        # If no credentials, return None to signal failure/skip
-        print("No Drive credentials found.")
-        return None
+    return drive_sync().upload_audit(analyst_name, room_name, files_map)
 
-    # 1. Root Folder
-    root_name = "Auditorias_Patrimonio"
-    root_folder = find_folder(service, root_name)
-    if not root_folder:
-        root_folder = create_folder(service, root_name)
-    
-    # 2. Audit Folder
-    date_str = datetime.datetime.now().strftime("%Y-%m-%d")
-    safe_room = "".join([c for c in room_name if c.isalnum() or c in (' ','-','_')]).strip()
-    audit_folder_name = f"{date_str} - {analyst_name} - {safe_room}"
-    
-    # Check if exists (optional), or just create new one
-    audit_folder = create_folder(service, audit_folder_name, parent_id=root_folder['id'])
-    
-    # 3. Upload Files
-    for filename, filepath in files_map.items():
-        if os.path.exists(filepath):
-            upload_file(service, filename, filepath, audit_folder['id'])
-            
-    return audit_folder.get('webViewLink')
+# --- Local Drive Stand-in ---
+
+_FOLDER_QUERY_RE = re.compile(r"mimeType='application/vnd\.google-apps\.folder' and name='((?:[^'\\]|\\.)*)' and trashed=false"
+                              r"(?: and '((?:[^'\\]|\\.)*)' in parents)?")
+
+def _unquote(text):
+    return re.sub(r"\\(.)", r"\1", text)
+
+class LocalDriveError(Exception):
+    """Shaped like googleapiclient's HttpError: the HTTP status is on .resp."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.resp = SimpleNamespace(status=status)
+
+class LocalFolderDrive:
+    """The slice of the Drive v3 files() API used above, backed by a local folder.
+
+    Folder and file IDs are paths relative to `root`; media_body is a file path.
+    Queries are parsed as strictly as Drive does: a malformed one is a 400.
+    """
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        os.makedirs(self.root, exist_ok=True)
+
+    def files(self):
+        return self
+
+    def _path(self, file_id):
+        return os.path.join(self.root, file_id) if file_id else self.root
+
+    def _entry(self, file_id):
+        return {'id': file_id, 'webViewLink': 'file://' + self._path(file_id)}
+
+    def list(self, q, fields=None):
+        match = _FOLDER_QUERY_RE.fullmatch(q)
+        if not match: raise LocalDriveError(400, f'Invalid query: {q}')
+        name, parent = _unquote(match.group(1)), match.group(2)
+        file_id = os.path.join(_unquote(parent), name) if parent else name
+        found = [self._entry(file_id)] if os.path.isdir(self._path(file_id)) else []
+        return _Executable({'files': found})
+
+    def create(self, body, media_body=None, fields=None):
+        parents = body.get('parents') or ['']
+        file_id = os.path.join(parents[0], body['name'])
+        if media_body is None:
+            os.makedirs(self._path(file_id), exist_ok=True)
+        else:
+            shutil.copyfile(media_body, self._path(file_id))
+        return _Executable(self._entry(file_id))
+
+class _Executable:
+    def __init__(self, result):
+        self.result = result
+
+    def execute(self):
+        return self.result
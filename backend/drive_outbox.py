@@ -0,0 +1,165 @@
+import os
+import time
+import threading
+import traceback
+from datetime import datetime, timedelta
+from sqlalchemy import func
+
+from .models import db, DriveOutbox, FileMetadata
+from . import drive_manager
+
+# --- Drive Outbox ---
+# Audits only insert a DriveOutbox row; a background thread per process drains
+# the table into Drive. Rows survive restarts, failures are retried with
+# exponential backoff, and each drain handles a batch of audits with a single
+# root folder lookup (audits of the same day, analyst and room share a folder).
+
+OUTBOX_POLL_SECONDS = 5
+OUTBOX_BATCH_SIZE = 20
+OUTBOX_MAX_ATTEMPTS = 10
+OUTBOX_BACKOFF_SECONDS = 30 # Doubles per failed attempt...
+OUTBOX_MAX_BACKOFF_SECONDS = 6 * 60 * 60 # ...up to this
+OUTBOX_STALE_SECONDS = 15 * 60 # A 'sending' row this old lost its worker
+OUTBOX_SWEEP_SECONDS = 60 # How often each process looks for such rows
+
+_wakeup = threading.Event()
+_last_sweep = None
+_sweep_lock = threading.Lock()
+_started = False
+_start_lock = threading.Lock()
+
+def enqueue(report_path, analyst_name, room_name, file_id=None):
+    """Queues a report for Drive (commits). report_path is relative to the reports folder."""
+    entry = DriveOutbox(
+        file_id=file_id,
+        report_path=report_path,
+        analyst_name=analyst_name,
+        room_name=room_name
+    )
+    db.session.add(entry)
+    db.session.commit()
+    _wakeup.set()
+    return entry
+
+def backoff_seconds(attempts):
+    return min(OUTBOX_MAX_BACKOFF_SECONDS, OUTBOX_BACKOFF_SECONDS * 2 ** max(0, attempts - 1))
+
+def stats():
+    """Row counts per status, for /keep_alive."""
+    rows = db.session.query(DriveOutbox.status, func.count(DriveOutbox.id)).group_by(DriveOutbox.status)
+    return {status: count for status, count in rows}
+
+def start_worker(app, reports_folder):
+    global _started
+    with _start_lock:
+        if _started: return
+        _started = True
+    threading.Thread(target=_worker_loop, args=(app, reports_folder), daemon=True, name='drive-outbox').start()
+
+def _sweep_due():
+    global _last_sweep
+    with _sweep_lock:
+        now = time.monotonic()
+        if _last_sweep is not None and now - _last_sweep < OUTBOX_SWEEP_SECONDS: return False
+        _last_sweep = now
+        return True
+
+def _requeue_stale(now):
+    """Puts 'sending' rows whose worker died back in the queue; writes only if there are any."""
+    stale = DriveOutbox.query.filter(DriveOutbox.status == 'sending', DriveOutbox.updated_at < now - timedelta(seconds=OUTBOX_STALE_SECONDS))
+    if stale.with_entities(DriveOutbox.id).first() is None: return
+    stale.update({'status': 'pending'}, synchronize_session=False)
+    db.session.commit()
+
+def _claim_batch():
+    """Moves up to OUTBOX_BATCH_SIZE due rows to 'sending'; each row is claimed by one worker only."""
+    now = datetime.utcnow()
+    if _sweep_due(): _requeue_stale(now)
+
+    due = DriveOutbox.query.filter(DriveOutbox.status == 'pending', DriveOutbox.next_attempt_at <= now)\
+        .order_by(DriveOutbox.next_attempt_at).limit(OUTBOX_BATCH_SIZE).with_entities(DriveOutbox.id).all()
+    if not due: return [] # Idle: nothing written
+    claimed = []
+    for (entry_id,) in due:
+        # Conditional UPDATE: another process may have taken it meanwhile
+        if DriveOutbox.query.filter_by(id=entry_id, status='pending')\
+                .update({'status': 'sending', 'updated_at': now}, synchronize_session=False):
+            claimed.append(entry_id)
+    db.session.commit()
+    return DriveOutbox.query.filter(DriveOutbox.id.in_(claimed)).all() if claimed else []
+
+def _succeed(entry, link):
+    entry.status = 'done'
+    entry.web_view_link = link
+    entry.last_error = None
+    entry.updated_at = datetime.utcnow()
+    if entry.file_id:
+        FileMetadata.query.filter_by(id=entry.file_id).update({'web_view_link': link}, synchronize_session=False)
+
+def _fail(entry, error, permanent=False):
+    entry.attempts = (entry.attempts or 0) + 1
+    entry.last_error = str(error)
+    entry.updated_at = datetime.utcnow()
+    if permanent or entry.attempts >= OUTBOX_MAX_ATTEMPTS:
+        entry.status = 'failed'
+    else:
+        entry.status = 'pending'
+        entry.next_attempt_at = datetime.utcnow() + timedelta(seconds=backoff_seconds(entry.attempts))
+
+def drain_once(reports_folder, sync=None):
+    """Uploads one batch of due reports. Returns how many rows were handled."""
+    sync = sync or drive_manager.drive_sync()
+    if not sync.available(): return 0 # No credentials: rows wait, nothing is lost
+
+    entries = _claim_batch()
+    if not entries: return 0
+
+    try:
+        root_id = sync.folder(drive_manager.ROOT_FOLDER_NAME)['id'] # One lookup for the whole batch
+    except Exception as e:
+        sync.forget_folder(drive_manager.ROOT_FOLDER_NAME)
+        for entry in entries: _fail(entry, e)
+        db.session.commit()
+        return len(entries)
+
+    groups = {}
+    for entry in entries:
+        path = os.path.join(reports_folder, entry.report_path)
+        if not os.path.exists(path):
+            _fail(entry, 'Relatório não encontrado no disco', permanent=True)
+            continue
+        name = drive_manager.audit_folder_name(entry.analyst_name, entry.room_name, entry.created_at) # Retries keep the audit's date
+        groups.setdefault(name, []).append((entry, path))
+
+    for name, group in groups.items():
+        try:
+            folder = sync.folder(name, root_id)
+        except Exception as e:
+            sync.forget_folder(name, root_id)
+            for entry, _ in group: _fail(entry, e)
+            continue
+
+        results = sync.upload_files({os.path.basename(path): path for _, path in group}, folder['id'], return_exceptions=True)
+        for entry, path in group:
+            result = results.get(os.path.basename(path))
+            if isinstance(result, Exception): _fail(entry, result)
+            else: _succeed(entry, folder.get('webViewLink'))
+
+    db.session.commit()
+    return len(entries)
+
+def _worker_loop(app, reports_folder):
+    while True:
+        handled = 0
+        with app.app_context():
+            try:
+                handled = drain_once(reports_folder)
+            except Exception:
+                traceback.print_exc()
+                db.session.rollback()
+            finally:
+                db.session.remove()
+
+        if not handled:
+            _wakeup.wait(OUTBOX_POLL_SECONDS)
+            _wakeup.clear()
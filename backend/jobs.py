@@ -0,0 +1,180 @@
+import os
+import json
+import time
+import uuid
+import threading
+import traceback
+from datetime import datetime, timedelta
+from sqlalchemy import func
+
+from .models import db, AuditJob
+from . import progress as events
+
+# --- Background Job Queue ---
+# Jobs live in the AuditJob table (SQLite), so they survive restarts and any
+# gunicorn worker can pick them up. Each worker process runs a few daemon
+# threads that claim queued jobs one at a time.
+
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+JOB_POLL_SECONDS = 2 # Picks up jobs enqueued by other gunicorn workers
+JOB_STALE_SECONDS = 15 * 60 # A 'running' job this quiet lost its worker
+JOB_SWEEP_SECONDS = 60 # How often each process looks for such jobs
+JOB_MAX_ATTEMPTS = 3 # Claims before a job that keeps losing its worker is failed
+PROGRESS_COMMIT_SECONDS = 1 # Fine-grained progress goes to the event stream, the DB row at most this often
+
+_handlers = {}
+_running = set() # Ids of the jobs this process is running
+_wakeup = threading.Event()
+_last_sweep = None
+_sweep_lock = threading.Lock()
+_started = False
+_start_lock = threading.Lock()
+
+class JobError(Exception):
+    """Expected failure with a message meant for the user (e.g. sheet not found)."""
+
+def register_handler(kind, func):
+    """func(payload, progress) -> JSON-serializable result; progress(stage, percent, **detail)."""
+    _handlers[kind] = func
+
+def enqueue(kind, payload, user_id=None, network_id=None):
+    job = AuditJob(
+        id=uuid.uuid4().hex,
+        kind=kind,
+        payload=json.dumps(payload),
+        user_id=user_id,
+        network_id=network_id
+    )
+    db.session.add(job)
+    db.session.commit()
+    events.publish(job.id, {'status': 'queued', 'stage': 'Na fila...', 'progress': 0})
+    _wakeup.set()
+    return job
+
+def job_status(job):
+    return {
+        'id': job.id,
+        'status': job.status,
+        'stage': job.stage,
+        'progress': job.progress,
+        'result': json.loads(job.result) if job.result else None,
+        'error': job.error
+    }
+
+def runs_here(job_id):
+    """True while this process runs the job, so its events reach the local buffer."""
+    return job_id in _running
+
+def start_workers(app):
+    global _started
+    with _start_lock:
+        if _started: return
+        _started = True
+    for i in range(JOB_WORKERS):
+        threading.Thread(target=_worker_loop, args=(app,), daemon=True, name=f'audit-job-{i}').start()
+
+def _sweep_due():
+    global _last_sweep
+    with _sweep_lock:
+        now = time.monotonic()
+        if _last_sweep is not None and now - _last_sweep < JOB_SWEEP_SECONDS: return False
+        _last_sweep = now
+        return True
+
+def _requeue_stale():
+    """Requeues running jobs that lost their worker; fails those already claimed JOB_MAX_ATTEMPTS times.
+
+    A job that takes its worker down with it would otherwise be retried forever.
+    Only reads while nothing is stale, so an idle queue never writes.
+    """
+    limit = datetime.utcnow() - timedelta(seconds=JOB_STALE_SECONDS)
+    stale = AuditJob.query.filter(AuditJob.status == 'running', AuditJob.updated_at < limit)\
+        .with_entities(AuditJob.id, AuditJob.attempts).all()
+    if not stale: return
+
+    now = datetime.utcnow()
+    for job_id, attempts in stale:
+        if (attempts or 0) >= JOB_MAX_ATTEMPTS:
+            changes = {'status': 'error', 'error': 'A tarefa foi interrompida várias vezes e foi cancelada',
+                       'updated_at': now, 'finished_at': now}
+        else:
+            changes = {'status': 'queued', 'stage': 'Reiniciando...'}
+        # Conditional: another process may have swept it meanwhile
+        AuditJob.query.filter(AuditJob.id == job_id, AuditJob.status == 'running', AuditJob.updated_at < limit)\
+            .update(changes, synchronize_session=False)
+    db.session.commit()
+
+def _claim_next():
+    """Atomically moves the oldest queued job to 'running'. Returns its id or None."""
+    if _sweep_due(): _requeue_stale()
+    job = AuditJob.query.filter_by(status='queued').order_by(AuditJob.created_at).first()
+    if not job: return None
+
+    now = datetime.utcnow()
+    # Conditional UPDATE: only one worker (thread or process) wins the row
+    claimed = AuditJob.query.filter_by(id=job.id, status='queued')\
+        .update({'status': 'running', 'stage': 'Iniciando...', 'updated_at': now,
+                 'attempts': func.coalesce(AuditJob.attempts, 0) + 1}, synchronize_session=False)
+    db.session.commit()
+    return job.id if claimed else None
+
+def _run(job_id):
+    _running.add(job_id)
+    try:
+        _run_job(job_id)
+    finally:
+        _running.discard(job_id)
+
+def _run_job(job_id):
+    job = AuditJob.query.get(job_id)
+    last_commit = [0.0]
+
+    def progress(stage, percent=None, **detail):
+        job.stage = stage
+        if percent is not None: job.progress = int(percent)
+        events.publish(job.id, dict(detail, status='running', stage=stage, progress=job.progress))
+
+        # Pollers (and the stale-job check) only need a coarse view
+        if time.monotonic() - last_commit[0] >= PROGRESS_COMMIT_SECONDS:
+            job.updated_at = datetime.utcnow()
+            db.session.commit()
+            last_commit[0] = time.monotonic()
+
+    try:
+        handler = _handlers.get(job.kind)
+        if not handler: raise JobError(f'Tipo de tarefa desconhecido: {job.kind}')
+        result = handler(json.loads(job.payload), progress)
+        job.status = 'done'
+        job.stage = 'Concluído'
+        job.progress = 100
+        job.result = json.dumps(result)
+    except JobError as e:
+        db.session.rollback()
+        job.status = 'error'
+        job.error = str(e)
+    except Exception as e:
+        traceback.print_exc()
+        db.session.rollback()
+        job.status = 'error'
+        job.error = str(e)
+
+    job.updated_at = job.finished_at = datetime.utcnow()
+    db.session.commit()
+    events.publish(job.id, job_status(job), final=True)
+
+def _worker_loop(app):
+    while True:
+        job_id = None
+        with app.app_context():
+            try:
+                job_id = _claim_next()
+                if job_id: _run(job_id)
+            except Exception:
+                traceback.print_exc()
+                time.sleep(JOB_POLL_SECONDS) # e.g. DB locked, back off
+            finally:
+                db.session.remove()
+
+        if not job_id:
+            _wakeup.wait(JOB_POLL_SECONDS)
+            _wakeup.clear()
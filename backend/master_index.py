@@ -0,0 +1,436 @@
+import os
+import atexit
+import hashlib
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+from openpyxl import load_workbook
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+
+from .models import db, MasterIndex, MasterSheet, MasterItem
+from .workbook_cache import workbook_cache, file_digest
+from .normalize import same_label
+from . import sheet_schema, columnar
+from .sheet_schema import ROOM_SCAN_MAX_ROWS, find_room_name
+
+# --- Sheet Parsing ---
+# Same header rules the routes always used, kept in one place so the upload-time
+# index and the on-the-fly fallback can never disagree. Header detection and
+# the stored per-sheet layouts live in sheet_schema.
+
+# Bumped when the header rules change, so build_index re-parses unchanged sheets
+PARSER_VERSION = 3
+
+def extract_items(rows, header_row, inv_idx, desc_idx):
+    """Yields (row, code, desc) for every inventory code below the header."""
+    if header_row == -1 or inv_idx == -1:
+        return
+    for r_idx in range(header_row + 1, len(rows)):
+        row = rows[r_idx]
+        if inv_idx < len(row) and row[inv_idx]:
+            code = str(row[inv_idx]).strip()
+            desc = str(row[desc_idx]).strip() if desc_idx != -1 and desc_idx < len(row) else "Item"
+            yield r_idx, code, desc
+
+def sheet_hash(rows):
+    """SHA-1 of a sheet's cell values; equal hashes mean the sheet parses the same."""
+    h = hashlib.sha1(b'parser-%d\n' % PARSER_VERSION)
+    for row in rows:
+        h.update(repr(row).encode('utf-8'))
+        h.update(b'\n')
+    return h.hexdigest()
+
+def parse_sheet(sheet_name, rows, layout=None):
+    """Parses one sheet into the dict stored by the index; `layout` is the sheet's stored layout, if any."""
+    layout, room_name = sheet_schema.read_layout(rows, layout)
+    header_row, inv_idx, desc_idx = layout['header_row'], layout['inv_idx'], layout['desc_idx']
+    return {
+        'sheet_name': sheet_name,
+        'content_hash': sheet_hash(rows),
+        'room_name': room_name,
+        'header_row': header_row,
+        'inv_idx': inv_idx,
+        'desc_idx': desc_idx,
+        'layout': layout,
+        'items': list(extract_items(rows, header_row, inv_idx, desc_idx))
+    }
+
+def discover_rooms_stripe(path, stripe, stripes):
+    """Room headers of every `stripes`-th sheet starting at `stripe`, as (position, sheet).
+
+    Streams each sheet for its room header only; item rows are never loaded.
+    Top-level so it can run on the process pool.
+    """
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        found = []
+        for position, sheet_name in enumerate(wb.sheetnames):
+            if position % stripes != stripe: continue
+            rows = wb[sheet_name].iter_rows(max_row=ROOM_SCAN_MAX_ROWS, values_only=True)
+            found.append((position, {'sheet_name': sheet_name, 'room_name': find_room_name(rows)}))
+        return found
+    finally:
+        wb.close()
+
+def discover_rooms(path):
+    """Room headers of every sheet, in the current process."""
+    return [sheet for _, sheet in discover_rooms_stripe(path, 0, 1)]
+
+def parse_workbook(path, on_sheet=None, layouts=None):
+    """Opens the workbook once and parses every sheet; on_sheet(done, total) after each.
+
+    layouts: sheet_name -> stored layout (sheet_schema.load_layouts), skips the header scan of unchanged sheets.
+    """
+    layouts = layouts or {}
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        sheets = []
+        for sheet_name in wb.sheetnames:
+            rows = list(wb[sheet_name].iter_rows(values_only=True))
+            sheets.append(parse_sheet(sheet_name, rows, layouts.get(sheet_name)))
+            if on_sheet: on_sheet(len(sheets), len(wb.sheetnames))
+        return sheets
+    finally:
+        wb.close()
+
+# --- Persistent Index ---
+
+def _write_sheet(m_sheet, sheet):
+    """Copies a parsed sheet onto its MasterSheet row and (re)inserts its items."""
+    m_sheet.room_name = sheet['room_name']
+    m_sheet.header_row = sheet['header_row']
+    m_sheet.inv_idx = sheet['inv_idx']
+    m_sheet.desc_idx = sheet['desc_idx']
+    m_sheet.content_hash = sheet['content_hash']
+    if m_sheet.id is None:
+        db.session.add(m_sheet)
+        db.session.flush()
+    else:
+        MasterItem.query.filter_by(sheet_id=m_sheet.id).delete(synchronize_session=False)
+    db.session.bulk_insert_mappings(MasterItem, [
+        {'sheet_id': m_sheet.id, 'row': r, 'code': code, 'description': desc}
+        for r, code, desc in sheet['items']
+    ])
+
+def build_index(filepath, path, reparse=False):
+    """Parses the master at `path` and (re)writes its index under `filepath`.
+
+    When the file replaces an indexed version, sheets are matched by name and
+    only those whose content hash changed get their items rewritten. Returns
+    counts of added, changed, removed and unchanged sheets. A current columnar
+    file stands in for the workbook unless `reparse` is set.
+    """
+    cached = None if reparse else open_columnar(path)
+    if cached:
+        with cached:
+            sheets = cached.all_sheets()
+    else:
+        sheets = parse_workbook(path, layouts=sheet_schema.load_layouts(filepath))
+        save_columnar(path, sheets)
+    sheet_schema.remember(filepath, sheets)
+    stat = os.stat(path)
+    workbook_cache.invalidate(filepath)
+
+    master = MasterIndex.query.filter_by(filepath=filepath).first()
+    if master:
+        master.file_size = stat.st_size
+        master.file_mtime = stat.st_mtime
+        master.parser_version = PARSER_VERSION
+        master.indexed_at = datetime.utcnow()
+    else:
+        master = MasterIndex(filepath=filepath, file_size=stat.st_size, file_mtime=stat.st_mtime, parser_version=PARSER_VERSION)
+        db.session.add(master)
+        db.session.flush()
+
+    old_sheets = {s.sheet_name: s for s in MasterSheet.query.filter_by(master_id=master.id)}
+    stats = {'added': 0, 'changed': 0, 'removed': 0, 'unchanged': 0}
+
+    for position, sheet in enumerate(sheets):
+        m_sheet = old_sheets.pop(sheet['sheet_name'], None)
+        if m_sheet is None:
+            m_sheet = MasterSheet(master_id=master.id, sheet_name=sheet['sheet_name'])
+            stats['added'] += 1
+        elif m_sheet.content_hash and m_sheet.content_hash == sheet['content_hash']:
+            m_sheet.position = position # Sheets may have been reordered
+            stats['unchanged'] += 1
+            continue
+        else:
+            stats['changed'] += 1
+        m_sheet.position = position
+        _write_sheet(m_sheet, sheet)
+
+    # Sheets (rooms) dropped from the new version
+    for m_sheet in old_sheets.values():
+        MasterItem.query.filter_by(sheet_id=m_sheet.id).delete(synchronize_session=False)
+        db.session.delete(m_sheet)
+        stats['removed'] += 1
+
+    db.session.commit()
+    return stats
+
+def sheet_rows(path, sheet_name, max_row):
+    """The first `max_row` rows of one sheet, or None if the sheet does not exist."""
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        if sheet_name not in wb.sheetnames: return None
+        return list(wb[sheet_name].iter_rows(max_row=max_row, values_only=True))
+    finally:
+        wb.close()
+
+def sheet_summaries(filepath, path):
+    """[{'sheet_name', 'room_name', 'items'}] in workbook order, from the index or a parse."""
+    master = get_index(filepath, path)
+    if master:
+        rows = db.session.query(MasterSheet.sheet_name, MasterSheet.room_name, func.count(MasterItem.id))\
+            .outerjoin(MasterItem, MasterItem.sheet_id == MasterSheet.id)\
+            .filter(MasterSheet.master_id == master.id)\
+            .group_by(MasterSheet.id)\
+            .order_by(MasterSheet.position)
+        return [{'sheet_name': name, 'room_name': room, 'items': count} for name, room, count in rows]
+    return [{'sheet_name': s['sheet_name'], 'room_name': s['room_name'], 'items': len(s['items'])}
+            for s in parsed_sheets(filepath, path)]
+
+def drop_index(filepath):
+    """Removes the stored index and layouts of a master (no commit)."""
+    workbook_cache.invalidate(filepath)
+    sheet_schema.forget(filepath)
+    master = MasterIndex.query.filter_by(filepath=filepath).first()
+    if not master: return
+    sheet_ids = [s.id for s in MasterSheet.query.filter_by(master_id=master.id).with_entities(MasterSheet.id)]
+    if sheet_ids:
+        MasterItem.query.filter(MasterItem.sheet_id.in_(sheet_ids)).delete(synchronize_session=False)
+    MasterSheet.query.filter_by(master_id=master.id).delete(synchronize_session=False)
+    db.session.delete(master)
+
+def rebuild_sheets(filepath, path, sheet_names=None):
+    """build_index that re-parses the given sheets (all if None) even if their content is unchanged."""
+    master = MasterIndex.query.filter_by(filepath=filepath).first()
+    if master:
+        query = MasterSheet.query.filter_by(master_id=master.id)
+        if sheet_names is not None: query = query.filter(MasterSheet.sheet_name.in_(sheet_names))
+        query.update({'content_hash': None}, synchronize_session=False)
+    return build_index(filepath, path, reparse=True)
+
+def get_index(filepath, path):
+    """Returns the stored index if it still matches the file on disk, else None."""
+    master = MasterIndex.query.filter_by(filepath=filepath).first()
+    if not master: return None
+
+    stat = os.stat(path)
+    if master.file_size != stat.st_size or master.file_mtime != stat.st_mtime:
+        return None # Replaced on disk since it was indexed
+    if master.parser_version != PARSER_VERSION:
+        return None # Built with older header rules; the next build re-parses it
+    return master
+
+# --- Columnar Cache ---
+
+def open_columnar(path):
+    """The master's columnar file if it matches the workbook on disk, else None."""
+    return columnar.open_current(path, file_digest(path), PARSER_VERSION)
+
+def save_columnar(path, sheets):
+    try:
+        columnar.write(path, file_digest(path), PARSER_VERSION, sheets)
+    except OSError as e:
+        # Not fatal: the next read parses the workbook again
+        print(f" * Columnar cache of {path} not written: {e}")
+
+# --- Read Paths (index first, then the LRU, the columnar file and a workbook parse) ---
+
+def parsed_sheets(filepath, path, on_sheet=None):
+    """Parsed sheets of a master without an up-to-date index, via the LRU cache."""
+    return workbook_cache.get(filepath, path, lambda p: load_master(filepath, p, on_sheet))
+
+def load_master(filepath, path, on_sheet=None):
+    """Parsed sheets from the columnar file, or from the workbook (then written as columnar)."""
+    cached = open_columnar(path)
+    if cached:
+        with cached:
+            return cached.all_sheets()
+    sheets = parse_master(filepath, path, on_sheet)
+    save_columnar(path, sheets)
+    return sheets
+
+def parse_master(filepath, path, on_sheet=None):
+    """parse_workbook with the master's stored layouts; layouts learned on the way are saved."""
+    sheets = parse_workbook(path, on_sheet, sheet_schema.load_layouts(filepath))
+    if sheet_schema.remember(filepath, sheets):
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback() # Another worker stored them first
+    return sheets
+
+def known_rooms(filepath, path):
+    """(sheet_name, room_name) pairs from the index or the caches, None if a parse is needed."""
+    master = get_index(filepath, path)
+    if master:
+        return MasterSheet.query.filter_by(master_id=master.id)\
+            .filter(MasterSheet.room_name.isnot(None))\
+            .order_by(MasterSheet.position)\
+            .with_entities(MasterSheet.sheet_name, MasterSheet.room_name).all()
+
+    # A full parse has the rooms too; otherwise a room-only parse will do
+    sheets = workbook_cache.peek(filepath, path)
+    if sheets is None:
+        sheets = workbook_cache.peek(filepath, path, kind='rooms')
+    if sheets is None:
+        cached = open_columnar(path)
+        if cached is None: return None
+        with cached:
+            return cached.rooms() # Header only, no strings decoded
+    return [(s['sheet_name'], s['room_name']) for s in sheets if s['room_name']]
+
+# --- Parallel Room Discovery ---
+# openpyxl parsing is CPU-bound and holds the GIL, so unindexed files go to processes.
+# Workers are spawned, never forked: a fork of the threaded server would copy
+# held locks and the open SQLAlchemy connections into the child.
+
+ROOM_POOL_WORKERS = int(os.environ.get('ROOM_POOL_WORKERS', min(4, os.cpu_count() or 1)))
+
+_room_pool = None
+_room_pool_lock = threading.Lock()
+
+def room_pool():
+    """The shared process pool, started on first use."""
+    global _room_pool
+    with _room_pool_lock:
+        if _room_pool is None:
+            _room_pool = ProcessPoolExecutor(max_workers=ROOM_POOL_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        return _room_pool
+
+def reset_room_pool():
+    """Drops a broken pool (worker killed by OOM etc.) so the next call starts a new one."""
+    global _room_pool
+    with _room_pool_lock:
+        if _room_pool is not None:
+            _room_pool.shutdown(wait=False)
+        _room_pool = None
+
+@atexit.register
+def shutdown_room_pool():
+    global _room_pool
+    with _room_pool_lock:
+        if _room_pool is not None:
+            _room_pool.shutdown(wait=True, cancel_futures=True)
+        _room_pool = None
+
+def list_rooms(files, on_file=None):
+    """Rooms of the selected masters as returned by /get_rooms, plus per-file errors.
+
+    `files` holds (source, filepath, path) tuples. Indexed or cached masters are
+    answered directly; the rest are parsed on the process pool, with each
+    file's sheets striped across the idle workers. Rooms keep the input file
+    order and the sheet order inside each file. on_file(done, total, source)
+    reports each finished file.
+    """
+    pairs_by_file = [None] * len(files)
+    errors = []
+
+    done = [0]
+    def file_done(source):
+        done[0] += 1
+        if on_file: on_file(done[0], len(files), source)
+
+    pending = []
+    for i, (source, filepath, path) in enumerate(files):
+        try:
+            pairs_by_file[i] = known_rooms(filepath, path)
+            if pairs_by_file[i] is None: pending.append(i)
+        except Exception as e:
+            errors.append({'file': source, 'error': str(e)})
+        if i not in pending: file_done(source)
+
+    if pending:
+        stripes = max(1, ROOM_POOL_WORKERS // len(pending))
+        futures = {}
+        try:
+            for i in pending:
+                futures[i] = [room_pool().submit(discover_rooms_stripe, files[i][2], s, stripes) for s in range(stripes)]
+        except BrokenProcessPool:
+            reset_room_pool()
+
+        for i in pending:
+            source, filepath, path = files[i]
+            try:
+                if i not in futures: raise BrokenProcessPool('Pool de processos indisponível')
+                found = []
+                for future in futures[i]:
+                    found.extend(future.result())
+                found.sort(key=lambda p: p[0])
+                sheets = [sheet for _, sheet in found]
+                workbook_cache.store(filepath, path, sheets, kind='rooms')
+                pairs_by_file[i] = [(s['sheet_name'], s['room_name']) for s in sheets if s['room_name']]
+            except BrokenProcessPool as e:
+                reset_room_pool()
+                errors.append({'file': source, 'error': str(e)})
+            except Exception as e:
+                errors.append({'file': source, 'error': str(e)})
+            file_done(source)
+
+    rooms = []
+    for (source, _, _), pairs in zip(files, pairs_by_file):
+        for sheet_name, room_name in pairs or []:
+            rooms.append({'id': f"{sheet_name}::{room_name}", 'name': room_name, 'source': source, 'type': 'sliced'})
+    return rooms, errors
+
+def expected_items_by_sheet(filepath, path):
+    """Every sheet of a master as sheet_name -> {'room_name', 'items': {code: desc}}.
+
+    One index query (or one cached parse) for the whole workbook, for audits
+    covering many rooms at once.
+    """
+    master = get_index(filepath, path)
+    if master:
+        rows = db.session.query(MasterSheet.sheet_name, MasterSheet.room_name, MasterItem.code, MasterItem.description)\
+            .outerjoin(MasterItem, MasterItem.sheet_id == MasterSheet.id)\
+            .filter(MasterSheet.master_id == master.id)\
+            .order_by(MasterSheet.position, MasterItem.row)
+        sheets = {}
+        for sheet_name, room_name, code, desc in rows:
+            sheet = sheets.setdefault(sheet_name, {'room_name': room_name, 'items': {}})
+            if code is not None: sheet['items'][code] = desc
+        return sheets
+
+    return {
+        sheet['sheet_name']: {'room_name': sheet['room_name'], 'items': {code: desc for _, code, desc in sheet['items']}}
+        for sheet in parsed_sheets(filepath, path)
+    }
+
+def resolve_sheet(label, sheets):
+    """Sheet name for a room label: a /get_rooms id, a sheet name or a room name. None if unknown."""
+    if "::" in label:
+        label = label.split("::")[0]
+    if label in sheets: return label
+
+    for sheet_name, sheet in sheets.items():
+        if sheet['room_name'] and same_label(sheet['room_name'], label):
+            return sheet_name
+    return None
+
+def expected_items(filepath, path, sheet_name, on_sheet=None):
+    """Map code -> description for a sheet, or None if the sheet does not exist."""
+    master = get_index(filepath, path)
+    if master:
+        m_sheet = MasterSheet.query.filter_by(master_id=master.id, sheet_name=sheet_name).first()
+        if not m_sheet: return None
+        rows = MasterItem.query.filter_by(sheet_id=m_sheet.id)\
+            .order_by(MasterItem.row)\
+            .with_entities(MasterItem.code, MasterItem.description).all()
+        return {code: desc for code, desc in rows}
+
+    if workbook_cache.peek(filepath, path) is None:
+        cached = open_columnar(path)
+        if cached:
+            with cached:
+                sheet = cached.find_sheet(sheet_name) # Decodes this sheet only
+            return {code: desc for _, code, desc in sheet['items']} if sheet else None
+
+    for sheet in parsed_sheets(filepath, path, on_sheet):
+        if sheet['sheet_name'] == sheet_name:
+            return {code: desc for _, code, desc in sheet['items']}
+    return None
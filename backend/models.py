@@ -4,6 +4,32 @@ from datetime import datetime
 # Initialize SQLAlchemy
 db = SQLAlchemy()
 
+def ensure_columns():
+    """create_all() skips tables that already exist, so nullable columns added later are ALTERed in."""
+    inspector = db.inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name): continue
+        existing = {c['name'] for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing: continue
+            col_type = column.type.compile(dialect=db.engine.dialect)
+            try:
+                with db.engine.begin() as conn:
+                    conn.execute(db.text(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {col_type}'))
+            except Exception as e:
+                # Another worker may have added it in the meantime
+                print(f" * Column {table.name}.{column.name} not added: {e}")
+
+def ensure_indexes():
+    """create_all() skips tables that already exist, so indexes added later are created here."""
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            try:
+                index.create(bind=db.engine, checkfirst=True)
+            except Exception as e:
+                # Another worker may have created it between the check and the CREATE
+                print(f" * Index {index.name} not created: {e}")
+
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(120), unique=True, nullable=False)
@@ -17,10 +43,18 @@ class Network(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), unique=True, nullable=False)
     password = db.Column(db.String(200), nullable=False)
-    city = db.Column(db.String(100), nullable=False)
-    admin_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    city = db.Column(db.String(100), nullable=False, index=True) # City picker on the login screen
+    admin_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
 
 class FileMetadata(db.Model):
+    # Every listing/lookup filters on these pairs
+    __table_args__ = (
+        db.Index('ix_file_metadata_type_network', 'type', 'network_id'),
+        db.Index('ix_file_metadata_type_user', 'type', 'user_id'),
+        db.Index('ix_file_metadata_filename_type', 'filename', 'type'),
+        db.Index('ix_file_metadata_type_date', 'type', 'upload_date', 'id'), # Keyset pagination
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     filename = db.Column(db.String(255), nullable=False)
     filepath = db.Column(db.String(500), nullable=False) # Local path relative to upload folder
@@ -32,6 +66,8 @@ class FileMetadata(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
     network_id = db.Column(db.Integer, db.ForeignKey('network.id'), nullable=True)
 
+    web_view_link = db.Column(db.String(500), nullable=True) # Drive folder of an audit report, once synced
+
     def to_dict(self):
         return {
             'id': self.id,
@@ -40,3 +76,137 @@ class FileMetadata(db.Model):
             'created_at': self.upload_date.isoformat(),
             'network_name': self.network_id # Will need join query to get name
         }
+
+# --- Master Spreadsheet Index (built once at upload) ---
+
+class MasterIndex(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    filepath = db.Column(db.String(500), unique=True, nullable=False) # Same key as FileMetadata.filepath
+    file_size = db.Column(db.Integer, nullable=False)
+    file_mtime = db.Column(db.Float, nullable=False) # Detects files replaced on disk
+    parser_version = db.Column(db.Integer, nullable=True) # master_index.PARSER_VERSION the index was built with
+    indexed_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class MasterSheet(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    master_id = db.Column(db.Integer, db.ForeignKey('master_index.id'), nullable=False, index=True)
+    position = db.Column(db.Integer, nullable=False) # Sheet order in the workbook
+    sheet_name = db.Column(db.String(255), nullable=False)
+    room_name = db.Column(db.String(500), nullable=True) # "Loc - Denom - Inv" from the Localização header
+    header_row = db.Column(db.Integer, default=-1) # Row of the "Nº Invent" header
+    inv_idx = db.Column(db.Integer, default=-1)
+    desc_idx = db.Column(db.Integer, default=-1)
+    content_hash = db.Column(db.String(40), nullable=True) # SHA-1 of the cell values, lets re-uploads skip unchanged sheets
+
+class MasterItem(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    sheet_id = db.Column(db.Integer, db.ForeignKey('master_sheet.id'), nullable=False, index=True)
+    row = db.Column(db.Integer, nullable=False)
+    code = db.Column(db.String(100), nullable=False)
+    description = db.Column(db.String(500))
+
+class MasterSchema(db.Model):
+    """Learned (or admin-fixed) layout of one sheet; survives index rebuilds and re-uploads."""
+    __table_args__ = (
+        db.UniqueConstraint('filepath', 'sheet_name', name='uq_master_schema_sheet'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    filepath = db.Column(db.String(500), nullable=False, index=True) # Same key as FileMetadata.filepath
+    sheet_name = db.Column(db.String(255), nullable=False)
+    layout = db.Column(db.Text, nullable=False) # JSON, see sheet_schema.detect_layout
+    fingerprint = db.Column(db.String(40), nullable=False) # SHA-1 of the header rows the layout was read from
+    manual = db.Column(db.Boolean, default=False) # Set by an admin through /masters/<filename>/schema
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# --- Background Jobs ---
+
+class AuditJob(db.Model):
+    id = db.Column(db.String(32), primary_key=True) # uuid4 hex, also the polling token
+    kind = db.Column(db.String(50), nullable=False) # 'verify'
+    status = db.Column(db.String(20), nullable=False, default='queued', index=True) # queued, running, done, error
+    stage = db.Column(db.String(200))
+    progress = db.Column(db.Integer, default=0) # 0-100
+    payload = db.Column(db.Text, nullable=False) # JSON
+    result = db.Column(db.Text) # JSON
+    error = db.Column(db.Text)
+    attempts = db.Column(db.Integer, default=0) # Times a worker claimed it
+
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    network_id = db.Column(db.Integer, db.ForeignKey('network.id'), nullable=True)
+
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+# --- Live Audit Sessions ---
+
+class AuditSession(db.Model):
+    id = db.Column(db.String(32), primary_key=True) # uuid4 hex
+    analyst_name = db.Column(db.String(200), nullable=False)
+    source_file = db.Column(db.String(255), nullable=False) # FileMetadata.filename of the audited master
+    filepath = db.Column(db.String(500), nullable=False)
+    room_name = db.Column(db.String(500), nullable=False) # As sent by the client (room id)
+    sheet_name = db.Column(db.String(255), nullable=False)
+    search_files = db.Column(db.Text, nullable=False) # JSON [[filename, filepath], ...] for wrong-room lookups
+    status = db.Column(db.String(20), nullable=False, default='open') # open, finalized
+    expected_count = db.Column(db.Integer, default=0)
+    found_count = db.Column(db.Integer, default=0)
+    extra_count = db.Column(db.Integer, default=0) # Includes wrong-room codes
+    job_id = db.Column(db.String(32), nullable=True) # Report job queued by finalize
+
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    network_id = db.Column(db.Integer, db.ForeignKey('network.id'), nullable=True)
+
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class AuditScan(db.Model):
+    __table_args__ = (
+        db.UniqueConstraint('session_id', 'code', name='uq_audit_scan_session_code'), # A code counts once per session
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    session_id = db.Column(db.String(32), db.ForeignKey('audit_session.id'), nullable=False, index=True)
+    code = db.Column(db.String(100), nullable=False)
+    status = db.Column(db.String(20), nullable=False) # verified, extra, wrong_room
+    location = db.Column(db.String(500), nullable=True) # Room where a wrong-room code belongs
+    scanned_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# --- Drive Outbox ---
+
+class DriveOutbox(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    file_id = db.Column(db.Integer, db.ForeignKey('file_metadata.id'), nullable=True) # Report that gets the webViewLink
+    report_path = db.Column(db.String(500), nullable=False) # Relative to the reports folder
+    analyst_name = db.Column(db.String(200), nullable=False)
+    room_name = db.Column(db.String(500), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='pending', index=True) # pending, sending, done, failed
+    attempts = db.Column(db.Integer, default=0)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    last_error = db.Column(db.Text)
+    web_view_link = db.Column(db.String(500))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# --- Chunked Uploads ---
+
+class UploadSession(db.Model):
+    id = db.Column(db.String(32), primary_key=True) # uuid4 hex, also the resume token
+    filename = db.Column(db.String(255), nullable=False) # Name shown in the listings
+    filepath = db.Column(db.String(500), nullable=False) # Safe name under the upload folder
+    total_size = db.Column(db.Integer, nullable=False)
+    chunk_size = db.Column(db.Integer, nullable=False)
+    file_sha1 = db.Column(db.String(40), nullable=True) # Optional whole-file check on complete
+
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    network_id = db.Column(db.Integer, db.ForeignKey('network.id'), nullable=True)
+
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, index=True) # Abandoned uploads are purged by age
+
+class ScanUpload(db.Model):
+    id = db.Column(db.String(32), primary_key=True) # scan_id returned by /upload_scan
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    network_id = db.Column(db.Integer, db.ForeignKey('network.id'), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -0,0 +1,60 @@
+import re
+import unicodedata
+from functools import lru_cache
+
+# --- Cell Normalization ---
+# ERP exports spell the same header many ways ("Nº Invent.", "N° Inventário",
+# "NO INVENTARIO", "Localizacao"...). Cells are folded once (accents removed,
+# º/° unified, whitespace collapsed, case-folded) and header roles are memoized
+# per distinct cell value, so a header row costs a few dict lookups.
+
+ROLE_LOCATION = 'location'
+ROLE_DENOMINATION = 'denomination'
+ROLE_ASSET_DENOMINATION = 'asset_denomination' # "Denominação do imobilizado": the item description column
+ROLE_INVENTORY = 'inventory'
+
+HEADER_ROLE_CACHE_SIZE = 8192
+
+_ORDINALS = str.maketrans({'º': 'o', '°': 'o', 'ª': 'a'})
+_SPACES = re.compile(r'\s+')
+
+# A space or '.' must follow the ordinal: the room header's "Empresa Nºinventário"
+# cell (company number) is not the item list's "Nº invent." column
+INVENTORY_RE = re.compile(r'\bn(?:o|r|ro|um|umero)?(?:\.\s*|\s+)(?:de\s+)?invent')
+
+def fold(value):
+    """Comparable form of a cell: no accents, º/° as 'o', single spaces, case-folded."""
+    text = unicodedata.normalize('NFKD', str(value).translate(_ORDINALS))
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return _SPACES.sub(' ', text).strip().casefold()
+
+def cell_text(value):
+    """Display text of a cell ('' for empty cells)."""
+    if value is None: return ''
+    return str(value).strip()
+
+@lru_cache(maxsize=HEADER_ROLE_CACHE_SIZE)
+def _header_role(value):
+    text = fold(value)
+    if 'localizacao' in text: return ROLE_LOCATION
+    if INVENTORY_RE.search(text): return ROLE_INVENTORY
+    if 'denominacao' in text:
+        return ROLE_ASSET_DENOMINATION if 'imobilizado' in text else ROLE_DENOMINATION
+    return None
+
+def header_role(value):
+    """Role of a header cell (one of the ROLE_* constants) or None."""
+    if not isinstance(value, str) or not value: return None # Headers are text; skip numbers and dates
+    return _header_role(value)
+
+def header_columns(row):
+    """{role: column} of a row; when a role repeats, the last column wins."""
+    columns = {}
+    for c_idx, cell in enumerate(row):
+        role = header_role(cell)
+        if role: columns[role] = c_idx
+    return columns
+
+def same_label(a, b):
+    """True if two labels (room names, sheet names) differ only in accents, case or spacing."""
+    return fold(a) == fold(b)
@@ -0,0 +1,86 @@
+import time
+import threading
+from collections import deque
+
+# --- In-Memory Progress Events (Server-Sent Events) ---
+# Each job (or ad-hoc request token) gets a small ring buffer of events in this
+# process. Publishers never block; /events readers wait on a condition and
+# resume from Last-Event-ID, so a reconnecting browser misses nothing still buffered.
+
+EVENT_BUFFER_SIZE = 200 # Events kept per key
+EVENT_TTL_SECONDS = 10 * 60 # Finished (or idle) buffers are dropped after this
+
+class EventBuffer:
+    def __init__(self):
+        self.events = deque(maxlen=EVENT_BUFFER_SIZE) # (id, data)
+        self.next_id = 1
+        self.finished = False
+        self.touched = time.monotonic()
+        self.cond = threading.Condition()
+
+    def publish(self, data, final=False):
+        with self.cond:
+            self.events.append((self.next_id, data))
+            self.next_id += 1
+            self.finished = self.finished or final
+            self.touched = time.monotonic()
+            self.cond.notify_all()
+
+    def since(self, last_id):
+        return [(event_id, data) for event_id, data in self.events if event_id > last_id]
+
+_buffers = {}
+_buffers_lock = threading.Lock()
+
+def _prune():
+    limit = time.monotonic() - EVENT_TTL_SECONDS
+    for key in [k for k, b in _buffers.items() if b.touched < limit]:
+        del _buffers[key]
+
+def buffer(key, create=True):
+    with _buffers_lock:
+        buf = _buffers.get(key)
+        if buf is None and create:
+            _prune()
+            buf = _buffers[key] = EventBuffer()
+        return buf
+
+def publish(key, data, final=False):
+    buffer(key).publish(data, final)
+
+def stream(key, last_id=0, heartbeat=15, on_idle=None, max_idle=None, max_seconds=None):
+    """Yields (id, data) events for `key` as they arrive, and None on each idle heartbeat.
+
+    on_idle(): optional check run on heartbeats; returning an event dict ends the
+    stream with it (e.g. the job finished in another process). Stops after a final
+    event, after max_seconds (the browser reconnects with Last-Event-ID), or after
+    max_idle seconds without events, ending with {'status': 'expired'}.
+    """
+    buf = buffer(key)
+    started = last_event = time.monotonic()
+    while True:
+        with buf.cond:
+            pending = buf.since(last_id)
+            if not pending and not buf.finished:
+                buf.cond.wait(heartbeat)
+                pending = buf.since(last_id)
+                buf.touched = time.monotonic() # Someone is still listening
+            finished = buf.finished
+
+        for event_id, data in pending:
+            last_id = event_id
+            yield event_id, data
+        if finished and not buf.since(last_id): return
+
+        now = time.monotonic()
+        if pending: last_event = now
+        if max_seconds and now - started >= max_seconds: return
+        if not pending:
+            data = on_idle() if on_idle else None
+            if data is not None:
+                yield last_id + 1, data
+                return
+            if max_idle and now - last_event >= max_idle:
+                yield last_id, {'status': 'expired'} # Nobody publishes to this key
+                return
+            yield None
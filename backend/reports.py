@@ -0,0 +1,99 @@
+import re
+import zipfile
+from openpyxl import Workbook
+
+# --- Audit Report Writer ---
+# Each report is a write-only workbook saved straight into its ZIP entry:
+# no full in-memory Workbook and no temp .xlsx files on disk.
+
+REPORT_HEADER = ["Código", "Descrição", "Status"]
+
+# (result key, file prefix, sheet title)
+REPORT_FILES = [
+    ('verified', 'Conferidos', 'Conferidos'), # Analisados
+    ('missing', 'Faltantes', 'Faltantes'), # Deveriam ter sido encontrados
+    ('extra', 'Sobras', 'Sobras') # Não encontrados/Sobras
+]
+
+def write_sheet(wb, title, columns):
+    """Appends one write-only sheet from column-oriented results."""
+    ws = wb.create_sheet(title)
+    ws.append(REPORT_HEADER)
+    status = columns['status']
+    for code, desc in zip(columns['code'], columns['desc']):
+        ws.append([code, desc, status])
+
+def write_workbook_entry(zipf, arcname, title, columns):
+    """Streams a single-sheet workbook into a new entry of an open ZipFile."""
+    wb = Workbook(write_only=True)
+    write_sheet(wb, title, columns)
+    with zipf.open(arcname, 'w') as entry:
+        wb.save(entry)
+
+# --- Batch (multi-room) Report ---
+
+SUMMARY_HEADER = ["Arquivo", "Sala", "Esperados", "Conferidos", "Faltantes", "Sobras", "Observação"]
+
+def sheet_title(name, used):
+    """Excel-safe, unique sheet title (max 31 chars, no []:*?/\\)."""
+    base = re.sub(r'[\[\]:*?/\\]', '_', name).strip() or 'Sala'
+    title = base[:31]
+    n = 2
+    while title.lower() in used:
+        suffix = f" ({n})"
+        title = base[:31 - len(suffix)] + suffix
+        n += 1
+    used.add(title.lower())
+    return title
+
+def write_batch_zip(zip_path, analyst_name, timestamp, audits):
+    """One consolidated workbook for a multi-room audit: summary, all missing/extra, one sheet per room.
+
+    audits: [{'source', 'room', 'result' (compare_codes output) or None, 'error'}].
+    """
+    wb = Workbook(write_only=True)
+
+    ws = wb.create_sheet("Resumo")
+    ws.append(SUMMARY_HEADER)
+    for audit in audits:
+        result = audit['result']
+        if result is None:
+            ws.append([audit['source'], audit['room'], None, None, None, None, audit['error']])
+            continue
+        verified, missing = len(result['verified']['code']), len(result['missing']['code'])
+        ws.append([audit['source'], audit['room'], verified + missing, verified, missing, len(result['extra']['code']), None])
+
+    # Consolidated lists, tagged with the room
+    for key, title in (('missing', 'Faltantes'), ('extra', 'Sobras')):
+        ws = wb.create_sheet(title)
+        ws.append(["Sala"] + REPORT_HEADER)
+        for audit in audits:
+            if audit['result'] is None: continue
+            columns = audit['result'][key]
+            for code, desc in zip(columns['code'], columns['desc']):
+                ws.append([audit['room'], code, desc, columns['status']])
+
+    used = {"resumo", "faltantes", "sobras"}
+    for audit in audits:
+        if audit['result'] is None: continue
+        ws = wb.create_sheet(sheet_title(audit['room'], used))
+        ws.append(REPORT_HEADER)
+        for key, _, _ in REPORT_FILES:
+            columns = audit['result'][key]
+            for code, desc in zip(columns['code'], columns['desc']):
+                ws.append([code, desc, columns['status']])
+
+    with zipfile.ZipFile(zip_path, 'w') as zipf:
+        with zipf.open(f"Auditoria_Lote_{analyst_name}_{timestamp}.xlsx", 'w') as entry:
+            wb.save(entry)
+
+def write_audit_zip(zip_path, analyst_name, timestamp, result, on_file=None):
+    """Writes the Conferidos/Faltantes/Sobras workbooks of one audit into zip_path.
+
+    on_file(index, total, arcname) is called before each workbook is written.
+    """
+    with zipfile.ZipFile(zip_path, 'w') as zipf:
+        for i, (key, prefix, title) in enumerate(REPORT_FILES):
+            arcname = f"{prefix}_{analyst_name}_{timestamp}.xlsx"
+            if on_file: on_file(i, len(REPORT_FILES), arcname)
+            write_workbook_entry(zipf, arcname, title, result[key])
@@ -0,0 +1,82 @@
+import os
+import re
+import uuid
+
+from .verification import iter_scanned_codes
+
+# --- Collector Scan Files ---
+# Raw scans are copied to uploads/scanned_data while they are parsed, one line
+# at a time, so a 100k+ line export never sits in memory as a whole.
+
+SCAN_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+TOP_DUPLICATES = 100 # Most repeated codes returned with the upload summary
+MAX_SCAN_BYTES = int(os.environ.get('MAX_SCAN_MB', 50)) * 1024 * 1024
+
+class ScanTooLarge(Exception):
+    """Upload went past MAX_SCAN_BYTES (it is discarded)."""
+
+def scan_path(folder, scan_id):
+    """Path of a stored scan, or None if the id is malformed or unknown."""
+    if not scan_id or not SCAN_ID_RE.match(scan_id): return None
+    for ext in ('.txt', '.csv'):
+        path = os.path.join(folder, f'scan_{scan_id}{ext}')
+        if os.path.exists(path): return path
+    return None
+
+def decode_lines(stream):
+    """Yields text lines from a binary stream (UTF-8, Latin-1 fallback per line)."""
+    for i, line in enumerate(stream):
+        try:
+            text = line.decode('utf-8')
+        except UnicodeDecodeError:
+            text = line.decode('latin-1') # Older collectors export in Windows-1252
+        if i == 0: text = text.lstrip('\ufeff')
+        yield text
+
+def tee_lines(stream, out, max_bytes=None):
+    """Yields the lines of a binary stream while copying them to `out`; raises ScanTooLarge past max_bytes."""
+    written = 0
+    for line in stream:
+        written += len(line)
+        if max_bytes is not None and written > max_bytes: raise ScanTooLarge()
+        out.write(line)
+        yield line
+
+def save_scan(stream, folder, is_csv=False, max_bytes=MAX_SCAN_BYTES):
+    """Stores a scan upload and tallies it in one pass.
+
+    Returns (scan_id, summary); summary has line/code counts and the most
+    repeated codes with their counts.
+    """
+    scan_id = uuid.uuid4().hex
+    path = os.path.join(folder, f"scan_{scan_id}{'.csv' if is_csv else '.txt'}")
+
+    counts = {} # code -> times scanned, in first-seen order
+    try:
+        with open(path, 'wb') as out:
+            for code in iter_scanned_codes(decode_lines(tee_lines(stream, out, max_bytes)), is_csv):
+                counts[code] = counts.get(code, 0) + 1
+    except Exception:
+        if os.path.exists(path): os.remove(path)
+        raise
+    if not counts: os.remove(path) # Nothing to audit, nothing to keep
+
+    duplicates = {code: n for code, n in counts.items() if n > 1}
+    top = sorted(duplicates.items(), key=lambda item: -item[1])[:TOP_DUPLICATES]
+    return scan_id, {
+        'scan_id': scan_id,
+        'codes': sum(counts.values()),
+        'unique': len(counts),
+        'duplicated_codes': len(duplicates),
+        'duplicates': dict(top)
+    }
+
+def read_scan(path):
+    """Set of codes of a stored scan, streamed from disk."""
+    with open(path, 'rb') as f:
+        return set(iter_scanned_codes(decode_lines(f), path.endswith('.csv')))
+
+def scan_lines(path):
+    """Decoded lines of a stored scan (e.g. for room markers)."""
+    with open(path, 'rb') as f:
+        yield from decode_lines(f)
@@ -0,0 +1,124 @@
+import os
+import time
+import threading
+import traceback
+
+try:
+    import fcntl
+except ImportError: # Windows (iniciar_sistema.bat)
+    fcntl = None
+    import msvcrt
+
+from .models import db
+
+# --- Host Scheduler ---
+# Periodic maintenance (health ping, cache warm-up) runs in exactly one process
+# per host: every gunicorn worker tries a non-blocking lock on the same file and
+# only the winner starts the scheduler thread. The lock dies with its process,
+# so the next worker to start takes over.
+
+SCHEDULER_TICK_SECONDS = 30 # Longest sleep between due checks
+
+class HostLock:
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def acquire(self):
+        """True if this process now holds the lock (kept until exit)."""
+        f = open(self.path, 'a+')
+        try:
+            if fcntl:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            f.close()
+            return False
+        f.seek(0)
+        f.truncate()
+        f.write(str(os.getpid()))
+        f.flush()
+        self._file = f
+        return True
+
+    @property
+    def held(self):
+        return self._file is not None
+
+class Task:
+    def __init__(self, name, interval, func, run_at_start):
+        self.name = name
+        self.interval = interval
+        self.func = func
+        self.next_run = time.time() if run_at_start else time.time() + interval
+        self.runs = 0
+        self.failures = 0
+        self.last_run = None
+        self.last_seconds = None
+        self.last_error = None
+
+    def stats(self):
+        return {
+            'interval': self.interval,
+            'runs': self.runs,
+            'failures': self.failures,
+            'last_run': self.last_run,
+            'last_seconds': self.last_seconds,
+            'last_error': self.last_error,
+            'next_run': self.next_run
+        }
+
+class Scheduler:
+    def __init__(self):
+        self.tasks = []
+        self.lock = None
+        self._started = False
+
+    def add(self, name, interval, func, run_at_start=True):
+        """func() runs every `interval` seconds inside an app context."""
+        self.tasks.append(Task(name, interval, func, run_at_start))
+
+    def start(self, app, lock_path):
+        """Starts the scheduler thread if this process wins the host lock."""
+        if self._started: return False
+        self._started = True
+        self.lock = HostLock(lock_path)
+        if not self.lock.acquire():
+            return False
+        threading.Thread(target=self._loop, args=(app,), daemon=True, name='host-scheduler').start()
+        return True
+
+    def _run(self, app, task):
+        started = time.time()
+        with app.app_context():
+            try:
+                task.func()
+                task.last_error = None
+            except Exception as e:
+                traceback.print_exc()
+                task.failures += 1
+                task.last_error = str(e)
+            finally:
+                db.session.remove()
+        task.runs += 1
+        task.last_run = started
+        task.last_seconds = round(time.time() - started, 3)
+        task.next_run = time.time() + task.interval
+
+    def _loop(self, app):
+        while True:
+            for task in self.tasks:
+                if task.next_run <= time.time():
+                    self._run(app, task)
+            next_due = min((t.next_run for t in self.tasks), default=time.time() + SCHEDULER_TICK_SECONDS)
+            time.sleep(min(SCHEDULER_TICK_SECONDS, max(1, next_due - time.time())))
+
+    def stats(self):
+        return {
+            'host': bool(self.lock and self.lock.held), # This process runs the tasks
+            'tasks': {t.name: t.stats() for t in self.tasks} if self.lock and self.lock.held else {}
+        }
+
+scheduler = Scheduler()
@@ -0,0 +1,155 @@
+import json
+import hashlib
+from datetime import datetime
+
+from .models import db, MasterSchema
+from .normalize import header_columns, cell_text, fold, ROLE_LOCATION, ROLE_DENOMINATION, ROLE_ASSET_DENOMINATION, ROLE_INVENTORY
+
+# --- Sheet Layout Detection ---
+# Where the "Localização" room header and the "Nº Invent" item header sit in a
+# sheet is learned once per master and stored (MasterSchema). Later parses only
+# re-read the two header rows and compare their fingerprint; a full scan for
+# headers happens only when the layout is new or the headers moved.
+
+# Room headers sit at the top of the ERP export; past this many rows we give up
+ROOM_SCAN_MAX_ROWS = 200
+
+def room_header_columns(row):
+    """Returns (loc_idx, denom_idx, inv_idx) if the row is a "Localização" header, else None."""
+    columns = header_columns(row)
+    if ROLE_LOCATION not in columns:
+        return None
+    # "Denominação do imobilizado" is the items list, not the room's name
+    return columns[ROLE_LOCATION], columns.get(ROLE_DENOMINATION, -1), columns.get(ROLE_INVENTORY, -1)
+
+def room_display_name(data_row, columns):
+    """Builds "Loc - Denom - Inv" from the row under a room header, or None."""
+    parts = [cell_text(data_row[idx]) for idx in columns if idx != -1 and idx < len(data_row) and data_row[idx]]
+    parts = [p for p in parts if p and p != "None"]
+    return " - ".join(parts) if parts else None
+
+def find_room_header(rows, max_rows=ROOM_SCAN_MAX_ROWS):
+    """Returns (header_row, columns, room_name) of the first room header with a data row, or (-1, None, None).
+
+    Walks `rows` lazily (any iterable) and stops at the header's data row, so
+    only a couple of rows are ever held in memory.
+    """
+    pending = None # Header columns waiting for their data row
+    for r_idx, row in enumerate(rows):
+        if r_idx >= max_rows:
+            break
+        if pending:
+            name = room_display_name(row, pending)
+            if name:
+                # One room per sheet: stop at the first valid header line
+                return r_idx - 1, pending, name
+        pending = room_header_columns(row)
+    return -1, None, None
+
+def find_room_name(rows, max_rows=ROOM_SCAN_MAX_ROWS):
+    """Returns the room display name of a sheet or None."""
+    return find_room_header(rows, max_rows)[2]
+
+def find_inventory_header(rows):
+    """Returns (header_row, inv_idx, desc_idx) of the "Nº Invent" header, or (-1, -1, -1)."""
+    for r_idx, row in enumerate(rows):
+        columns = header_columns(row)
+        if ROLE_INVENTORY in columns:
+            desc = [columns[role] for role in (ROLE_DENOMINATION, ROLE_ASSET_DENOMINATION) if role in columns]
+            return r_idx, columns[ROLE_INVENTORY], max(desc, default=-1) # Rightmost "Denominação", as before
+    return -1, -1, -1
+
+# --- Layouts ---
+
+def layout_fingerprint(rows, room_header_row, header_row):
+    """SHA-1 of the (folded) header rows a layout points at."""
+    h = hashlib.sha1()
+    for r_idx in (room_header_row, header_row):
+        row = rows[r_idx] if 0 <= r_idx < len(rows) else ()
+        h.update('\x1f'.join(fold(c) if c is not None else '' for c in row).rstrip('\x1f').encode('utf-8'))
+        h.update(b'\n')
+    return h.hexdigest()
+
+def make_layout(rows, room_header_row, room_columns, header_row, inv_idx, desc_idx):
+    return {
+        'room_header_row': room_header_row,
+        'room_columns': list(room_columns) if room_columns else None,
+        'header_row': header_row,
+        'inv_idx': inv_idx,
+        'desc_idx': desc_idx,
+        'fingerprint': layout_fingerprint(rows, room_header_row, header_row)
+    }
+
+def detect_layout(rows):
+    """Full scan of a sheet (list of rows) for its room and item headers."""
+    room_header_row, room_columns, _ = find_room_header(rows)
+    header_row, inv_idx, desc_idx = find_inventory_header(rows)
+    return make_layout(rows, room_header_row, room_columns, header_row, inv_idx, desc_idx)
+
+def layout_matches(layout, rows):
+    """True if `layout` still describes `rows` (its header rows are unchanged)."""
+    if not layout: return False
+    if not layout.get('manual') and (layout['header_row'] == -1 or layout['room_header_row'] == -1):
+        return False # Incomplete detections are retried, the headers may be further down now
+    return layout['fingerprint'] == layout_fingerprint(rows, layout['room_header_row'], layout['header_row'])
+
+def layout_room_name(rows, layout):
+    r_idx = layout['room_header_row']
+    if r_idx == -1 or not layout['room_columns'] or r_idx + 1 >= len(rows): return None
+    return room_display_name(rows[r_idx + 1], layout['room_columns'])
+
+def read_layout(rows, known=None):
+    """(layout, room_name) of a sheet: `known` if its header rows are unchanged, else a full scan."""
+    if layout_matches(known, rows):
+        room_name = layout_room_name(rows, known)
+        if room_name or known.get('manual'):
+            return known, room_name
+    layout = detect_layout(rows)
+    return layout, layout_room_name(rows, layout)
+
+# --- Stored Layouts ---
+
+def load_layouts(filepath):
+    """sheet_name -> layout of every stored sheet layout of a master."""
+    layouts = {}
+    for row in MasterSchema.query.filter_by(filepath=filepath):
+        layouts[row.sheet_name] = dict(json.loads(row.layout), manual=bool(row.manual))
+    return layouts
+
+def remember(filepath, sheets):
+    """Stores the layouts of parsed sheets that are new or changed (no commit). Returns how many."""
+    stored = {row.sheet_name: row for row in MasterSchema.query.filter_by(filepath=filepath)}
+    changed = 0
+    for sheet in sheets:
+        layout = {k: v for k, v in sheet['layout'].items() if k != 'manual'}
+        row = stored.get(sheet['sheet_name'])
+        if row and row.fingerprint == layout['fingerprint'] and json.loads(row.layout) == layout:
+            continue
+        if row is None:
+            row = MasterSchema(filepath=filepath, sheet_name=sheet['sheet_name'])
+            db.session.add(row)
+        row.layout = json.dumps(layout)
+        row.fingerprint = layout['fingerprint']
+        row.manual = bool(sheet['layout'].get('manual')) # A stale manual layout gives way to the detected one
+        row.updated_at = datetime.utcnow()
+        changed += 1
+    return changed
+
+def set_manual(filepath, sheet_name, rows, room_header_row, room_columns, header_row, inv_idx, desc_idx):
+    """Stores an admin-fixed layout for one sheet (no commit). `rows` must reach both header rows."""
+    layout = make_layout(rows, room_header_row, room_columns, header_row, inv_idx, desc_idx)
+    row = MasterSchema.query.filter_by(filepath=filepath, sheet_name=sheet_name).first()
+    if row is None:
+        row = MasterSchema(filepath=filepath, sheet_name=sheet_name)
+        db.session.add(row)
+    row.layout = json.dumps(layout)
+    row.fingerprint = layout['fingerprint']
+    row.manual = True
+    row.updated_at = datetime.utcnow()
+    return dict(layout, manual=True)
+
+def forget(filepath, sheet_name=None):
+    """Drops stored layouts of a master, or of one of its sheets (no commit)."""
+    query = MasterSchema.query.filter_by(filepath=filepath)
+    if sheet_name is not None: query = query.filter_by(sheet_name=sheet_name)
+    query.delete(synchronize_session=False)
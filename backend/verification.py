@@ -0,0 +1,70 @@
+import re
+
+# --- Batched Code Comparison ---
+# Expected and scanned codes are compared as whole sets; results come back
+# column-oriented ({'code': [...], 'desc': [...]}) so report writers can
+# stream them without building one dict per item.
+
+# A collector line starting with this switches the room of the codes below it
+ROOM_MARKER = '#'
+
+STATUS_FOUND = 'Encontrado'
+STATUS_MISSING = 'Faltante'
+STATUS_EXTRA = 'Sobras'
+EXTRA_DESC = 'Não consta na planilha'
+
+# CSV exports carry the code in the first field (e.g. "code;date;reader")
+CSV_FIELD_RE = re.compile(r'[;,\t]')
+CSV_HEADER_RE = re.compile(r'^(c[oó]d|invent|n[º°o]\s*invent|patrim)', re.IGNORECASE)
+
+def iter_scanned_codes(lines, is_csv=False):
+    """Yields the stripped, non-empty code of each line (any iterable, read lazily)."""
+    for i, line in enumerate(lines):
+        if is_csv:
+            line = CSV_FIELD_RE.split(line, 1)[0].strip().strip('"')
+            if i == 0 and CSV_HEADER_RE.match(line): continue # Column header, not a code
+        code = line.strip()
+        if code: yield code
+
+def parse_scanned_codes(raw):
+    """Set of non-empty, stripped codes from the pasted collector text."""
+    return set(iter_scanned_codes(raw.splitlines()))
+
+def parse_room_markers(lines):
+    """Splits one tagged scan (iterable of lines) into {room: set of codes}, in marker order.
+
+    "# Sala 101" starts a room; the same room tagged twice is merged.
+    Raises ValueError if codes come before the first marker.
+    """
+    rooms = {}
+    current = None
+    for line in lines:
+        line = line.strip()
+        if not line: continue
+        if line.startswith(ROOM_MARKER):
+            current = rooms.setdefault(line[len(ROOM_MARKER):].strip(), set())
+        elif current is None:
+            raise ValueError(f'Código "{line}" sem sala: comece com "{ROOM_MARKER} <sala>"')
+        else:
+            current.add(line)
+    rooms.pop('', None)
+    return rooms
+
+def compare_codes(expected, scanned):
+    """Splits codes into verified, missing and extra.
+
+    expected: {code: desc} in master order. scanned: set of codes.
+    Verified and missing keep the master order; extra codes are sorted.
+    """
+    expected_codes = expected.keys()
+    found = expected_codes & scanned
+    extra = sorted(scanned - expected_codes)
+
+    verified_codes = [c for c in expected_codes if c in found]
+    missing_codes = [c for c in expected_codes if c not in found]
+
+    return {
+        'verified': {'code': verified_codes, 'desc': [expected[c] for c in verified_codes], 'status': STATUS_FOUND},
+        'missing': {'code': missing_codes, 'desc': [expected[c] for c in missing_codes], 'status': STATUS_MISSING},
+        'extra': {'code': extra, 'desc': [EXTRA_DESC] * len(extra), 'status': STATUS_EXTRA}
+    }
@@ -0,0 +1,148 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Default budget per worker, override with WORKBOOK_CACHE_MB
+DEFAULT_CACHE_MB = 64
+
+def file_hash(path):
+    """SHA-1 of the file contents, read in 1 MB chunks."""
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+# Content hashes of served files (ETags), memoized per (path, size, mtime)
+DIGEST_MEMO_SIZE = 1024
+_digests = OrderedDict()
+_digests_lock = threading.Lock()
+
+def file_digest(path, stat=None):
+    """file_hash(path), re-read only when the file's size or mtime changed."""
+    stat = stat or os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    with _digests_lock:
+        digest = _digests.get(key)
+        if digest:
+            _digests.move_to_end(key)
+            return digest
+    digest = file_hash(path)
+    with _digests_lock:
+        _digests[key] = digest
+        while len(_digests) > DIGEST_MEMO_SIZE:
+            _digests.popitem(last=False)
+    return digest
+
+def estimate_size(sheets):
+    """Rough memory footprint in bytes of a parsed workbook."""
+    total = 0
+    for sheet in sheets:
+        total += 256 + len(sheet['sheet_name']) + len(sheet['room_name'] or '')
+        for _, code, desc in sheet.get('items', ()):
+            total += 160 + len(code) + len(desc)
+    return total
+
+class WorkbookCache:
+    """In-process LRU of parsed workbooks, keyed by (filepath, size, mtime, content hash).
+
+    `kind` separates a full parse ('sheets') from lighter parses of the same
+    file, e.g. room headers only ('rooms').
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict() # key -> (sheets, size)
+        self._hashes = {} # (filepath, size, mtime) -> content hash
+        self._lock = threading.Lock()
+
+    def _key(self, filepath, path, kind):
+        stat = os.stat(path)
+        stat_key = (filepath, stat.st_size, stat.st_mtime)
+        with self._lock:
+            digest = self._hashes.get(stat_key)
+        if digest is None:
+            # Only re-hash when the file changed on disk; hashing stays outside the lock
+            digest = file_digest(path, stat)
+            with self._lock:
+                self._hashes[stat_key] = digest
+        return stat_key + (digest, kind)
+
+    def peek(self, filepath, path, kind='sheets'):
+        """Returns the cached parse of the file or None, without parsing or counting a miss."""
+        key = self._key(filepath, path, kind)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            return None # Not a miss: the caller falls back to a lighter parse
+
+    def get(self, filepath, path, parse, kind='sheets'):
+        """Returns parse(path) from cache, parsing and storing it on a miss."""
+        key = self._key(filepath, path, kind)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        sheets = parse(path) # Outside the lock: parsing is the slow part
+        self.put(key, sheets)
+        return sheets
+
+    def store(self, filepath, path, sheets, kind='sheets'):
+        """Stores a parse made elsewhere (e.g. on the process pool) after a peek missed."""
+        key = self._key(filepath, path, kind)
+        with self._lock:
+            self.misses += 1
+        self.put(key, sheets)
+
+    def put(self, key, sheets):
+        size = estimate_size(sheets)
+        with self._lock:
+            if key in self._entries:
+                self.current_bytes -= self._entries.pop(key)[1]
+            if size > self.max_bytes:
+                return # Larger than the whole budget, never cache
+
+            # Older versions of the same file are dead weight
+            for old_key in [k for k in self._entries if k[0] == key[0] and k[1:4] != key[1:4]]:
+                self.current_bytes -= self._entries.pop(old_key)[1]
+            for old_key in [k for k in self._hashes if k[0] == key[0] and k != key[:3]]:
+                del self._hashes[old_key]
+
+            self._entries[key] = (sheets, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, (_, old_size) = self._entries.popitem(last=False)
+                self.current_bytes -= old_size
+                self.evictions += 1
+
+    def invalidate(self, filepath):
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == filepath]:
+                self.current_bytes -= self._entries.pop(key)[1]
+            for key in [k for k in self._hashes if k[0] == filepath]:
+                del self._hashes[key]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+workbook_cache = WorkbookCache(int(os.environ.get('WORKBOOK_CACHE_MB', DEFAULT_CACHE_MB)) * 1024 * 1024)
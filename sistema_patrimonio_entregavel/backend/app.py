@@ -2,14 +2,18 @@ import os
 import zipfile
 import io
 import time
+import queue
 import sqlite3
-from flask import Flask, render_template, request, send_file, jsonify, session, g
+import threading
+from itertools import chain, islice
+from flask import Flask, render_template, request, send_file, jsonify, session, g, Response, stream_with_context
 from werkzeug.security import generate_password_hash, check_password_hash
 from openpyxl import load_workbook, Workbook
 from openpyxl.styles import PatternFill
 from copy import copy
 import unicodedata
 import re
+from datetime import datetime, timedelta
 
 app = Flask(__name__)
 app.secret_key = 'super_secret_key_sesi_sorocaba' # Change this in production!
@@ -82,6 +86,41 @@ def init_db():
             )
         ''')
 
+        # 5. Raw Scan Files (network of each file in scanned_data, for filtered exports)
+        db.execute('''
+            CREATE TABLE IF NOT EXISTS scanned_files (
+                filename TEXT PRIMARY KEY,
+                network_id INTEGER,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY(network_id) REFERENCES networks(id)
+            )
+        ''')
+
+        # 6. Global Code Index (inventory code -> file/sheet/row), kept in sync on upload/delete
+        # Only each sheet's code column is indexed; rows are read back from the workbook on a hit.
+        if 'row_id' in {c['name'] for c in db.execute('PRAGMA table_info(code_index)')}:
+            # Earlier index: every cell value of every row, plus each row as JSON. Rebuilt from scratch.
+            db.execute('DROP TABLE code_index')
+            db.execute('DROP TABLE IF EXISTS indexed_rows')
+            db.execute('DROP TABLE IF EXISTS indexed_files')
+        db.execute('''
+            CREATE TABLE IF NOT EXISTS indexed_files (
+                filename TEXT PRIMARY KEY,
+                mtime REAL NOT NULL
+            )
+        ''')
+        db.execute('''
+            CREATE TABLE IF NOT EXISTS code_index (
+                code TEXT NOT NULL,
+                filename TEXT NOT NULL,
+                sheet TEXT NOT NULL,
+                row_idx INTEGER NOT NULL
+            )
+        ''')
+        db.execute('CREATE INDEX IF NOT EXISTS idx_code_index_code ON code_index (code)')
+        db.execute('CREATE INDEX IF NOT EXISTS idx_code_index_file ON code_index (filename)')
+        db.commit()
+
         # Create Default Admin if not exists (Super Admin)
         cur = db.execute('SELECT * FROM users WHERE email = ?', ('admin@123',))
         if not cur.fetchone():
@@ -117,6 +156,195 @@ os.makedirs(SCANNED_DATA_FOLDER, exist_ok=True)
 REPORTS_FOLDER = os.path.join(PROJECT_ROOT, 'Relatorios_Gerados')
 os.makedirs(REPORTS_FOLDER, exist_ok=True)
 
+def backfill_scanned_files():
+    """Maps raw scans saved before scanned_files existed to their network.
+
+    /verify names the scan <analyst>_<room>_<timestamp>.txt and the report
+    <analyst>_<room>_Analise.zip, so the report row tells the network. Scans
+    without a report, or whose report name several networks used, are stored
+    with no network; filtered exports still include those.
+    """
+    with app.app_context():
+        db = get_db()
+        known = {r['filename'] for r in db.execute('SELECT filename FROM scanned_files')}
+        missing = [name for name in os.listdir(SCANNED_DATA_FOLDER)
+                   if name not in known and os.path.isfile(os.path.join(SCANNED_DATA_FOLDER, name))]
+        if not missing: return
+
+        report_networks = {}
+        for r in db.execute('SELECT DISTINCT filename, network_id FROM reports'):
+            report_networks.setdefault(r['filename'], set()).add(r['network_id'])
+        rows = []
+        for name in missing:
+            match = re.match(r'(.+)_\d{8}_\d{6}\.txt$', name)
+            networks = report_networks.get(f'{match.group(1)}_Analise.zip', set()) if match else set()
+            rows.append((name, networks.pop() if len(networks) == 1 else None))
+        db.executemany('INSERT OR IGNORE INTO scanned_files (filename, network_id) VALUES (?, ?)', rows)
+        db.commit()
+
+backfill_scanned_files()
+
+# --- Global Code Index ---
+# Masters are indexed on upload; a background thread catches up on files that
+# are missing from the index or changed on disk, so /verify never indexes on
+# the request path (it scans such a file directly and queues it instead).
+
+INDEX_HEADER_MAX_ROWS = 50 # The "Nº Invent" header sits near the top of a sheet
+INVENTORY_HEADER_RE = re.compile(r'\bn(?:o|r|ro|um|umero)?(?:\.\s*|\s+)(?:de\s+)?invent')
+
+_index_lock = threading.Lock() # Upload and the background thread may index the same file
+_index_queue = queue.Queue()
+
+def _fold(value):
+    text = unicodedata.normalize('NFKD', str(value).replace('º', 'o').replace('°', 'o'))
+    return ''.join(c for c in text if not unicodedata.combining(c)).strip().lower()
+
+def code_column(rows):
+    """(header_row, column) of the inventory codes: the "Nº Invent" column, else the first column under row 1."""
+    for r_idx, row in enumerate(rows):
+        for c_idx, value in enumerate(row):
+            if isinstance(value, str) and INVENTORY_HEADER_RE.search(_fold(value)):
+                return r_idx, c_idx
+    return 0, 0 # Same column /verify writes unknown codes to
+
+def code_rows(ws):
+    """Yields (row_idx, code, row) for every code in a sheet's code column (row_idx counts from 0)."""
+    rows = ws.iter_rows(values_only=True)
+    head = list(islice(rows, INDEX_HEADER_MAX_ROWS))
+    header_row, column = code_column(head)
+    for row_idx, row in enumerate(chain(head, rows)):
+        if row_idx <= header_row or column >= len(row) or row[column] is None: continue
+        code = str(row[column]).strip()
+        if code: yield row_idx, code, row
+
+def drop_file_index(db, filename):
+    db.execute('DELETE FROM code_index WHERE filename = ?', (filename,))
+    db.execute('DELETE FROM indexed_files WHERE filename = ?', (filename,))
+
+def index_file(db, filename):
+    """(Re)builds the code index of one master spreadsheet."""
+    file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    with _index_lock:
+        mtime = os.path.getmtime(file_path)
+        wb = load_workbook(file_path, read_only=True, data_only=True)
+        try:
+            entries = [(code, filename, sheet_name, row_idx)
+                       for sheet_name in wb.sheetnames for row_idx, code, _ in code_rows(wb[sheet_name])]
+        finally:
+            wb.close()
+
+        drop_file_index(db, filename)
+        db.executemany('INSERT INTO code_index (code, filename, sheet, row_idx) VALUES (?, ?, ?, ?)', entries)
+        db.execute('INSERT INTO indexed_files (filename, mtime) VALUES (?, ?)', (filename, mtime))
+        db.commit()
+
+def index_is_current(db, filename):
+    file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    row = db.execute('SELECT mtime FROM indexed_files WHERE filename = ?', (filename,)).fetchone()
+    return bool(row) and row['mtime'] == os.path.getmtime(file_path)
+
+def queue_index(filename):
+    _index_queue.put(filename)
+
+def _index_worker():
+    while True:
+        filename = _index_queue.get()
+        with app.app_context():
+            db = get_db()
+            try:
+                if os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], filename)) and not index_is_current(db, filename):
+                    index_file(db, filename)
+            except Exception as e:
+                print(f"Error indexing {filename}: {e}")
+
+def start_indexer():
+    threading.Thread(target=_index_worker, daemon=True, name='code-index').start()
+    with app.app_context():
+        for r in get_db().execute('SELECT DISTINCT filename FROM files'):
+            queue_index(r['filename']) # Files uploaded before the index, or changed on disk
+
+def read_rows(filename, wanted):
+    """{(sheet, row_idx): row values} for wanted = {sheet: {row_idx, ...}} of one master."""
+    found = {}
+    wb = load_workbook(os.path.join(app.config['UPLOAD_FOLDER'], filename), read_only=True, data_only=True)
+    try:
+        for sheet, indexes in wanted.items():
+            if sheet not in wb.sheetnames: continue
+            for row_idx, row in enumerate(wb[sheet].iter_rows(max_row=max(indexes) + 1, values_only=True)):
+                if row_idx in indexes: found[(sheet, row_idx)] = list(row)
+    finally:
+        wb.close()
+    return found
+
+def scan_file(filename, codes, skip_sheet=None):
+    """First occurrence of each code in one master, read directly (file not indexed yet)."""
+    found = {}
+    wb = load_workbook(os.path.join(app.config['UPLOAD_FOLDER'], filename), read_only=True, data_only=True)
+    try:
+        for sheet_name in wb.sheetnames:
+            if skip_sheet == (filename, sheet_name): continue
+            for _, code, row in code_rows(wb[sheet_name]):
+                if code in codes and code not in found:
+                    found[code] = {'location': sheet_name, 'row_values': list(row)}
+            if len(found) == len(codes): break
+    finally:
+        wb.close()
+    return found
+
+def lookup_codes(db, codes, filenames, skip_sheet=None):
+    """First occurrence of each code across `filenames` (in that order).
+
+    Indexed files answer from the index; the others are scanned and queued for indexing.
+    skip_sheet: (filename, sheet) left out of the search (the audited room).
+    Returns {code: {'location': sheet, 'row_values': [...]}}.
+    """
+    indexed = []
+    for filename in filenames:
+        if index_is_current(db, filename): indexed.append(filename)
+        else: queue_index(filename)
+
+    hits = {} # code -> (rank, rowid, filename, sheet, row_idx)
+    file_rank = {f: i for i, f in enumerate(filenames)}
+    codes = list(codes)
+    for start in range(0, len(codes), 500): # Stay under SQLite's variable limit
+        chunk = codes[start:start + 500]
+        rows = db.execute(f'''
+            SELECT rowid, code, filename, sheet, row_idx FROM code_index
+            WHERE code IN ({','.join('?' * len(chunk))})
+        ''', chunk).fetchall()
+        for r in rows:
+            if r['filename'] not in indexed: continue
+            if skip_sheet and (r['filename'], r['sheet']) == skip_sheet: continue
+            key = (file_rank[r['filename']], r['rowid'])
+            if r['code'] not in hits or key < hits[r['code']][:2]:
+                hits[r['code']] = key + (r['filename'], r['sheet'], r['row_idx'])
+
+    # Row values of the hits only, one workbook read per file that has any
+    wanted = {}
+    for _, _, filename, sheet, row_idx in hits.values():
+        wanted.setdefault(filename, {}).setdefault(sheet, set()).add(row_idx)
+    rows = {}
+    for filename, sheets in wanted.items():
+        rows.update({(filename,) + key: row for key, row in read_rows(filename, sheets).items()})
+
+    found = {}
+    for filename in filenames: # File order decides which occurrence wins
+        if filename in indexed:
+            for code, (_, _, f, sheet, row_idx) in hits.items():
+                if f == filename and code not in found and (f, sheet, row_idx) in rows:
+                    found[code] = {'location': sheet, 'row_values': rows[(f, sheet, row_idx)]}
+        else:
+            pending = set(codes) - set(found)
+            if not pending: break
+            try:
+                for code, data in scan_file(filename, pending, skip_sheet).items():
+                    found.setdefault(code, data)
+            except Exception as e:
+                print(f"Error reading {filename}: {e}")
+    return found
+
+start_indexer()
+
 # --- Routes ---
 
 @app.route('/')
@@ -321,6 +549,12 @@ def upload_master():
         db.execute('INSERT INTO files (filename, city, user_id) VALUES (?, ?, ?)', (filename, city, user_id))
         db.commit()
 
+        # Keep the global code index in sync (replaces the old entries on re-upload)
+        try:
+            index_file(db, filename)
+        except Exception as e:
+            print(f"Error indexing {filename}: {e}")
+
         return jsonify({'message': f'Planilha "{filename}" carregada com sucesso para {city}!'})
     
     return jsonify({'error': 'Formato de arquivo inválido. Apenas .xlsx'}), 400
@@ -409,6 +643,7 @@ def delete_master():
         try:
             os.remove(file_path)
             db.execute('DELETE FROM files WHERE filename = ?', (filename,))
+            drop_file_index(db, filename)
             db.commit()
             return jsonify({'message': f'Planilha "{filename}" removida com sucesso'})
         except Exception as e:
@@ -416,6 +651,7 @@ def delete_master():
     else:
         # Just clean DB if file missing
         db.execute('DELETE FROM files WHERE filename = ?', (filename,))
+        drop_file_index(db, filename)
         db.commit()
         return jsonify({'error': 'Planilha não encontrada (DB Limpo)'}), 404
 
@@ -591,23 +827,87 @@ def download_all_data():
     if not session.get('is_admin'):
         return jsonify({'error': 'Acesso negado.'}), 403
     
+    # Optional filters: ?start=YYYY-MM-DD&end=YYYY-MM-DD (inclusive) &network_id=N
     try:
-        memory_file = io.BytesIO()
-        with zipfile.ZipFile(memory_file, 'w', zipfile.ZIP_DEFLATED) as zf:
-            if os.path.exists(SCANNED_DATA_FOLDER):
-                for filename in os.listdir(SCANNED_DATA_FOLDER):
-                    file_path = os.path.join(SCANNED_DATA_FOLDER, filename)
-                    zf.write(file_path, arcname=filename)
-        
-        memory_file.seek(0)
-        return send_file(
-            memory_file,
-            mimetype='application/zip',
-            as_attachment=True,
-            download_name='Todos_Dados_Brutos.zip'
-        )
-    except Exception as e:
-         return jsonify({'error': str(e)}), 500
+        start = datetime.strptime(request.args['start'], '%Y-%m-%d') if request.args.get('start') else None
+        end = datetime.strptime(request.args['end'], '%Y-%m-%d') + timedelta(days=1) if request.args.get('end') else None
+    except ValueError:
+        return jsonify({'error': 'Data inválida (use AAAA-MM-DD)'}), 400
+
+    network_id = request.args.get('network_id', type=int)
+    db = get_db()
+    if network_id is not None:
+        net = db.execute('SELECT admin_id FROM networks WHERE id = ?', (network_id,)).fetchone()
+        u = db.execute('SELECT email FROM users WHERE id = ?', (session.get('user_id'),)).fetchone()
+        is_super = u and u['email'] == 'admin@123'
+        if not net or (net['admin_id'] != session.get('user_id') and not is_super):
+            return jsonify({'error': 'Acesso negado'}), 403
+        # Scans whose network could not be recovered (see backfill_scanned_files) go to every network's export
+        allowed = {r['filename'] for r in db.execute('SELECT filename FROM scanned_files WHERE network_id = ? OR network_id IS NULL', (network_id,))}
+
+    entries = []
+    for entry in sorted(os.scandir(SCANNED_DATA_FOLDER), key=lambda e: e.name) if os.path.exists(SCANNED_DATA_FOLDER) else []:
+        if not entry.is_file(): continue
+        if network_id is not None and entry.name not in allowed: continue
+        scanned_at = scan_timestamp(entry)
+        if start and scanned_at < start: continue
+        if end and scanned_at >= end: continue
+        entries.append((entry.path, entry.name))
+
+    # Entries are compressed and sent while the files are read: memory stays flat however big the archive gets
+    return Response(
+        stream_with_context(stream_zip(entries)),
+        mimetype='application/zip',
+        headers={'Content-Disposition': 'attachment; filename=Todos_Dados_Brutos.zip'}
+    )
+
+def scan_timestamp(entry):
+    """When a raw scan was saved: the timestamp in its name (see /verify), else the file mtime."""
+    match = re.search(r'_(\d{8}_\d{6})\.txt$', entry.name)
+    if match:
+        try:
+            return datetime.strptime(match.group(1), '%Y%m%d_%H%M%S')
+        except ValueError:
+            pass
+    return datetime.fromtimestamp(entry.stat().st_mtime)
+
+class ZipStream:
+    """Write-only, non-seekable sink for ZipFile; pop() hands over what was written so far."""
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+ZIP_STREAM_CHUNK = 64 * 1024
+
+def stream_zip(entries):
+    """Yields a ZIP archive of [(path, arcname)] chunk by chunk (data descriptors, no seeking)."""
+    sink = ZipStream()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for path, arcname in entries:
+            try:
+                info = zipfile.ZipInfo.from_file(path, arcname)
+                src = open(path, 'rb')
+            except OSError:
+                continue # Removed while the export was running
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with src, zf.open(info, 'w', force_zip64=True) as dest:
+                for chunk in iter(lambda: src.read(ZIP_STREAM_CHUNK), b''):
+                    dest.write(chunk)
+                    data = sink.pop()
+                    if data: yield data
+            yield sink.pop()
+    yield sink.pop() # Central directory
 
 
 # --- Core Logic: Verify ---
@@ -664,6 +964,10 @@ def verify():
             f.write(f"Data: {timestamp}\n")
             f.write("-" * 20 + "\n")
             f.write(scanned_codes_raw)
+
+        db = get_db()
+        db.execute('INSERT OR REPLACE INTO scanned_files (filename, network_id) VALUES (?, ?)', (raw_filename, current_net_id))
+        db.commit()
         
         # ... logic ...
         wb = load_workbook(source_path)
@@ -728,22 +1032,9 @@ def verify():
         found_map = {}
         
         if scanned_but_not_in_room:
-             for fname in files_to_search:
-                fpath = os.path.join(app.config['UPLOAD_FOLDER'], fname)
-                if not os.path.exists(fpath): continue
-                try:
-                    wb_search = load_workbook(fpath, read_only=True, data_only=True)
-                    for sheet_name in wb_search.sheetnames:
-                        if fname == source_file and sheet_name == selected_room: continue
-                        sheet = wb_search[sheet_name]
-                        for row in sheet.iter_rows(values_only=True):
-                            row_str = [str(v).strip() for v in row if v is not None]
-                            intersection = set(row_str).intersection(scanned_but_not_in_room)
-                            for code in intersection:
-                                if code not in found_map: found_map[code] = {'location': sheet_name, 'row_values': list(row)}
-                        if len(found_map) == len(scanned_but_not_in_room): break
-                    wb_search.close()
-                except: pass
+             # Lookups in the global code index instead of re-reading every file
+             searchable = [fname for fname in files_to_search if os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], fname))]
+             found_map = lookup_codes(get_db(), scanned_but_not_in_room, searchable, skip_sheet=(source_file, selected_room))
         
         for code in scanned_but_not_in_room:
             if code in found_map:
@@ -0,0 +1,42 @@
+import os
+import sys
+import uuid
+import tempfile
+
+import pytest
+
+# Request-level tests run the real app against a throwaway database and data
+# folder: backend.app reads these at import, so they are set before any test imports it.
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+DATA_ROOT = tempfile.mkdtemp(prefix='patrimonio-tests-')
+os.environ['DATA_ROOT'] = DATA_ROOT
+os.environ['DATABASE_PATH'] = os.path.join(DATA_ROOT, 'database.db')
+os.environ['JOB_WORKERS'] = '0' # Tests claim and run jobs themselves
+sys.path.insert(0, ROOT)
+
+@pytest.fixture(scope='session')
+def app():
+    from backend.app import app
+    app.config['TESTING'] = True
+    return app
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+@pytest.fixture
+def admin(app):
+    """A fresh admin with one network: {'email', 'password', 'network_id', 'network_password', 'user_id'}."""
+    from backend.models import User, Network
+    tag = uuid.uuid4().hex[:8]
+    account = {'email': f'admin-{tag}@teste', 'password': 'senha', 'network_password': 'rede'}
+    res = app.test_client().post('/register_admin', json={
+        'email': account['email'], 'password': account['password'], 'city': 'Sorocaba',
+        'network_name': f'Rede {tag}', 'network_password': account['network_password']
+    })
+    assert res.status_code == 200, res.get_json()
+    with app.app_context():
+        user = User.query.filter_by(email=account['email']).first()
+        account['user_id'] = user.id
+        account['network_id'] = Network.query.filter_by(admin_id=user.id).first().id
+    return account
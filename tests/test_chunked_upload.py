@@ -0,0 +1,51 @@
+import io
+import uuid
+import hashlib
+import threading
+
+from backend import chunked_upload
+from backend.models import db, UploadSession
+
+class StallingStream(io.BytesIO):
+    """Hands out its first block, then waits until every writer has its temp file open."""
+
+    def __init__(self, data, barrier):
+        super().__init__(data)
+        self.barrier = barrier
+        self.reads = 0
+
+    def read(self, size=-1):
+        self.reads += 1
+        if self.reads == 2: self.barrier.wait(timeout=5)
+        return super().read(min(size, 1024))
+
+def test_same_chunk_retried_by_two_threads(app, tmp_path):
+    data = b'x' * 4096
+    with app.app_context():
+        upload = UploadSession(id=uuid.uuid4().hex, filename='m.xlsx', filepath='m.xlsx',
+                               total_size=len(data), chunk_size=len(data))
+        db.session.add(upload)
+        db.session.commit()
+        upload_id = upload.id
+
+    barrier = threading.Barrier(2)
+    errors = []
+    def send():
+        with app.app_context():
+            try:
+                chunked_upload.save_chunk(str(tmp_path), db.session.get(UploadSession, upload_id), 0,
+                                          StallingStream(data, barrier), hashlib.sha1(data).hexdigest())
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=send) for _ in range(2)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+
+    assert errors == []
+    with app.app_context():
+        upload = db.session.get(UploadSession, upload_id)
+        assert chunked_upload.upload_status(str(tmp_path), upload)['received'] == [0]
+        folder = chunked_upload.session_folder(str(tmp_path), upload)
+    with open(f'{folder}/0.part', 'rb') as f:
+        assert f.read() == data
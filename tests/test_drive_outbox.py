@@ -0,0 +1,121 @@
+import os
+import time
+from datetime import datetime, timedelta
+
+from backend import drive_manager, drive_outbox
+from backend.models import db, DriveOutbox, FileMetadata
+
+class FlakyDrive(drive_manager.LocalFolderDrive):
+    """LocalFolderDrive whose next `failures` file uploads answer 503; records the folders it creates."""
+
+    def __init__(self, root, failures=0):
+        super().__init__(root)
+        self.failures = failures
+        self.folders = []
+
+    def create(self, body, media_body=None, fields=None):
+        if media_body is None:
+            self.folders.append(body['name'])
+        elif self.failures:
+            self.failures -= 1
+            raise drive_manager.LocalDriveError(503, 'Backend Error')
+        return super().create(body, media_body, fields)
+
+def local_sync(root, drive=None, retries=drive_manager.DRIVE_MAX_RETRIES):
+    drive = drive or drive_manager.LocalFolderDrive(str(root))
+    return drive_manager.DriveSync(service_factory=lambda: drive, media_factory=lambda path: path,
+                                   retries=retries, backoff=0, sleep=lambda s: None)
+
+def queue_report(app, reports, filename, analyst_name, room_name, file_id=None):
+    with open(os.path.join(reports, filename), 'w') as f:
+        f.write('zip')
+    with app.app_context():
+        return drive_outbox.enqueue(filename, analyst_name, room_name, file_id=file_id).id
+
+def add_report_row(app, filename):
+    with app.app_context():
+        row = FileMetadata(filename=filename, filepath=filename, type='audit_report')
+        db.session.add(row)
+        db.session.commit()
+        return row.id
+
+def test_quoted_analyst_name_syncs(app, tmp_path):
+    reports, drive = tmp_path / 'reports', tmp_path / 'drive'
+    reports.mkdir()
+    entry_id = queue_report(app, str(reports), 'Auditoria_quote.zip', "D'Ana \\ Souza", 'Sala 1')
+
+    with app.app_context():
+        assert drive_outbox.drain_once(str(reports), local_sync(drive)) >= 1
+        entry = db.session.get(DriveOutbox, entry_id)
+        assert (entry.status, entry.last_error) == ('done', None)
+        name = drive_manager.audit_folder_name("D'Ana \\ Souza", 'Sala 1', entry.created_at)
+    assert (drive / drive_manager.ROOT_FOLDER_NAME / name / 'Auditoria_quote.zip').exists()
+
+def test_audits_share_folders_and_links_are_written_back(app, tmp_path):
+    reports, root = tmp_path / 'reports', tmp_path / 'drive'
+    reports.mkdir()
+    drive = FlakyDrive(str(root), failures=1) # First upload hits a 503, retried in place
+    file_ids = [add_report_row(app, f'Auditoria_{i}.zip') for i in range(3)]
+    ids = [queue_report(app, str(reports), 'Auditoria_0.zip', 'Ana', 'Sala 1', file_ids[0]),
+           queue_report(app, str(reports), 'Auditoria_1.zip', 'Ana', 'Sala 1', file_ids[1]),
+           queue_report(app, str(reports), 'Auditoria_2.zip', 'Ana', 'Sala 2', file_ids[2])]
+
+    sync = local_sync(root, drive)
+    with app.app_context():
+        drive_outbox.drain_once(str(reports), sync)
+        entries = [db.session.get(DriveOutbox, i) for i in ids]
+        assert [(e.status, e.attempts) for e in entries] == [('done', 0)] * 3
+        room_1 = drive_manager.audit_folder_name('Ana', 'Sala 1', entries[0].created_at)
+        room_2 = drive_manager.audit_folder_name('Ana', 'Sala 2', entries[2].created_at)
+        links = [db.session.get(FileMetadata, i).web_view_link for i in file_ids]
+    assert drive.failures == 0
+    assert drive.folders == [drive_manager.ROOT_FOLDER_NAME, room_1, room_2] # One folder per room, root once
+    folder_link = 'file://' + str(root / drive_manager.ROOT_FOLDER_NAME / room_1)
+    assert links[:2] == [folder_link, folder_link]
+    assert links[2].endswith(room_2)
+
+    # A new process (cold folder cache) finds the existing folders instead of creating them again
+    later = queue_report(app, str(reports), 'Auditoria_3.zip', 'Ana', 'Sala 1')
+    other = FlakyDrive(str(root))
+    with app.app_context():
+        drive_outbox.drain_once(str(reports), local_sync(root, other))
+        assert db.session.get(DriveOutbox, later).status == 'done'
+    assert other.folders == []
+    assert (root / drive_manager.ROOT_FOLDER_NAME / room_1 / 'Auditoria_3.zip').exists()
+
+def test_transient_failure_is_retried_on_a_later_drain(app, tmp_path):
+    reports, root = tmp_path / 'reports', tmp_path / 'drive'
+    reports.mkdir()
+    entry_id = queue_report(app, str(reports), 'Auditoria_retry.zip', 'Bia', 'Sala 3')
+
+    drive = FlakyDrive(str(root), failures=1)
+    with app.app_context():
+        drive_outbox.drain_once(str(reports), local_sync(root, drive, retries=0))
+        entry = db.session.get(DriveOutbox, entry_id)
+        assert (entry.status, entry.attempts, entry.last_error) == ('pending', 1, 'Backend Error')
+        assert entry.next_attempt_at > datetime.utcnow() # Backing off
+
+        entry.next_attempt_at = datetime.utcnow()
+        db.session.commit()
+        drive_outbox.drain_once(str(reports), local_sync(root, drive, retries=0))
+        entry = db.session.get(DriveOutbox, entry_id)
+        assert (entry.status, entry.last_error) == ('done', None)
+        assert entry.web_view_link.endswith(drive_manager.audit_folder_name('Bia', 'Sala 3', entry.created_at))
+
+def test_row_of_a_dead_worker_is_sent_after_the_sweep(app, tmp_path, monkeypatch):
+    reports, root = tmp_path / 'reports', tmp_path / 'drive'
+    reports.mkdir()
+    entry_id = queue_report(app, str(reports), 'Auditoria_stale.zip', 'Caio', 'Sala 4')
+    with app.app_context():
+        entry = db.session.get(DriveOutbox, entry_id)
+        entry.status = 'sending' # Claimed by a worker that died
+        entry.updated_at = datetime.utcnow() - timedelta(seconds=drive_outbox.OUTBOX_STALE_SECONDS + 60)
+        db.session.commit()
+
+        monkeypatch.setattr(drive_outbox, '_last_sweep', time.monotonic()) # Swept a moment ago
+        drive_outbox.drain_once(str(reports), local_sync(root))
+        assert db.session.get(DriveOutbox, entry_id).status == 'sending'
+
+        monkeypatch.setattr(drive_outbox, '_last_sweep', None)
+        drive_outbox.drain_once(str(reports), local_sync(root))
+        assert db.session.get(DriveOutbox, entry_id).status == 'done'
@@ -0,0 +1,44 @@
+import os
+import json
+import glob
+import hashlib
+
+from backend import master_index
+
+# Parity check: every workbook in planilhas/ must parse exactly as it did before
+# header detection moved to backend/normalize.py. The snapshot was taken with
+# the earlier substring rules; regenerate it only for an intended change.
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+SNAPSHOT = os.path.join(os.path.dirname(__file__), 'data', 'planilhas_parse.json')
+
+def summarize(sheet):
+    items = [list(item) for item in sheet['items']]
+    return {
+        'sheet_name': sheet['sheet_name'],
+        'room_name': sheet['room_name'],
+        'header_row': sheet['header_row'],
+        'inv_idx': sheet['inv_idx'],
+        'desc_idx': sheet['desc_idx'],
+        'items': len(items),
+        'items_sha1': hashlib.sha1(json.dumps(items, ensure_ascii=False).encode('utf-8')).hexdigest()
+    }
+
+def test_planilhas_parse_like_snapshot():
+    with open(SNAPSHOT, encoding='utf-8') as f:
+        expected = json.load(f)
+    files = sorted(glob.glob(os.path.join(ROOT, 'planilhas', '*.xlsx')))
+    assert {os.path.basename(p) for p in files} == set(expected)
+    for path in files:
+        parsed = [summarize(s) for s in master_index.parse_workbook(path)]
+        assert parsed == expected[os.path.basename(path)], os.path.basename(path)
+
+def test_salvo_room_header_is_not_the_item_header():
+    # "Empresa Nºinventário" heads the company column of the room header, not the item list
+    sheets = master_index.parse_workbook(os.path.join(ROOT, 'planilhas', 'salvo.xlsx'))
+    sheet = next(s for s in sheets if s['sheet_name'] == 'Table 2')
+    assert sheet['room_name'] == '10030080 - ARMÁRIO BAIXO COM 02 789595'
+    assert (sheet['header_row'], sheet['inv_idx'], sheet['desc_idx']) == (3, 0, 4)
+    codes = [code for _, code, _ in sheet['items']]
+    assert '1000' not in codes and 'Nº invent.' not in codes
+    assert codes[:2] == ['789595', '1600338']
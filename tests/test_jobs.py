@@ -0,0 +1,42 @@
+import uuid
+from datetime import datetime, timedelta
+
+from backend import jobs
+from backend.models import db, AuditJob
+
+def add_job(app, status='queued', attempts=0, quiet_for=0):
+    with app.app_context():
+        job = AuditJob(id=uuid.uuid4().hex, kind='test', payload='{}', status=status, attempts=attempts,
+                       created_at=datetime(2000, 1, 1), # Oldest in the queue, claimed first
+                       updated_at=datetime.utcnow() - timedelta(seconds=quiet_for))
+        db.session.add(job)
+        db.session.commit()
+        return job.id
+
+def job_row(app, job_id):
+    with app.app_context():
+        job = db.session.get(AuditJob, job_id)
+        return job.status, job.attempts
+
+def test_stale_jobs_are_requeued_until_the_attempt_limit(app):
+    stale = jobs.JOB_STALE_SECONDS + 60
+    retried = add_job(app, 'running', attempts=1, quiet_for=stale)
+    given_up = add_job(app, 'running', attempts=jobs.JOB_MAX_ATTEMPTS, quiet_for=stale)
+    busy = add_job(app, 'running', attempts=1)
+
+    with app.app_context():
+        jobs._requeue_stale()
+    assert job_row(app, retried) == ('queued', 1)
+    assert job_row(app, given_up) == ('error', jobs.JOB_MAX_ATTEMPTS)
+    assert job_row(app, busy) == ('running', 1)
+
+    with app.app_context():
+        assert jobs._claim_next() == retried
+    assert job_row(app, retried) == ('running', 2) # Each claim counts
+
+def test_stale_sweep_runs_on_a_timer(app, monkeypatch):
+    monkeypatch.setattr(jobs, '_last_sweep', None)
+    assert jobs._sweep_due()
+    assert not jobs._sweep_due() # Within JOB_SWEEP_SECONDS of the last one
+    monkeypatch.setattr(jobs, 'JOB_SWEEP_SECONDS', 0)
+    assert jobs._sweep_due()
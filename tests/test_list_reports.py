@@ -0,0 +1,32 @@
+from backend.models import db, FileMetadata
+
+def add_report(app, network_id, filename, link=None):
+    with app.app_context():
+        db.session.add(FileMetadata(filename=filename, filepath=filename, type='audit_report',
+                                    network_id=network_id, web_view_link=link))
+        db.session.commit()
+
+def test_network_user_lists_its_reports(app, client, admin):
+    add_report(app, admin['network_id'], f"Auditoria_{admin['user_id']}.zip", 'https://drive.example/pasta')
+
+    res = client.post('/join_network', json={'network_id': admin['network_id'], 'password': admin['network_password']})
+    assert res.status_code == 200
+
+    res = client.get('/list_reports')
+    assert res.status_code == 200
+    reports = res.get_json()['reports']
+    assert [r['filename'] for r in reports] == [f"Auditoria_{admin['user_id']}.zip"]
+    assert reports[0]['network_id'] == admin['network_id']
+    assert reports[0]['drive_link'] == 'https://drive.example/pasta'
+
+def test_admin_lists_reports_of_own_networks_only(app, client, admin):
+    add_report(app, admin['network_id'], f"Propria_{admin['user_id']}.zip")
+    add_report(app, admin['network_id'] + 1000, f"Outra_{admin['user_id']}.zip")
+
+    assert client.post('/login', json={'email': admin['email'], 'password': admin['password']}).status_code == 200
+    res = client.get('/list_reports')
+    assert res.status_code == 200
+    names = [r['filename'] for r in res.get_json()['reports']]
+    assert f"Propria_{admin['user_id']}.zip" in names
+    assert f"Outra_{admin['user_id']}.zip" not in names
+    assert all(r['drive_link'] is None for r in res.get_json()['reports'])
@@ -0,0 +1,65 @@
+import json
+import base64
+from datetime import datetime, timedelta
+
+import pytest
+
+from backend.models import db, FileMetadata
+
+@pytest.fixture
+def reports(app, admin):
+    """Five reports of the admin's network, one day apart; two share a date to exercise the id tiebreak."""
+    day = datetime(2024, 3, 1)
+    dates = [day, day + timedelta(days=1), day + timedelta(days=1), day + timedelta(days=2), day + timedelta(days=3)]
+    names = []
+    with app.app_context():
+        for i, date in enumerate(dates):
+            name = f"Pag_{admin['user_id']}_{i}.zip"
+            db.session.add(FileMetadata(filename=name, filepath=name, type='audit_report',
+                                        network_id=admin['network_id'], upload_date=date))
+            names.append(name)
+        db.session.commit()
+    return names
+
+def logged_in(app, admin):
+    client = app.test_client()
+    assert client.post('/login', json={'email': admin['email'], 'password': admin['password']}).status_code == 200
+    return client
+
+def all_pages(client, **params):
+    names, pages, cursor = [], 0, None
+    while True:
+        query = dict(params, **({'cursor': cursor} if cursor else {}))
+        res = client.get('/list_reports', query_string=query)
+        assert res.status_code == 200
+        body = res.get_json()
+        names += [r['filename'] for r in body['reports']]
+        pages += 1
+        cursor = body['next_cursor']
+        if not cursor: return names, pages
+
+def test_pages_follow_the_sort_without_gaps_or_repeats(app, admin, reports):
+    client = logged_in(app, admin)
+
+    names, pages = all_pages(client, limit=2)
+    assert names == [reports[4], reports[3], reports[2], reports[1], reports[0]] # Newest first, then higher id
+    assert pages == 3
+
+    names, _ = all_pages(client, limit=2, sort='name', order='asc')
+    assert names == reports
+
+    names, pages = all_pages(client, limit=5)
+    assert (len(names), pages) == (5, 1)
+
+@pytest.mark.parametrize('cursor', [
+    'abc', # Bad base64 padding
+    base64.urlsafe_b64encode(b'42').decode(), # Decodes to a number
+    base64.urlsafe_b64encode(b'"x"').decode(), # Decodes to a string
+    base64.urlsafe_b64encode(json.dumps(['2024-03-01T00:00:00']).encode()).decode(),
+    base64.urlsafe_b64encode(json.dumps([1, 2]).encode()).decode(),
+    base64.urlsafe_b64encode(json.dumps(['not a date', 2]).encode()).decode(),
+    base64.urlsafe_b64encode(b'\xff\xfe').decode(), # Not UTF-8
+])
+def test_tampered_cursor_is_a_bad_request(app, admin, reports, cursor):
+    res = logged_in(app, admin).get('/list_reports', query_string={'cursor': cursor})
+    assert res.status_code == 400
@@ -0,0 +1,27 @@
+from backend import progress
+
+def join(client, account):
+    res = client.post('/join_network', json={'network_id': account['network_id'], 'password': account['network_password']})
+    assert res.status_code == 200
+
+def test_request_stream_needs_a_session(client):
+    assert client.get('/progress/abcdefgh12/events').status_code == 403
+
+def test_request_stream_with_a_session_streams_published_events(app, admin):
+    client = app.test_client()
+    join(client, admin)
+    progress.publish('request:token-done-1', {'status': 'done', 'progress': 100}, final=True)
+    res = client.get('/progress/token-done-1/events')
+    assert res.status_code == 200
+    assert 'data: {"status": "done", "progress": 100}' in res.get_data(as_text=True)
+
+def test_unknown_token_stream_expires():
+    events = list(progress.stream('request:nobody', heartbeat=0.01, max_idle=0.05))
+    assert events[-1] == (0, {'status': 'expired'})
+    assert all(event is None for event in events[:-1])
+
+def test_stream_ends_after_its_lifetime():
+    progress.publish('request:long', {'stage': 'Lendo planilhas (1/9)...'})
+    events = list(progress.stream('request:long', heartbeat=0.01, max_seconds=0.05))
+    assert events[0] == (1, {'stage': 'Lendo planilhas (1/9)...'})
+    assert all(event is None for event in events[1:])
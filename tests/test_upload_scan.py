@@ -0,0 +1,60 @@
+import io
+import os
+
+import pytest
+
+from backend import scans
+
+def scan_files(app):
+    from backend.app import SCANNED_DATA_FOLDER
+    return set(os.listdir(SCANNED_DATA_FOLDER))
+
+def upload(client, text):
+    return client.post('/upload_scan', data={'file': (io.BytesIO(text.encode('utf-8')), 'coletor.txt')},
+                       content_type='multipart/form-data')
+
+def join(client, account):
+    res = client.post('/join_network', json={'network_id': account['network_id'], 'password': account['network_password']})
+    assert res.status_code == 200
+
+def test_anonymous_upload_is_refused_and_writes_nothing(app, client):
+    before = scan_files(app)
+    res = upload(client, '123\n456\n')
+    assert res.status_code == 403
+    assert scan_files(app) == before
+
+def test_network_user_uploads_and_other_network_cannot_use_the_scan(app, admin):
+    owner = app.test_client()
+    join(owner, admin)
+    res = upload(owner, '123\n456\n456\n')
+    assert res.status_code == 200
+    summary = res.get_json()
+    assert (summary['codes'], summary['unique'], summary['duplicates']) == (3, 2, {'456': 2})
+
+    # Another network's session: the scan_id is not theirs
+    other_admin = app.test_client()
+    res = other_admin.post('/register_admin', json={'email': f"outro-{summary['scan_id'][:8]}@teste", 'password': 's', 'city': 'Sorocaba',
+                                                    'network_name': f"Outra {summary['scan_id'][:8]}", 'network_password': 'r'})
+    assert res.status_code == 200
+    assert other_admin.post('/login', json={'email': f"outro-{summary['scan_id'][:8]}@teste", 'password': 's'}).status_code == 200
+    payload = {'source_file': 'qualquer.xlsx', 'room_name': 'Sala', 'scan_id': summary['scan_id']}
+    assert other_admin.post('/verify', json=payload).status_code == 403
+    assert other_admin.post('/verify_batch', json=payload).status_code == 403
+
+    # The uploader passes the scan check (and stops at the unknown master)
+    assert owner.post('/verify', json=payload).status_code == 404
+
+def test_oversized_scan_is_refused(app, admin, monkeypatch):
+    client = app.test_client()
+    join(client, admin)
+    monkeypatch.setattr(scans, 'MAX_SCAN_BYTES', 64)
+    before = scan_files(app)
+    res = upload(client, '1234567890\n' * 20)
+    assert res.status_code == 413
+    assert scan_files(app) == before
+
+def test_save_scan_stops_past_the_cap_without_content_length(tmp_path):
+    # Chunked bodies have no Content-Length: the cap is enforced while streaming
+    with pytest.raises(scans.ScanTooLarge):
+        scans.save_scan(io.BytesIO(b'1234567890\n' * 20), str(tmp_path), max_bytes=64)
+    assert list(tmp_path.iterdir()) == []